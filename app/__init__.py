@@ -16,6 +16,7 @@ _DEFAULT_CONFIG: Dict[str, Any] = {
         "transport_adapter": "app.lib.transports.http.ODKCentralHTTPTransportAdapter",
         "connect_timeout": 60,  # 1 minute
         "read_timeout": 300,  # 5 minutes
+        "max_workers": 8,
     },
     # TODO: Remove log handlers before going to production.
     "logging": {
@@ -1,24 +1,70 @@
+import json
+import multiprocessing
+import os
+import shutil
+import sys
 from argparse import ArgumentParser
-from typing import Any, Mapping
+from concurrent.futures import ProcessPoolExecutor
+from typing import Any, Collection, List, Mapping, Optional, Sequence
 
 from lxml import etree
 
 import app
-from app.core import AppData, Transport
-from app.lib import Pipeline
+from app.core import AppData, RichXFormsSubsError, Task, Transport
+from app.lib import (
+    SHARD_KEYS,
+    CSVSink,
+    FormCache,
+    HTTPMetricsRegistry,
+    MetricsCollector,
+    NDJSONSink,
+    Pipeline,
+    PipelineHook,
+    Shard,
+    SQLiteSink,
+    SyncStateStore,
+    Stage,
+    XLSXSink,
+    get_http_metrics_registry
+)
 from app.use_cases.main_pipeline import (
     AppDataToJson,
     FetchForms,
     FetchSubmissions,
+    SaveSyncState,
+    SubmissionConsumer
+)
+from app.use_cases.sharding import (
+    merge_outputs,
+    merge_shard_outputs,
+    write_shard_manifest
 )
 from app.utils import import_string
 
 
+# =============================================================================
+# CONSTANTS
+# =============================================================================
+
+_WORKERS_DIR_NAME: str = ".workers"
+
+_METRICS_JSON_FILE_NAME: str = "metrics.json"
+
+_METRICS_PROMETHEUS_FILE_NAME: str = "metrics.prom"
+
+_HTTP_METRICS_JSON_FILE_NAME: str = "http_metrics.json"
+
+_HTTP_METRICS_PROMETHEUS_FILE_NAME: str = "http_metrics.prom"
+
+
 # =============================================================================
 # HELPERS
 # =============================================================================
 
-def _init_transport_from_config(config: Mapping[str, Any]) -> Transport:
+def _init_transport_from_config(
+        config: Mapping[str, Any],
+        metrics_registry: Optional[HTTPMetricsRegistry] = None
+) -> Transport:
     # TODO: Nope. Revisit this. An abstract factory would work well here.
     #  This assumes that only a http transport is available.
     transport_klass = import_string(config["main_pipeline"]["transport"])
@@ -28,11 +74,19 @@ def _init_transport_from_config(config: Mapping[str, Any]) -> Transport:
     )
     connect_timeout = http_transport_config.get("connect_timeout")
     read_timeout = http_transport_config.get("read_timeout")
+    max_workers = http_transport_config.get("max_workers")
     transport_adapter_kwargs = http_transport_config["transport_adapter_kwargs"]
+    form_cache_config: Optional[Mapping[str, Any]] = config.get("form_cache")
+    form_cache: Optional[FormCache] = None
+    if form_cache_config:
+        form_cache = FormCache(**form_cache_config)
     transport = transport_klass(
         transport_adapter=transport_adapter(**transport_adapter_kwargs),
         connect_timeout=connect_timeout,
-        read_timeout=read_timeout
+        read_timeout=read_timeout,
+        max_workers=max_workers,
+        form_cache=form_cache,
+        metrics_registry=metrics_registry
     )
     return transport
 
@@ -75,6 +129,141 @@ def argparse_factory(prog_name: str = "rich_xforms_subs") -> ArgumentParser:
         ),
         type=str
     )
+    parser.add_argument(
+        "-i",
+        "--incremental",
+        action="store_true",
+        help=(
+            "Only retrieve the submissions received since the last run and "
+            "merge them into the existing outputs."
+        )
+    )
+    parser.add_argument(
+        "--state_file",
+        default=None,
+        help=(
+            "The location of the file used to persist the incremental sync "
+            "state (default: <out_dir>/sync_state.json)."
+        ),
+        type=str
+    )
+    parser.add_argument(
+        "-l",
+        "--lazy_forms",
+        action="store_true",
+        help=(
+            "Only retrieve the form versions referred to by the retrieved "
+            "submissions instead of every version of every form. Only the "
+            "retrieved form versions are then written to all_forms.json."
+        )
+    )
+    parser.add_argument(
+        "-f",
+        "--format",
+        choices=("json", "ndjson", "csv", "sqlite", "xlsx"),
+        default="json",
+        help=(
+            "The format of the retrieved submissions. With ndjson, csv, "
+            "sqlite and xlsx, the submissions are streamed to disk as they "
+            "are retrieved (default: %(default)s)."
+        ),
+        type=str
+    )
+    parser.add_argument(
+        "--compress",
+        action="store_true",
+        help="Gzip compress the streamed submissions."
+    )
+    parser.add_argument(
+        "--normalized",
+        action="store_true",
+        help=(
+            "Write each form version's schema once and only the values of "
+            "each streamed submission. Only applies to the ndjson format."
+        )
+    )
+    parser.add_argument(
+        "-t",
+        "--threaded",
+        action="store_true",
+        help=(
+            "Retrieve and write the submissions on separate threads, "
+            "overlapping the two."
+        )
+    )
+    parser.add_argument(
+        "-w",
+        "--workers",
+        default=1,
+        help=(
+            "The number of worker processes to split the forms across. Each "
+            "worker retrieves, parses and writes the submissions of its "
+            "share of the forms, and their outputs are then merged "
+            "(default: %(default)d)."
+        ),
+        type=int
+    )
+    parser.add_argument(
+        "-s",
+        "--shard",
+        default=None,
+        help=(
+            "Only process the given shard, <index>/<count>, of the forms, or "
+            "submissions, e.g. 0/4 for the first of four shards. Shards are "
+            "assigned by a stable hash of the form, or instance, ids and a "
+            "manifest of the shard's outputs is written for --merge."
+        ),
+        type=str
+    )
+    parser.add_argument(
+        "--shard_key",
+        choices=SHARD_KEYS,
+        default="form",
+        help=(
+            "Whether to shard by form id, each form being processed by a "
+            "single shard, or by instance id, each submission being processed "
+            "by a single shard (default: %(default)s)."
+        ),
+        type=str
+    )
+    parser.add_argument(
+        "--merge",
+        default=None,
+        help=(
+            "Merge the outputs of the shards in the given directories into "
+            "the output directory instead of retrieving any data."
+        ),
+        metavar="SHARD_DIR",
+        nargs="+",
+        type=str
+    )
+    parser.add_argument(
+        "-m",
+        "--metrics",
+        action="store_true",
+        help=(
+            "Collect the wall time, CPU time, items processed, bytes written "
+            "and peak memory usage of each stage of the run and write them to "
+            "the %s and %s (Prometheus text format) files in the output "
+            "directory. The latencies, bytes received, status codes, "
+            "re-authentications and retries after re-authentication of the "
+            "HTTP requests of the run, summarized by endpoint on exit, are "
+            "also written to the %s and %s files." % (
+                _METRICS_JSON_FILE_NAME,
+                _METRICS_PROMETHEUS_FILE_NAME,
+                _HTTP_METRICS_JSON_FILE_NAME,
+                _HTTP_METRICS_PROMETHEUS_FILE_NAME
+            )
+        )
+    )
+    parser.add_argument(
+        "--columnar",
+        action="store_true",
+        help=(
+            "Store the retrieved submissions column by column, one column per "
+            "question, to reduce memory usage."
+        )
+    )
     parser.add_argument(
         "-q",
         "--quiet",
@@ -104,15 +293,375 @@ def read_form_xls_file(form_source: str) -> etree._ElementTree:  # type: ignore
     return etree.parse(form_source)
 
 
-def main_pipeline_factory(out_dir: str) -> Pipeline[AppData, Any]:
-    config: Mapping[str, Any] = app.config
-    transport = _init_transport_from_config(config)
-    return Pipeline(
-        FetchForms(transport=transport),
-        AppDataToJson(file_path="%s/%s" % (out_dir, "all_forms.json")),
-        FetchSubmissions(transport=transport),
-        AppDataToJson(file_path="%s/%s" % (out_dir, "all_forms_and_subs.json")),
+def main_pipeline_factory(
+        out_dir: str,
+        transport: Transport,
+        incremental: bool = False,
+        state_file: Optional[str] = None,
+        lazy_forms: bool = False,
+        output_format: str = "json",
+        compress: bool = False,
+        normalized: bool = False,
+        threaded: bool = False,
+        form_ids: Optional[Collection[str]] = None,
+        shard: Optional[Shard] = None,
+        hooks: Sequence[PipelineHook] = tuple()
+) -> Pipeline[AppData, Any]:
+    sync_state_store: Optional[SyncStateStore] = SyncStateStore(
+        state_file or os.path.join(out_dir, "sync_state.json")
+    ) if incremental else None
+    # Streamed submissions are written as they are retrieved and are not
+    # retained on the app data.
+    submission_consumers: List[SubmissionConsumer] = []
+    if output_format == "ndjson":
+        submission_consumers.append(
+            NDJSONSink(
+                out_dir,
+                compress=compress,
+                append=incremental,
+                normalized=normalized
+            )
+        )
+    elif output_format == "csv":
+        submission_consumers.append(CSVSink(out_dir, append=incremental))
+    elif output_format == "sqlite":
+        submission_consumers.append(
+            SQLiteSink(os.path.join(out_dir, "submissions.sqlite3"))
+        )
+    elif output_format == "xlsx":
+        submission_consumers.append(
+            XLSXSink(os.path.join(out_dir, "submissions.xlsx"))
+        )
+    fetch_submissions: FetchSubmissions = FetchSubmissions(
+        transport=transport,
+        submission_consumers=submission_consumers,
+        retain_submissions=not submission_consumers,
+        sync_state_store=sync_state_store,
+        threaded=threaded,
+        instance_id_filter=(
+            shard.owns
+            if shard is not None and shard.key == "instance"
+            else None
+        ),
+        hooks=hooks
+    )
+    # Stages are named for the pipeline hooks.
+    tasks: List[Task[Any, Any]] = [
+        Stage(
+            FetchForms(
+                transport=transport,
+                lazy=lazy_forms,
+                form_ids=form_ids,
+                form_filter=(
+                    shard.owns if shard is not None and shard.key == "form"
+                    else None
+                )
+            ),
+            name="fetch_forms"
+        ),
+        Stage(fetch_submissions, name="fetch_submissions")
+    ]
+    # Lazily retrieved form versions are only known once the submissions
+    # referring to them have been retrieved.
+    tasks.insert(
+        len(tasks) if lazy_forms else 1,
+        Stage(
+            AppDataToJson(
+                file_path="%s/%s" % (out_dir, "all_forms.json"),
+                with_submissions=False
+            ),
+            name="write_forms"
+        )
+    )
+    if not submission_consumers:
+        tasks.append(
+            Stage(
+                AppDataToJson(
+                    file_path="%s/%s" % (out_dir, "all_forms_and_subs.json"),
+                    merge_existing=incremental
+                ),
+                name="write_forms_and_submissions"
+            )
+        )
+    # The sync state is only advanced once the submissions are written.
+    if sync_state_store is not None:
+        tasks.append(
+            Stage(SaveSyncState(fetch_submissions), name="save_sync_state")
+        )
+    return Pipeline(*tasks, hooks=hooks)
+
+
+def _write_metrics(
+        metrics_collector: MetricsCollector,
+        http_metrics_registry: HTTPMetricsRegistry,
+        out_dir: str
+) -> None:
+    # The run may have failed before the output directory was created.
+    os.makedirs(out_dir, exist_ok=True)
+    metrics_collector.write_json(
+        os.path.join(out_dir, _METRICS_JSON_FILE_NAME)
+    )
+    metrics_collector.write_prometheus(
+        os.path.join(out_dir, _METRICS_PROMETHEUS_FILE_NAME)
+    )
+    http_metrics_registry.write_json(
+        os.path.join(out_dir, _HTTP_METRICS_JSON_FILE_NAME)
+    )
+    http_metrics_registry.write_prometheus(
+        os.path.join(out_dir, _HTTP_METRICS_PROMETHEUS_FILE_NAME)
+    )
+
+
+def _load_http_metrics(
+        http_metrics_registry: HTTPMetricsRegistry,
+        out_dir: str
+) -> None:
+    file_path: str = os.path.join(out_dir, _HTTP_METRICS_JSON_FILE_NAME)
+    if not os.path.exists(file_path):
+        return
+    with open(file_path, "rb") as metrics_file:
+        http_metrics_registry.add_metrics(json.load(metrics_file))
+
+
+def _print_http_metrics_summary() -> None:
+    summary: str = get_http_metrics_registry().format_summary()
+    if summary:
+        print("HTTP requests by endpoint:\n%s" % summary, file=sys.stderr)
+
+
+def run_main_pipeline(
+        config_file_path: str,
+        out_dir: str,
+        columnar: bool = False,
+        metrics: bool = False,
+        http_metrics_registry: Optional[HTTPMetricsRegistry] = None,
+        **pipeline_kwargs: Any
+) -> Sequence[str]:
+    """
+    Setup the application and run the main pipeline.
+
+    :param config_file_path: The location of the application config file.
+    :param out_dir: The directory to write the outputs to.
+    :param columnar: Whether to store the retrieved submissions column by
+           column.
+    :param metrics: Whether to collect metrics about the run, including
+           about its HTTP requests, and write them to `out_dir`, even when
+           the run fails.
+    :param http_metrics_registry: The registry to record the HTTP requests
+           of the run on. Defaults to the process wide registry.
+    :param pipeline_kwargs: Other keyword arguments of
+           `main_pipeline_factory`.
+
+    :return: The ids of the forms processed.
+    """
+    http_metrics_registry = (
+        http_metrics_registry or get_http_metrics_registry()
+    )
+    app.setup(config_file_path=config_file_path)
+    app_data = AppData(columnar=columnar)
+    metrics_collector: Optional[MetricsCollector] = (
+        MetricsCollector() if metrics else None
     )
+    try:
+        # The transport may authenticate on creation.
+        with _init_transport_from_config(
+                app.config,
+                metrics_registry=http_metrics_registry
+        ) as transport:
+            main_pipeline: Pipeline[AppData, Any] = main_pipeline_factory(
+                out_dir=out_dir,
+                transport=transport,
+                hooks=(metrics_collector,) if metrics_collector else (),
+                **pipeline_kwargs
+            )
+            main_pipeline.execute(app_data)
+    finally:
+        if metrics_collector is not None:
+            _write_metrics(metrics_collector, http_metrics_registry, out_dir)
+    return tuple(app_data.data)
+
+
+def run_main_pipeline_worker(
+        out_dir: str,
+        **pipeline_kwargs: Any
+) -> Sequence[str]:
+    """
+    Run the main pipeline on a worker process started by
+    `run_main_pipeline_workers`.
+
+    A worker process may run more than once, the HTTP requests of each run
+    are recorded on their own registry. The registry is written to `out_dir`
+    for the parent process to merge, even when the run fails.
+
+    :param out_dir: The directory to write the outputs to.
+    :param pipeline_kwargs: Other keyword arguments of `run_main_pipeline`.
+
+    :return: The ids of the forms processed.
+    """
+    http_metrics_registry: HTTPMetricsRegistry = HTTPMetricsRegistry()
+    try:
+        return run_main_pipeline(
+            out_dir=out_dir,
+            http_metrics_registry=http_metrics_registry,
+            **pipeline_kwargs
+        )
+    finally:
+        http_metrics_registry.write_json(
+            os.path.join(out_dir, _HTTP_METRICS_JSON_FILE_NAME)
+        )
+
+
+def _merge_worker_metrics(
+        out_dir: str,
+        worker_dirs: Sequence[str],
+        metrics: bool = False
+) -> None:
+    # Includes the requests made by this process to list the forms.
+    http_metrics_registry: HTTPMetricsRegistry = get_http_metrics_registry()
+    for _worker_dir in worker_dirs:
+        _load_http_metrics(http_metrics_registry, _worker_dir)
+    if not metrics:
+        return
+    metrics_collector: MetricsCollector = MetricsCollector()
+    for _worker_dir in worker_dirs:
+        file_path: str = os.path.join(_worker_dir, _METRICS_JSON_FILE_NAME)
+        if not os.path.exists(file_path):
+            continue
+        with open(file_path, "rb") as metrics_file:
+            metrics_collector.add_metrics(json.load(metrics_file))
+    _write_metrics(metrics_collector, http_metrics_registry, out_dir)
+
+
+def run_main_pipeline_workers(
+        workers: int,
+        config_file_path: str,
+        out_dir: str,
+        incremental: bool = False,
+        state_file: Optional[str] = None,
+        output_format: str = "json",
+        compress: bool = False,
+        columnar: bool = False,
+        metrics: bool = False,
+        shard: Optional[Shard] = None,
+        **pipeline_kwargs: Any
+) -> Sequence[str]:
+    """
+    Split the available forms, or those of the given `shard`, across worker
+    processes, run the main pipeline on each worker for its share of the
+    forms and then merge the outputs of the workers.
+
+    Forms are assigned to the workers round-robin, in the order of their ids.
+    Each worker sets up its own transport and writes its outputs, and its
+    sync state when `incremental` is `True`, to its own directory under
+    `out_dir`. The directories are removed once their outputs have been
+    merged. The HTTP requests of the workers are recorded on the process
+    wide HTTP metrics registry. When `metrics` is `True`, the metrics
+    collected by the workers are also combined and written to `out_dir`.
+
+    :param workers: The number of worker processes to use.
+    :param config_file_path: The location of the application config file.
+    :param out_dir: The directory to write the merged outputs to.
+    :param incremental: Whether to only retrieve the submissions received
+           since the last run and merge them into the existing outputs.
+    :param state_file: The location of the incremental sync state file.
+    :param output_format: The format of the retrieved submissions.
+    :param compress: Whether the streamed submissions are gzip compressed.
+    :param columnar: Whether to store the retrieved submissions column by
+           column.
+    :param metrics: Whether to collect metrics about the run.
+    :param shard: The shard of the forms, or submissions, to process.
+    :param pipeline_kwargs: Other keyword arguments of
+           `main_pipeline_factory`.
+
+    :return: The ids of the forms processed.
+    """
+    assert workers > 0, '"workers" MUST be greater than 0.'
+    assert not (incremental and output_format == "json"), (
+        "Incremental runs of the json format are not supported with workers."
+    )
+    app.setup(config_file_path=config_file_path)
+    with _init_transport_from_config(app.config) as transport:
+        form_ids: Sequence[str] = sorted(
+            _form_id
+            for _form_id in transport.list_form_ids()
+            if shard is None or shard.key != "form" or shard.owns(_form_id)
+        )
+    workers = max(min(workers, len(form_ids)), 1)
+    workers_dir: str = os.path.join(out_dir, _WORKERS_DIR_NAME)
+    worker_dirs: List[str] = [
+        os.path.join(workers_dir, str(_index)) for _index in range(workers)
+    ]
+    state_file = state_file or os.path.join(out_dir, "sync_state.json")
+    worker_state_files: List[str] = [
+        os.path.join(_worker_dir, "sync_state.json")
+        for _worker_dir in worker_dirs
+    ]
+    shutil.rmtree(workers_dir, ignore_errors=True)
+    for _worker_dir, _worker_state_file in zip(
+            worker_dirs,
+            worker_state_files
+    ):
+        os.makedirs(_worker_dir)
+        if incremental and os.path.exists(state_file):
+            shutil.copyfile(state_file, _worker_state_file)
+
+    # Functions of the "__main__" module cannot be looked up by the worker
+    # processes, the pipeline is run through this module's import name.
+    _run_main_pipeline = import_string(
+        "app.__main__.run_main_pipeline_worker"
+    )
+    with ProcessPoolExecutor(
+            max_workers=workers,
+            # Forking a process with running threads is unsafe.
+            mp_context=multiprocessing.get_context("spawn")
+    ) as executor:
+        futures = [
+            executor.submit(
+                _run_main_pipeline,
+                config_file_path=config_file_path,
+                columnar=columnar,
+                metrics=metrics,
+                out_dir=_worker_dir,
+                incremental=incremental,
+                state_file=_worker_state_file,
+                output_format=output_format,
+                compress=compress,
+                form_ids=form_ids[_index::workers],
+                shard=shard,
+                **pipeline_kwargs
+            )
+            for _index, (_worker_dir, _worker_state_file) in enumerate(
+                zip(worker_dirs, worker_state_files)
+            )
+        ]
+        try:
+            # Propagate the first error, if any.
+            for _future in futures:
+                _future.result()
+        finally:
+            _merge_worker_metrics(out_dir, worker_dirs, metrics=metrics)
+
+    merge_outputs(
+        out_dir,
+        worker_dirs,
+        output_format=output_format,
+        compress=compress,
+        append=incremental,
+        overlapping=False,
+        move_files=True
+    )
+
+    # The sync state is only advanced once all the outputs have been merged.
+    if incremental:
+        sync_state_store = SyncStateStore(state_file)
+        for _index, _worker_state_file in enumerate(worker_state_files):
+            sync_state_store.merge(
+                SyncStateStore(_worker_state_file),
+                form_ids=form_ids[_index::workers]
+            )
+        sync_state_store.save()
+    shutil.rmtree(workers_dir, ignore_errors=True)
+    return form_ids
 
 
 # =============================================================================
@@ -122,13 +671,63 @@ def main_pipeline_factory(out_dir: str) -> Pipeline[AppData, Any]:
 def main() -> None:
     parser = argparse_factory()
     args = parser.parse_args()
+    if args.incremental and args.format == "xlsx":
+        parser.error(
+            "-i/--incremental is not supported by the xlsx format, xlsx "
+            "workbooks cannot be appended to."
+        )
+    if args.workers < 1:
+        parser.error("-w/--workers MUST be greater than 0.")
+    if args.workers > 1 and args.incremental and args.format == "json":
+        parser.error(
+            "-i/--incremental is not supported by the json format with more "
+            "than one worker, use a streamed format instead."
+        )
+    shard: Optional[Shard] = None
+    if args.shard is not None:
+        try:
+            shard = Shard.parse(args.shard, key=args.shard_key)
+        except ValueError as exp:
+            parser.error("-s/--shard: %s" % exp)
 
-    app.setup(config_file_path=args.config)
-    app_data = AppData()
-    main_pipeline: Pipeline[AppData, Any] = main_pipeline_factory(
-        out_dir=args.out_dir
-    )
-    main_pipeline.execute(app_data)
+    if args.merge:
+        try:
+            merge_shard_outputs(args.out_dir, args.merge)
+        except RichXFormsSubsError as exp:
+            parser.exit(1, "%s: error: %s\n" % (parser.prog, exp))
+        print("Done...")
+        return
+
+    pipeline_kwargs: Mapping[str, Any] = {
+        "config_file_path": args.config,
+        "columnar": args.columnar,
+        "out_dir": args.out_dir,
+        "incremental": args.incremental,
+        "state_file": args.state_file,
+        "lazy_forms": args.lazy_forms,
+        "output_format": args.format,
+        "compress": args.compress,
+        "normalized": args.normalized,
+        "threaded": args.threaded,
+        "metrics": args.metrics,
+        "shard": shard
+    }
+    try:
+        form_ids: Sequence[str] = (
+            run_main_pipeline_workers(workers=args.workers, **pipeline_kwargs)
+            if args.workers > 1 else run_main_pipeline(**pipeline_kwargs)
+        )
+    finally:
+        _print_http_metrics_summary()
+    if shard is not None:
+        write_shard_manifest(
+            args.out_dir,
+            shard,
+            output_format=args.format,
+            form_ids=form_ids,
+            compress=args.compress,
+            normalized=args.normalized
+        )
     print("Done...")
 
 
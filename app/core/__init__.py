@@ -1,5 +1,5 @@
 from .exceptions import RichXFormsSubsError, TransportError
-from .models import AppData
+from .models import AppData, ColumnarSubmissions
 from .mixins import InitFromMapping, ToJson
 from .task import Task
 from .transport import Transport, TransportOptions
@@ -7,6 +7,7 @@ from .types import (
     InstanceMetadataMapping,
     PrimaryInstanceMapping,
     QuestionMapping,
+    QuestionSchemaMapping,
     SecondaryInstanceItemMapping,
     SecondaryInstanceMapping,
     XFormMapping
@@ -19,12 +20,16 @@ from .xforms_spec import (
     SecondaryInstance,
     SecondaryInstanceDocumentRoot,
     SecondaryInstanceItem,
+    SubmissionDocumentRoot,
+    SubmissionQuestion,
+    SubmissionTemplate,
     XForm
 )
 
 
 __all__ = [
     "AppData",
+    "ColumnarSubmissions",
     "InitFromMapping",
     "InstanceMetadata",
     "InstanceMetadataMapping",
@@ -34,11 +39,15 @@ __all__ = [
     "RichXFormsSubsError",
     "Question",
     "QuestionMapping",
+    "QuestionSchemaMapping",
     "SecondaryInstance",
     "SecondaryInstanceDocumentRoot",
     "SecondaryInstanceItem",
     "SecondaryInstanceItemMapping",
     "SecondaryInstanceMapping",
+    "SubmissionDocumentRoot",
+    "SubmissionQuestion",
+    "SubmissionTemplate",
     "Task",
     "ToJson",
     "Transport",
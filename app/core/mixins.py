@@ -3,6 +3,7 @@ from typing import Any, Mapping
 
 
 class InitFromMapping(metaclass=ABCMeta):
+    __slots__ = ()
 
     @classmethod
     @abstractmethod
@@ -11,6 +12,7 @@ class InitFromMapping(metaclass=ABCMeta):
 
 
 class ToJson(metaclass=ABCMeta):
+    __slots__ = ()
 
     @abstractmethod
     def to_json(self) -> Any:
@@ -1,16 +1,41 @@
-from typing import Any, Dict, List, Mapping, Optional, Tuple, TypedDict
+from threading import RLock
+from types import MappingProxyType
+from typing import (
+    TYPE_CHECKING,
+    Any,
+    Dict,
+    Iterator,
+    List,
+    Mapping,
+    Optional,
+    Sequence,
+    Tuple,
+    TypedDict,
+    Union,
+    overload
+)
 from .exceptions import RichXFormsSubsError
 from .mixins import ToJson
-from .xforms_spec import PrimaryInstanceDocumentRoot, XForm
+from .xforms_spec import (
+    InstanceMetadata,
+    PrimaryInstanceDocumentRoot,
+    SubmissionTemplate,
+    XForm
+)
+if TYPE_CHECKING:
+    import numpy
 
 
 # =============================================================================
 # TYPES
 # =============================================================================
 
+_Submissions = Union[List[PrimaryInstanceDocumentRoot], "ColumnarSubmissions"]
+
+
 class _FormAndSubmissions(TypedDict):
     form: XForm
-    submissions: List[PrimaryInstanceDocumentRoot]
+    submissions: _Submissions
 
 
 _AppData = Dict[str, Dict[str, _FormAndSubmissions]]
@@ -20,53 +45,274 @@ _AppData = Dict[str, Dict[str, _FormAndSubmissions]]
 # APP MODELS
 # =============================================================================
 
+class ColumnarSubmissions(Sequence[PrimaryInstanceDocumentRoot]):
+    """
+    A column oriented store of the submissions of a form version.
+
+    The questions of the form, including sub questions, make up the store's
+    schema with one column per question xpath. Each column is a growable
+    array holding the values of one question across all the submissions on
+    the store. Appending a submission appends one value to each column.
+    Repeated string values, e.g. the answers of select questions, are stored
+    once and shared by all the columns.
+
+    Whole columns can be exported as lists or as NumPy arrays, NumPy being an
+    optional dependency. Submissions are rebuilt from the columns when they
+    are accessed by index or iterated over.
+    """
+
+    def __init__(self, form: XForm):
+        self._form: XForm = form
+        self._template: SubmissionTemplate = form.submission_template
+        self._xpaths: Sequence[str] = self._template.xpaths
+        self._slots: Mapping[str, int] = {
+            _xpath: _slot for _slot, _xpath in enumerate(self._xpaths)
+        }
+        self._columns: Tuple[List[Any], ...] = tuple(
+            [] for _ in self._xpaths
+        )
+        self._instance_ids: List[Optional[str]] = []
+        self._instance_names: List[Optional[str]] = []
+        self._strings: Dict[str, str] = dict()
+
+    @property
+    def form(self) -> XForm:
+        return self._form
+
+    @property
+    def xpaths(self) -> Sequence[str]:
+        """The xpath of each question of the form, in column order."""
+        return self._xpaths
+
+    @property
+    def instance_ids(self) -> List[Optional[str]]:
+        """The instance ids of the submissions, in insertion order."""
+        return list(self._instance_ids)
+
+    def append(self, submission: PrimaryInstanceDocumentRoot) -> None:
+        """Add a submission of this store's form version to the store.
+
+        :param submission: The submission to add.
+        """
+        values: List[Any] = self._template.get_values(submission)
+        strings: Dict[str, str] = self._strings
+        for _column, _value in zip(self._columns, values):
+            if _value.__class__ is str:
+                _value = strings.setdefault(_value, _value)
+            _column.append(_value)
+        self._instance_ids.append(submission.meta.instance_id)
+        self._instance_names.append(submission.meta.instance_name)
+
+    def column(self, xpath: str) -> List[Any]:
+        """Return the values of a question across all the submissions.
+
+        :param xpath: The xpath of the question whose values to return.
+
+        :return: A list of the question's values, in insertion order.
+
+        :raise KeyError: If the form has no question with the given xpath.
+        """
+        return list(self._columns[self._slots[xpath]])
+
+    def to_numpy(self, xpath: str, dtype: Any = None) -> "numpy.ndarray":
+        """Return the values of a question as a NumPy array.
+
+        :param xpath: The xpath of the question whose values to return.
+        :param dtype: An optional NumPy data type of the returned array. When
+               not given, NumPy infers the data type from the values.
+
+        :return: A NumPy array of the question's values, in insertion order.
+
+        :raise KeyError: If the form has no question with the given xpath.
+        :raise RichXFormsSubsError: If NumPy is not installed.
+        """
+        try:
+            import numpy
+        except ImportError as exp:
+            raise RichXFormsSubsError(
+                'NumPy is required to export columns as arrays, install it '
+                'with "pip install numpy".'
+            ) from exp
+        return numpy.asarray(self._columns[self._slots[xpath]], dtype=dtype)
+
+    @overload
+    def __getitem__(self, index: int) -> PrimaryInstanceDocumentRoot:
+        ...
+
+    @overload
+    def __getitem__(
+            self,
+            index: slice
+    ) -> Sequence[PrimaryInstanceDocumentRoot]:
+        ...
+
+    def __getitem__(
+            self,
+            index: Union[int, slice]
+    ) -> Union[
+        PrimaryInstanceDocumentRoot,
+        Sequence[PrimaryInstanceDocumentRoot]
+    ]:
+        if isinstance(index, slice):
+            return tuple(
+                self[_index] for _index in range(*index.indices(len(self)))
+            )
+        submission = self._template.create_submission()
+        submission.set_values([_column[index] for _column in self._columns])
+        submission.meta = InstanceMetadata(
+            instance_id=self._instance_ids[index],
+            instance_name=self._instance_names[index]
+        )
+        return submission
+
+    def __iter__(self) -> Iterator[PrimaryInstanceDocumentRoot]:
+        for _index in range(len(self)):
+            yield self[_index]
+
+    def __len__(self) -> int:
+        return len(self._instance_ids)
+
+
 class AppData(ToJson):
+    """
+    The forms and submissions processed by the app.
+
+    When `columnar` is `True`, the submissions of each form version are kept
+    on a `ColumnarSubmissions` store instead of a list of submissions.
 
-    def __init__(self):
+    Secondary indexes of the form versions, of the submissions by instance
+    id and of the number of submissions of each form are maintained as forms
+    and submissions are added, making lookups constant time. A submission
+    whose instance id is already present is not added a second time.
+    """
+
+    def __init__(self, columnar: bool = False):
         self._data: _AppData = dict()
+        self._columnar: bool = columnar
+        self._lock: RLock = RLock()
+        # The forms of each form's versions keyed by form id, then version.
+        self._form_versions: Dict[str, Dict[str, XForm]] = dict()
+        self._entries: Dict[Tuple[str, str], _FormAndSubmissions] = dict()
+        # The form id, version and index of each submission, keyed by the
+        # submission's instance id.
+        self._submissions_index: Dict[str, Tuple[str, str, int]] = dict()
+        self._submissions_counts: Dict[str, int] = dict()
 
     @property
-    def data(self) -> _AppData:
-        # Return a copy of the current data
-        return dict(self._data)
+    def data(self) -> Mapping[str, Dict[str, _FormAndSubmissions]]:
+        # Return a read-only view of the current data
+        return MappingProxyType(self._data)
 
     def add_form(self, form: XForm) -> None:
-        form_versions: Dict[str, _FormAndSubmissions] = self._data.setdefault(
-            form.id, dict()
-        )
-        form_versions[form.version] = {"form": form, "submissions": []}
+        with self._lock:
+            self.add_form_id(form.id)
+            entry_key: Tuple[str, str] = (form.id, form.version)
+            replaced_entry: Optional[_FormAndSubmissions] = self._entries.get(
+                entry_key
+            )
+            if replaced_entry is not None:
+                self._unindex_submissions(form.id, replaced_entry)
+            entry: _FormAndSubmissions = {
+                "form": form,
+                "submissions": (
+                    ColumnarSubmissions(form) if self._columnar else []
+                )
+            }
+            self._data[form.id][form.version] = entry
+            self._form_versions[form.id][form.version] = form
+            self._entries[entry_key] = entry
+
+    def add_form_id(self, form_id: str) -> None:
+        """Add a form whose versions are yet to be added to the app data.
+
+        :param form_id: The id of the form to add.
+        """
+        with self._lock:
+            self._data.setdefault(form_id, dict())
+            self._form_versions.setdefault(form_id, dict())
+            self._submissions_counts.setdefault(form_id, 0)
 
     def add_form_submission(
             self,
             form_id: str,
             form_version: str,
             submission: PrimaryInstanceDocumentRoot
-    ) -> None:
-        try:
-            self._data[form_id][form_version]["submissions"].append(submission)
-        except KeyError as exp:
-            raise RichXFormsSubsError(
-                'A form with id="%s" or version="%s" was not found on the app.'
-                % (form_id, form_version)
-            ) from exp
+    ) -> bool:
+        """Add a submission of a form version.
+
+        :param form_id: The id of the submission's form.
+        :param form_version: The version of the submission's form.
+        :param submission: The submission to add.
+
+        :return: `True` if the submission was added or `False` if a
+                 submission with the same instance id is already present.
+
+        :raise RichXFormsSubsError: If the form version is not present.
+        """
+        with self._lock:
+            entry: Optional[_FormAndSubmissions] = self._entries.get(
+                (form_id, form_version)
+            )
+            if entry is None:
+                raise RichXFormsSubsError(
+                    'A form with id="%s" or version="%s" was not found on the '
+                    "app." % (form_id, form_version)
+                )
+            instance_id: Optional[str] = submission.meta.instance_id
+            if instance_id and instance_id in self._submissions_index:
+                return False
+            if instance_id:
+                self._submissions_index[instance_id] = (
+                    form_id,
+                    form_version,
+                    len(entry["submissions"])
+                )
+            entry["submissions"].append(submission)
+            self._submissions_counts[form_id] += 1
+            return True
 
     def get_all_form_versions(self, form_id: str) -> Mapping[str, XForm]:
-        form_versions: Dict[str, _FormAndSubmissions] = self._data.setdefault(
-            form_id, dict()
+        return MappingProxyType(self._form_versions.get(form_id, dict()))
+
+    def get_form(self, form_id: str, version: str) -> Optional[XForm]:
+        entry: Optional[_FormAndSubmissions] = self._entries.get(
+            (form_id, version)
         )
-        _entry: Tuple[str, _FormAndSubmissions]
-        return dict(
-            map(
-                lambda _entry: (_entry[0], _entry[1]["form"]),
-                form_versions.items()
-            )
+        return entry["form"] if entry is not None else None
+
+    def get_submission(
+            self,
+            instance_id: str
+    ) -> Optional[PrimaryInstanceDocumentRoot]:
+        location: Optional[Tuple[str, str, int]] = self._submissions_index.get(
+            instance_id
         )
+        if location is None:
+            return None
+        form_id, version, index = location
+        return self._entries[(form_id, version)]["submissions"][index]
 
-    def get_form(self, form_id: str, version: str) -> Optional[XForm]:
-        form_versions: Dict[str, _FormAndSubmissions] = self._data.get(
-            form_id, dict()
+    def get_submissions_count(self, form_id: str) -> int:
+        return self._submissions_counts.get(form_id, 0)
+
+    def has_submission(self, instance_id: str) -> bool:
+        return instance_id in self._submissions_index
+
+    def _unindex_submissions(
+            self,
+            form_id: str,
+            entry: _FormAndSubmissions
+    ) -> None:
+        submissions: _Submissions = entry["submissions"]
+        instance_ids: Sequence[Optional[str]] = (
+            submissions.instance_ids
+            if isinstance(submissions, ColumnarSubmissions) else
+            tuple(_sub.meta.instance_id for _sub in submissions)
         )
-        return form_versions.get(version, dict()).get("form", None)
+        for _instance_id in instance_ids:
+            if _instance_id:
+                self._submissions_index.pop(_instance_id, None)
+        self._submissions_counts[form_id] -= len(submissions)
 
     def to_json(self) -> Any:
         def _form_and_subs_to_json(form_and_subs: _FormAndSubmissions) -> Any:
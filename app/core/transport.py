@@ -1,5 +1,5 @@
 from abc import ABCMeta, abstractmethod
-from typing import Any, Callable, Mapping, Optional, Sequence
+from typing import Any, Callable, Iterator, Mapping, Optional, Sequence
 
 from .xforms_spec import PrimaryInstanceDocumentRoot, XForm
 
@@ -12,8 +12,23 @@ class Transport(metaclass=ABCMeta):
 
     Data in this context refers to forms and form submissions for the most part
     and data source can be anything that contains forms or submissions.
+
+    Transports are context managers, exiting a transport closes it.
     """
 
+    def __enter__(self) -> "Transport":
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+    def close(self) -> None:
+        """Release the resources held by this transport.
+
+        The transport should not be used once closed. Does nothing by default.
+        """
+        ...
+
     @abstractmethod
     def flush(
             self,
@@ -45,6 +60,18 @@ class Transport(metaclass=ABCMeta):
     def list_forms(self, **options: TransportOptions) -> Sequence[XForm]:
         ...
 
+    @abstractmethod
+    def list_form_ids(self, **options: TransportOptions) -> Sequence[str]:
+        """Retrieve the ids of all the available forms.
+
+        Unlike `list_forms`, the versions of each form are not retrieved.
+
+        :param options: Optional, implementation specific options.
+
+        :return: The ids of all the available forms.
+        """
+        ...
+
     # SUBMISSION RETRIEVAL
     # -------------------------------------------------------------------------
     @abstractmethod
@@ -57,6 +84,28 @@ class Transport(metaclass=ABCMeta):
     ) -> PrimaryInstanceDocumentRoot:
         ...
 
+    @abstractmethod
+    def iter_form_submissions(
+            self,
+            form_id: str,
+            form_versions: Mapping[str, XForm],
+            **options: TransportOptions
+    ) -> Iterator[PrimaryInstanceDocumentRoot]:
+        """Lazily retrieve all the submissions of the given form.
+
+        Each submission is yielded as soon as it is available, allowing the
+        caller to process the submissions one at a time without holding all
+        of them in memory.
+
+        :param form_id: The id of the form whose submissions to retrieve.
+        :param form_versions: A mapping of all the known versions of the form
+               keyed by their version.
+        :param options: Optional, implementation specific options.
+
+        :return: An iterator of the given form's submissions.
+        """
+        ...
+
     @abstractmethod
     def list_form_submissions(
             self,
@@ -58,6 +58,20 @@ class QuestionMapping(TypedDict):
     value: Optional[Any]
 
 
+class QuestionSchemaMapping(TypedDict):
+    # The question's slot on its form version's submission template.
+    index: int
+    # The slot of the question's parent or None for top level questions.
+    parent: Optional[int]
+    name: str
+    question_type: str
+    read_only: bool
+    xpath: str
+    label: Optional[str]
+    required: Optional[bool]
+    tag: Optional[str]
+
+
 class SecondaryInstanceItemMapping(TypedDict):
     name: str
     label: str
@@ -3,16 +3,16 @@ ODK XForms Specification Models.
 https://getodk.github.io/xforms-spec
 """
 from abc import ABCMeta
-from functools import cache
 from typing import (
+    TYPE_CHECKING,
     Any,
+    Callable,
     Dict,
+    List,
     Mapping,
     Optional,
     Sequence,
-    Tuple,
-    Type,
-    TypeVar
+    Tuple
 )
 
 from typing_inspect import is_optional_type
@@ -22,72 +22,129 @@ from .types import (
     InstanceMetadataMapping,
     PrimaryInstanceMapping,
     QuestionMapping,
+    QuestionSchemaMapping,
     SecondaryInstanceItemMapping,
     SecondaryInstanceMapping,
     XFormMapping
 )
 
 # =============================================================================
-# TYPES
+# CONSTANTS
 # =============================================================================
 
-_SE = TypeVar("_SE", bound="AbstractXFormsItem")
+# The default value of the required parameters of the generated initializers.
+_MISSING: Any = object()
 
 
 # =============================================================================
 # HELPERS
 # =============================================================================
 
-@cache
-def _get_available_annotations(
-        xforms_spec_type: Type[_SE]
-) -> Mapping[str, Any]:
-    return {
-        field_name: field_type
-        for klass in filter(
-            lambda _klass: hasattr(_klass, "__annotations__"),
-            xforms_spec_type.mro()
-        )
-        for field_name, field_type in klass.__annotations__.items()
-    }
+def _make_init(fields: Mapping[str, Any]) -> Callable[..., None]:
+    """
+    Generate an initializer that assigns each of the given fields from a
+    keyword argument of the same name.
+
+    Fields whose types are not optional are required. A `ValueError` is
+    raised when any of them is missing. Optional fields default to `None`
+    and unknown keyword arguments are ignored.
 
+    :param fields: The types of the fields to initialize keyed by the
+           fields names.
 
-@cache
-def _get_required_fields_names(xforms_spec_type: Type[_SE]) -> Sequence[str]:
-    available_annotations: Mapping[str, Any] = _get_available_annotations(
-        xforms_spec_type
+    :return: The generated initializer.
+    """
+    required_fields: Sequence[str] = tuple(
+        _field_name
+        for _field_name, _field_type in fields.items()
+        if not is_optional_type(_field_type)
+    )
+    parameters: str = "".join(
+        "%s=%s, " % (
+            _field_name,
+            "_MISSING" if _field_name in required_fields else "None"
+        )
+        for _field_name in fields
     )
-    return tuple(
-        field_name
-        for field_name, field_type in available_annotations.items()
-        if not is_optional_type(field_type)
+    lines: List[str] = [
+        "def __init__(self, %s**_ignored):" % (
+            "*, %s" % parameters if parameters else ""
+        )
+    ]
+    if required_fields:
+        lines.append("    if %s:" % " or ".join(
+            "%s is _MISSING" % _field_name for _field_name in required_fields
+        ))
+        lines.append("        raise ValueError(%r)" % (
+            "The following values are required: %s"
+            % ", ".join(required_fields)
+        ))
+    lines.extend(
+        "    self.%s = %s" % (_field_name, _field_name)
+        for _field_name in fields
     )
+    if not fields:
+        lines.append("    pass")
+    namespace: Dict[str, Any] = {"_MISSING": _MISSING}
+    exec("\n".join(lines), namespace)
+    return namespace["__init__"]
+
+
+class _XFormsItemMeta(ABCMeta):
+    """
+    Give each XForms item class slotted storage for its annotated fields and
+    a generated initializer.
+
+    Each class only adds slots for the fields it introduces, the fields of
+    its bases are stored on the bases slots. Names listed on a class's own
+    `__slots__` are kept. An initializer is only generated for classes that
+    don't define their own.
+    """
+
+    def __new__(
+            mcs,
+            name: str,
+            bases: Tuple[type, ...],
+            namespace: Dict[str, Any],
+            **kwargs
+    ):
+        inherited_fields: Dict[str, Any] = dict()
+        for _base in reversed(bases):
+            inherited_fields.update(getattr(_base, "_xforms_fields", dict()))
+        own_fields: Mapping[str, Any] = namespace.get("__annotations__", {})
+        namespace["__slots__"] = tuple(namespace.get("__slots__", ())) + tuple(
+            _field_name
+            for _field_name in own_fields
+            if _field_name not in inherited_fields
+        )
+        namespace["_xforms_fields"] = {**inherited_fields, **own_fields}
+        if "__init__" not in namespace:
+            namespace["__init__"] = _make_init(namespace["_xforms_fields"])
+        return super().__new__(mcs, name, bases, namespace, **kwargs)
 
 
 # =============================================================================
 # XFORM ELEMENTS DEFINITIONS
 # =============================================================================
 
-class AbstractXFormsItem(InitFromMapping, ToJson, metaclass=ABCMeta):
+class AbstractXFormsItem(InitFromMapping, ToJson, metaclass=_XFormsItemMeta):
+    """
+    An XForms item.
 
-    def __init__(self, required_fields: Sequence[str], **kwargs):
-        if any(set(required_fields).difference(set(kwargs.keys()))):
-            raise ValueError(
-                "The following values are required: %s" % ", ".join(
-                    required_fields
-                )
-            )
+    The annotated fields of each subclass are stored on slots and are
+    initialized from keyword arguments of the same name.
+    """
 
-        for valid_field in _get_available_annotations(self.__class__).keys():
-            setattr(self, valid_field, kwargs.get(valid_field))
+    if TYPE_CHECKING:
+        # Declares the initializers generated by `_XFormsItemMeta` to type
+        # checkers.
+        def __init__(self, **kwargs: Any) -> None:
+            ...
 
 
 class XFormsNode(AbstractXFormsItem, metaclass=ABCMeta):
     """A node in an XLSForms Item."""
 
-    def __init__(self, **kwargs):
-        super().__init__(_get_required_fields_names(self.__class__), **kwargs)
-
 
 class InstanceMetadata(XFormsNode):
     """Instance metadata"""
@@ -278,6 +335,8 @@ class SecondaryInstance(XFormsNode):
 
 
 class XForm(AbstractXFormsItem):
+    __slots__ = ("_submission_template", "__weakref__")
+
     title: str
     primary_instance: PrimaryInstance
     secondary_instances: Mapping[str, SecondaryInstance]
@@ -291,11 +350,19 @@ class XForm(AbstractXFormsItem):
     def version(self) -> str:
         return self.primary_instance.document_root.version
 
+    @property
+    def submission_template(self) -> "SubmissionTemplate":
+        """The template shared by all the submissions of this form."""
+        try:
+            return self._submission_template
+        except AttributeError:
+            self._submission_template = SubmissionTemplate(
+                self.primary_instance.document_root
+            )
+            return self._submission_template
+
     def create_form_submission_template(self) -> PrimaryInstanceDocumentRoot:
-        # Create a copy of this form's primary instance document root.
-        return PrimaryInstanceDocumentRoot.of_mapping(
-            self.primary_instance.document_root.to_json()
-        )
+        return self.submission_template.create_submission()
 
     def to_json(self) -> XFormMapping:
         _entry: Tuple[str, SecondaryInstance]
@@ -330,5 +397,320 @@ class XForm(AbstractXFormsItem):
         }
         return cls(**_copy)
 
-    def __init__(self, **kwargs):
-        super().__init__(_get_required_fields_names(self.__class__), **kwargs)
+
+# =============================================================================
+# SUBMISSION TEMPLATES
+# =============================================================================
+
+class SubmissionTemplate:
+    """
+    The structure shared by all the submissions of a form version.
+
+    Each question of the form's primary instance, including sub questions,
+    is assigned a slot in depth first order. Submissions created from a
+    template share the template's questions metadata, i.e. names, labels,
+    types, etc, and only hold a list of their question values indexed by
+    slot.
+    """
+
+    def __init__(self, document_root: PrimaryInstanceDocumentRoot):
+        self._document_root: PrimaryInstanceDocumentRoot = document_root
+        self._questions: List[Question] = []
+        # The slots of the sub questions of each question keyed by the sub
+        # questions names, indexed by the question's slot.
+        self._sub_slots: List[Mapping[str, int]] = []
+        self._root_slots: Mapping[str, int] = self._assign_slots(
+            document_root.questions
+        )
+        self._default_values: Tuple[Any, ...] = tuple(
+            _question.value for _question in self._questions
+        )
+
+    @property
+    def document_root(self) -> PrimaryInstanceDocumentRoot:
+        return self._document_root
+
+    @property
+    def slots_count(self) -> int:
+        return len(self._questions)
+
+    @property
+    def questions(self) -> Sequence[Question]:
+        """The question on each slot."""
+        return tuple(self._questions)
+
+    @property
+    def xpaths(self) -> Sequence[str]:
+        """The xpath of the question on each slot."""
+        return tuple(_question.xpath for _question in self._questions)
+
+    def create_submission(self) -> "SubmissionDocumentRoot":
+        return SubmissionDocumentRoot(self, list(self._default_values))
+
+    def to_schema(self) -> List[QuestionSchemaMapping]:
+        """Return the metadata of each question of the form in slot order.
+
+        Together with the values of a submission, as returned by
+        `get_values`, the schema holds everything needed to rebuild the
+        submission's questions.
+
+        :return: The metadata of each question, including sub questions.
+        """
+        parents: List[Optional[int]] = [None] * len(self._questions)
+        for _slot, _sub_slots in enumerate(self._sub_slots):
+            for _sub_slot in _sub_slots.values():
+                parents[_sub_slot] = _slot
+        return [
+            {
+                "index": _slot,
+                "parent": parents[_slot],
+                "name": _question.name,
+                "question_type": _question.question_type,
+                "read_only": _question.read_only,
+                "xpath": _question.xpath,
+                "label": _question.label,
+                "required": _question.required,
+                "tag": _question.tag
+            }
+            for _slot, _question in enumerate(self._questions)
+        ]
+
+    def get_values(self, submission: PrimaryInstanceDocumentRoot) -> List[Any]:
+        """Return the question values of a submission in slot order.
+
+        :param submission: A submission of this template's form version.
+               Questions missing from the submission have no value.
+
+        :return: The value of each question of the submission.
+        """
+        if isinstance(submission, SubmissionDocumentRoot) and (
+                submission.template is self
+        ):
+            return list(submission.values)
+        values: List[Any] = [None] * len(self._questions)
+        self._collect_values(self._root_slots, submission.questions, values)
+        return values
+
+    def create_question_views(
+            self,
+            values: List[Any]
+    ) -> Dict[str, "SubmissionQuestion"]:
+        return self._create_question_views(self._root_slots, values)
+
+    def questions_to_json(
+            self,
+            values: Sequence[Any]
+    ) -> Dict[str, QuestionMapping]:
+        return self._questions_to_json(self._root_slots, values)
+
+    def _assign_slots(
+            self,
+            questions: Mapping[str, Question]
+    ) -> Mapping[str, int]:
+        slots: Dict[str, int] = dict()
+        for _question in questions.values():
+            slot: int = len(self._questions)
+            slots[_question.name] = slot
+            self._questions.append(_question)
+            self._sub_slots.append(dict())
+            if _question.sub_questions:
+                self._sub_slots[slot] = self._assign_slots(
+                    _question.sub_questions
+                )
+        return slots
+
+    def _collect_values(
+            self,
+            slots: Mapping[str, int],
+            questions: Mapping[str, Question],
+            values: List[Any]
+    ) -> None:
+        for _name, _slot in slots.items():
+            _question: Optional[Question] = questions.get(_name)
+            if _question is None:
+                continue
+            values[_slot] = _question.value
+            if self._sub_slots[_slot] and _question.sub_questions:
+                self._collect_values(
+                    self._sub_slots[_slot],
+                    _question.sub_questions,
+                    values
+                )
+
+    def _create_question_views(
+            self,
+            slots: Mapping[str, int],
+            values: List[Any]
+    ) -> Dict[str, "SubmissionQuestion"]:
+        return {
+            _name: SubmissionQuestion(
+                self._questions[_slot],
+                values,
+                _slot,
+                self._create_question_views(self._sub_slots[_slot], values)
+                if self._sub_slots[_slot] else None
+            )
+            for _name, _slot in slots.items()
+        }
+
+    def _questions_to_json(
+            self,
+            slots: Mapping[str, int],
+            values: Sequence[Any]
+    ) -> Dict[str, QuestionMapping]:
+        mappings: Dict[str, QuestionMapping] = dict()
+        for _name, _slot in slots.items():
+            _question: Question = self._questions[_slot]
+            _sub_slots: Mapping[str, int] = self._sub_slots[_slot]
+            mappings[_name] = {
+                "name": _question.name,
+                "question_type": _question.question_type,
+                "read_only": _question.read_only,
+                "xpath": _question.xpath,
+                "label": _question.label,
+                "required": _question.required,
+                "tag": _question.tag,
+                "sub_questions": self._questions_to_json(
+                    _sub_slots,
+                    values
+                ) if _sub_slots else None,
+                "value": values[_slot]
+            }
+        return mappings
+
+
+class SubmissionQuestion(Question):
+    """
+    A question of a submission created from a submission template.
+
+    The question's metadata is read from the template's question while the
+    question's value is stored on the submission's values.
+    """
+    __slots__ = ("_question", "_values", "_slot", "_sub_questions")
+
+    def __init__(
+            self,
+            question: Question,
+            values: List[Any],
+            slot: int,
+            sub_questions: Optional[Mapping[str, "SubmissionQuestion"]]
+    ):
+        # The reflective initializer is skipped, nothing is copied from the
+        # template's question.
+        self._question: Question = question
+        self._values: List[Any] = values
+        self._slot: int = slot
+        self._sub_questions: Optional[Mapping[str, SubmissionQuestion]]
+        self._sub_questions = sub_questions
+
+    @property  # type: ignore
+    def name(self) -> str:
+        return self._question.name
+
+    @property  # type: ignore
+    def question_type(self) -> str:
+        return self._question.question_type
+
+    @property  # type: ignore
+    def read_only(self) -> bool:
+        return self._question.read_only
+
+    @property  # type: ignore
+    def xpath(self) -> str:
+        return self._question.xpath
+
+    @property  # type: ignore
+    def label(self) -> Optional[str]:
+        return self._question.label
+
+    @property  # type: ignore
+    def required(self) -> Optional[bool]:
+        return self._question.required
+
+    @property  # type: ignore
+    def tag(self) -> Optional[str]:
+        return self._question.tag
+
+    @property  # type: ignore
+    def sub_questions(self) -> Optional[Mapping[str, "SubmissionQuestion"]]:
+        return self._sub_questions
+
+    @property  # type: ignore
+    def value(self) -> Optional[Any]:
+        return self._values[self._slot]
+
+    @value.setter
+    def value(self, value: Optional[Any]) -> None:
+        self._values[self._slot] = value
+
+
+class SubmissionDocumentRoot(PrimaryInstanceDocumentRoot):
+    """
+    The document root of a submission created from a submission template.
+
+    Only the submission's question values, indexed by their template slots,
+    are allocated per submission. The submission's questions are created on
+    first access as views over these values.
+    """
+    __slots__ = ("_template", "_values", "_questions")
+
+    def __init__(self, template: SubmissionTemplate, values: List[Any]):
+        # The reflective initializer is skipped, the template's questions
+        # are shared instead of being copied.
+        document_root: PrimaryInstanceDocumentRoot = template.document_root
+        self.id = document_root.id
+        self.version = document_root.version
+        # Shared until replaced by the submission's own metadata.
+        self.meta = document_root.meta
+        self.prefix = None
+        self.delimiter = None
+        self._template: SubmissionTemplate = template
+        self._values: List[Any] = values
+        self._questions: Optional[Mapping[str, SubmissionQuestion]] = None
+
+    @property
+    def template(self) -> SubmissionTemplate:
+        return self._template
+
+    @property
+    def values(self) -> Sequence[Any]:
+        """The value of each question, in the template's slot order."""
+        return self._values
+
+    @property  # type: ignore
+    def questions(self) -> Mapping[str, SubmissionQuestion]:
+        if self._questions is None:
+            self._questions = self._template.create_question_views(
+                self._values
+            )
+        return self._questions
+
+    def set_values(self, values: Sequence[Any]) -> None:
+        """Set the values of all the questions of this submission at once.
+
+        :param values: The value of each question, including sub questions,
+               in the template's slot order.
+        """
+        assert len(values) == len(self._values), (
+            "Expected %d values but got %d."
+            % (len(self._values), len(values))
+        )
+        self._values[:] = values
+
+    def to_json(self) -> PrimaryInstanceMapping:
+        return {
+            "id": self.id,
+            "version": self.version,
+            "questions": self._template.questions_to_json(self._values),
+            "meta": self.meta.to_json(),
+            "prefix": None,
+            "delimiter": None
+        }
+
+    @classmethod
+    def of_mapping(
+            cls,
+            mapping: PrimaryInstanceMapping
+    ) -> PrimaryInstanceDocumentRoot:
+        # Submissions loaded from a mapping don't have a template.
+        return PrimaryInstanceDocumentRoot.of_mapping(mapping)
@@ -1,3 +1,13 @@
+from .cache import *
+from .cache import __all__ as _all_cache
+from .metrics import *
+from .metrics import __all__ as _all_metrics
+from .sharding import *
+from .sharding import __all__ as _all_sharding
+from .sinks import *
+from .sinks import __all__ as _all_sinks
+from .state import *
+from .state import __all__ as _all_state
 from .tasks import *
 from .tasks import __all__ as _all_tasks
 from .transports import *
@@ -6,5 +16,10 @@ from .transports import __all__ as _all_transports
 
 __all__ = []
 
+__all__ += _all_cache  # type: ignore
+__all__ += _all_metrics  # type: ignore
+__all__ += _all_sharding  # type: ignore
+__all__ += _all_sinks  # type: ignore
+__all__ += _all_state  # type: ignore
 __all__ += _all_tasks  # type: ignore
 __all__ += _all_transports  # type: ignore
@@ -0,0 +1,6 @@
+from .form_cache import FormCache
+
+
+__all__ = [
+    "FormCache"
+]
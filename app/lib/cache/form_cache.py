@@ -0,0 +1,183 @@
+import hashlib
+import logging
+import os
+import pickle
+from threading import Lock
+from typing import Dict, List, Optional, Tuple, TypedDict
+
+from app.core import XForm, XFormMapping
+from app.utils import ensure_not_none_nor_empty
+
+# =============================================================================
+# TYPES
+# =============================================================================
+
+class _FormCacheEntry(TypedDict):
+    form_id: str
+    version: str
+    content_hash: str
+    form: XFormMapping
+
+
+# =============================================================================
+# CONSTANTS
+# =============================================================================
+
+LOGGER = logging.getLogger(__name__)
+
+_DEFAULT_MAX_SIZE: int = 100 * 1024 * 1024  # 100 MB
+
+_ENTRY_FILE_EXTENSION: str = ".pickle"
+
+
+# =============================================================================
+# FORM CACHE
+# =============================================================================
+
+class FormCache:
+    """
+    A persistent, on-disk cache of parsed forms keyed by the form's id and
+    version.
+
+    Published form versions are immutable, so a cached form is served without
+    a network call or an xml parse. Each entry also records a hash of the
+    form's definition. When a hash is given on lookup, the entry is only
+    served if its recorded hash matches the given hash.
+
+    Entries are stored as pickled `XFormMapping`s, one file per entry, on the
+    given directory. The total size of the entries is kept under `max_size`
+    bytes by evicting the least recently used entries.
+    """
+
+    def __init__(self, directory: str, max_size: Optional[int] = None):
+        self._directory: str = ensure_not_none_nor_empty(
+            directory,
+            message='"directory" MUST be provided.'
+        )
+        self._max_size: int = max_size or _DEFAULT_MAX_SIZE
+        assert self._max_size > 0, '"max_size" MUST be greater than 0.'
+        self._lock: Lock = Lock()
+        os.makedirs(self._directory, exist_ok=True)
+        # Sizes of the entries on disk keyed by their file paths.
+        self._entry_sizes: Dict[str, int] = dict()
+        for _entry in os.scandir(self._directory):
+            if not _entry.name.endswith(_ENTRY_FILE_EXTENSION):
+                continue
+            try:
+                self._entry_sizes[_entry.path] = _entry.stat().st_size
+            except FileNotFoundError:
+                # Evicted by another process sharing the directory.
+                continue
+
+    @property
+    def size(self) -> int:
+        """The total size in bytes of all the entries on this cache."""
+        return sum(self._entry_sizes.values())
+
+    def get(
+            self,
+            form_id: str,
+            version: str,
+            content_hash: Optional[str] = None
+    ) -> Optional[XForm]:
+        """Return a cached form or `None` if it isn't cached.
+
+        :param form_id: The id of the form to return.
+        :param version: The version of the form to return.
+        :param content_hash: An optional hash of the form's definition. If
+               given, the cached form is only returned if it was cached with
+               the same hash.
+
+        :return: The cached form or `None` if there was no matching entry.
+        """
+        entry_path: str = self._entry_path(form_id, version)
+        with self._lock:
+            if entry_path not in self._entry_sizes:
+                return None
+            try:
+                with open(entry_path, "rb") as entry_file:
+                    entry: _FormCacheEntry = pickle.load(entry_file)
+                # Mark the entry as recently used.
+                os.utime(entry_path)
+            except (OSError, pickle.UnpicklingError, EOFError):
+                LOGGER.warning(
+                    'Discarding unreadable form cache entry "%s"',
+                    entry_path,
+                    exc_info=True
+                )
+                self._remove_entry(entry_path)
+                return None
+
+        if content_hash is not None and entry["content_hash"] != content_hash:
+            LOGGER.debug(
+                'Stale form cache entry for form with id="%s" and '
+                'version="%s"',
+                form_id,
+                version
+            )
+            return None
+        LOGGER.debug(
+            'Form cache hit for form with id="%s" and version="%s"',
+            form_id,
+            version
+        )
+        return XForm.of_mapping(entry["form"])
+
+    def put(self, form: XForm, content_hash: str) -> None:
+        """Add a form to this cache, replacing any existing entry.
+
+        :param form: The form to cache.
+        :param content_hash: A hash of the form's definition.
+        """
+        entry: _FormCacheEntry = {
+            "form_id": form.id,
+            "version": form.version,
+            "content_hash": content_hash,
+            "form": form.to_json()
+        }
+        entry_path: str = self._entry_path(form.id, form.version)
+        entry_data: bytes = pickle.dumps(
+            entry,
+            protocol=pickle.HIGHEST_PROTOCOL
+        )
+        with self._lock:
+            temp_entry_path: str = "%s.tmp" % entry_path
+            with open(temp_entry_path, "wb") as entry_file:
+                entry_file.write(entry_data)
+            os.replace(temp_entry_path, entry_path)
+            self._entry_sizes[entry_path] = len(entry_data)
+            self._evict()
+
+    def _entry_path(self, form_id: str, version: str) -> str:
+        key: str = hashlib.sha1(
+            ("%s\0%s" % (form_id, version)).encode("utf-8")
+        ).hexdigest()
+        return os.path.join(self._directory, key + _ENTRY_FILE_EXTENSION)
+
+    def _evict(self) -> None:
+        total_size: int = sum(self._entry_sizes.values())
+        if total_size <= self._max_size:
+            return
+        # Evict the least recently used entries first.
+        entries: List[Tuple[float, str]] = []
+        for _entry_path in tuple(self._entry_sizes):
+            try:
+                entries.append((os.stat(_entry_path).st_mtime, _entry_path))
+            except FileNotFoundError:
+                # Evicted by another process sharing the directory, e.g.
+                # another worker or shard.
+                total_size -= self._entry_sizes.pop(_entry_path)
+        entries.sort()
+        for _, _entry_path in entries:
+            if total_size <= self._max_size:
+                break
+            total_size -= self._entry_sizes[_entry_path]
+            LOGGER.debug('Evicting form cache entry "%s"', _entry_path)
+            self._remove_entry(_entry_path)
+
+    def _remove_entry(self, entry_path: str) -> None:
+        self._entry_sizes.pop(entry_path, None)
+        try:
+            os.remove(entry_path)
+        except FileNotFoundError:
+            pass
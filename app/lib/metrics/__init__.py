@@ -0,0 +1,34 @@
+from .common import (
+    DEFAULT_METRICS_NAMESPACE,
+    escape_prometheus_label_value,
+    write_metrics_file
+)
+from .http_metrics import (
+    LATENCY_BUCKETS,
+    EndpointMetricsMapping,
+    HTTPMetricsMapping,
+    HTTPMetricsRegistry,
+    LatencyHistogramMapping,
+    get_http_metrics_registry
+)
+from .pipeline_metrics import (
+    MetricsCollector,
+    PipelineMetricsMapping,
+    StageMetricsMapping
+)
+
+
+__all__ = [
+    "DEFAULT_METRICS_NAMESPACE",
+    "LATENCY_BUCKETS",
+    "EndpointMetricsMapping",
+    "HTTPMetricsMapping",
+    "HTTPMetricsRegistry",
+    "LatencyHistogramMapping",
+    "MetricsCollector",
+    "PipelineMetricsMapping",
+    "StageMetricsMapping",
+    "escape_prometheus_label_value",
+    "get_http_metrics_registry",
+    "write_metrics_file"
+]
@@ -0,0 +1,40 @@
+import os
+
+# =============================================================================
+# CONSTANTS
+# =============================================================================
+
+# The prefix of the names of the metrics exported in the Prometheus text
+# format.
+DEFAULT_METRICS_NAMESPACE: str = "rich_xforms_subs"
+
+
+# =============================================================================
+# HELPERS
+# =============================================================================
+
+def escape_prometheus_label_value(value: str) -> str:
+    """Escape a label value for use in the Prometheus text format.
+
+    :param value: The label value to escape.
+
+    :return: The escaped label value, without the surrounding quotes.
+    """
+    return (
+        value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+    )
+
+
+def write_metrics_file(file_path: str, content: str) -> None:
+    """Atomically write exported metrics to a file.
+
+    The content is first written to a temporary file which then replaces the
+    target file, an interrupted write leaves the previous file intact.
+
+    :param file_path: The file to write. Replaced if it exists.
+    :param content: The exported metrics to write.
+    """
+    temp_file_path: str = "%s.tmp" % file_path
+    with open(temp_file_path, "w") as out_file:
+        out_file.write(content)
+    os.replace(temp_file_path, file_path)
@@ -0,0 +1,535 @@
+import json
+import logging
+from bisect import bisect_left
+from datetime import datetime, timezone
+from threading import Lock
+from typing import Dict, List, Optional, Sequence, Tuple, TypedDict
+
+from .common import (
+    DEFAULT_METRICS_NAMESPACE,
+    escape_prometheus_label_value,
+    write_metrics_file
+)
+
+# =============================================================================
+# TYPES
+# =============================================================================
+
+class LatencyHistogramMapping(TypedDict):
+    # The number of observations in each bucket, not cumulative, by the
+    # index of the bucket's upper bound in `LATENCY_BUCKETS`. The last
+    # bucket holds the observations greater than the largest bound.
+    counts: List[int]
+    count: int
+    sum: float
+    max: float
+
+
+class EndpointMetricsMapping(TypedDict):
+    # The number of requests sent, including retries, and how many of them
+    # failed without a response, e.g. on a connection error or a timeout.
+    requests: int
+    errors: int
+    # The number of requests retried after a re-authentication.
+    retries: int
+    # The number of re-authentications triggered by the endpoint.
+    reauthentications: int
+    # The number of responses by HTTP status code.
+    status_codes: Dict[str, int]
+    bytes_received: int
+    # Only observed for the requests that established a new connection.
+    connect_seconds: LatencyHistogramMapping
+    total_seconds: LatencyHistogramMapping
+
+
+class HTTPMetricsMapping(TypedDict):
+    # ISO 8601 formatted, timezone aware datetimes.
+    started_at: str
+    collected_at: str
+    buckets: List[float]
+    endpoints: Dict[str, EndpointMetricsMapping]
+
+
+# =============================================================================
+# CONSTANTS
+# =============================================================================
+
+LOGGER = logging.getLogger(__name__)
+
+# The upper bounds, in seconds, of the buckets of the latency histograms.
+LATENCY_BUCKETS: Sequence[float] = (
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+    30.0,
+    60.0
+)
+
+# The name, type and help of the per endpoint counters exported in the
+# Prometheus text format, by key of `EndpointMetricsMapping`.
+_PROMETHEUS_COUNTERS: Sequence[Tuple[str, str, str]] = (
+    (
+        "requests",
+        "http_requests_total",
+        "Number of HTTP requests sent to each endpoint, including retries."
+    ),
+    (
+        "errors",
+        "http_request_errors_total",
+        "Number of HTTP requests to each endpoint that got no response."
+    ),
+    (
+        "retries",
+        "http_request_retries_total",
+        "Number of HTTP requests to each endpoint retried after a "
+        "re-authentication."
+    ),
+    (
+        "reauthentications",
+        "http_reauthentications_total",
+        "Number of re-authentications triggered by each endpoint."
+    ),
+    (
+        "bytes_received",
+        "http_received_bytes_total",
+        "Number of response body bytes received from each endpoint."
+    )
+)
+
+_PROMETHEUS_HISTOGRAMS: Sequence[Tuple[str, str, str]] = (
+    (
+        "connect_seconds",
+        "http_connect_duration_seconds",
+        "Time taken to establish the new connections of each endpoint."
+    ),
+    (
+        "total_seconds",
+        "http_request_duration_seconds",
+        "Time taken by the HTTP requests to each endpoint, from sending the "
+        "request to receiving the whole response."
+    )
+)
+
+_SUMMARY_COLUMNS: Sequence[str] = (
+    "Endpoint",
+    "Requests",
+    "Errors",
+    "Re-auths",
+    "Auth retries",
+    "Received",
+    "Connects",
+    "Conn p95",
+    "Mean",
+    "p50",
+    "p95",
+    "Max",
+    "Statuses"
+)
+
+
+# =============================================================================
+# HELPERS
+# =============================================================================
+
+def _new_histogram() -> LatencyHistogramMapping:
+    return {
+        "counts": [0] * (len(LATENCY_BUCKETS) + 1),
+        "count": 0,
+        "sum": 0.0,
+        "max": 0.0
+    }
+
+
+def _new_endpoint_metrics() -> EndpointMetricsMapping:
+    return {
+        "requests": 0,
+        "errors": 0,
+        "retries": 0,
+        "reauthentications": 0,
+        "status_codes": dict(),
+        "bytes_received": 0,
+        "connect_seconds": _new_histogram(),
+        "total_seconds": _new_histogram()
+    }
+
+
+def _observe(histogram: LatencyHistogramMapping, value: float) -> None:
+    # Buckets include their upper bound.
+    histogram["counts"][bisect_left(LATENCY_BUCKETS, value)] += 1
+    histogram["count"] += 1
+    histogram["sum"] += value
+    histogram["max"] = max(histogram["max"], value)
+
+
+def _combine_histograms(
+        histogram: LatencyHistogramMapping,
+        other: LatencyHistogramMapping
+) -> None:
+    for _index, _count in enumerate(other["counts"]):
+        histogram["counts"][_index] += _count
+    histogram["count"] += other["count"]
+    histogram["sum"] += other["sum"]
+    histogram["max"] = max(histogram["max"], other["max"])
+
+
+def _quantile(
+        histogram: LatencyHistogramMapping,
+        quantile: float
+) -> Optional[float]:
+    # Interpolate linearly within the bucket holding the quantile, the same
+    # as Prometheus' `histogram_quantile`, but never past the largest value
+    # observed.
+    if not histogram["count"]:
+        return None
+    rank: float = quantile * histogram["count"]
+    seen: int = 0
+    for _index, _count in enumerate(histogram["counts"]):
+        if _count and seen + _count >= rank:
+            if _index == len(LATENCY_BUCKETS):
+                return histogram["max"]
+            lower: float = LATENCY_BUCKETS[_index - 1] if _index else 0.0
+            upper: float = LATENCY_BUCKETS[_index]
+            value: float = lower + (upper - lower) * (rank - seen) / _count
+            return min(value, histogram["max"])
+        seen += _count
+    return histogram["max"]
+
+
+def _format_seconds(value: Optional[float]) -> str:
+    if value is None:
+        return "-"
+    return "%.0fms" % (value * 1000) if value < 1 else "%.2fs" % value
+
+
+def _format_bytes(value: int) -> str:
+    if value < 1024:
+        return "%dB" % value
+    size: float = value / 1024
+    for _unit in ("KiB", "MiB"):
+        if size < 1024:
+            return "%.1f%s" % (size, _unit)
+        size /= 1024
+    return "%.1fGiB" % size
+
+
+# =============================================================================
+# HTTP METRICS REGISTRY
+# =============================================================================
+
+class HTTPMetricsRegistry:
+    """
+    A thread safe, in-process registry of the metrics of the HTTP requests
+    made by the HTTP transports, grouped by endpoint.
+
+    Endpoints are identified by the request method and the template of the
+    request url, e.g. "GET /v1/projects/{projectId}/forms", so that the
+    requests for different forms or submissions are grouped together. For
+    each endpoint, the number of requests, errors, retries and
+    re-authentications, the bytes received, the responses by status code
+    and histograms of the connect and total latencies are recorded.
+
+    The transports record to the process wide registry returned by
+    `get_http_metrics_registry` unless given one. The recorded metrics are
+    exported as json, see `to_json`, in the Prometheus text format, see
+    `to_prometheus`, and as a human readable table, see `format_summary`.
+    """
+
+    def __init__(self):
+        self._lock: Lock = Lock()
+        self._started_at: datetime = datetime.now(timezone.utc)
+        self._endpoints: Dict[str, EndpointMetricsMapping] = dict()
+
+    def record_request(
+            self,
+            endpoint: str,
+            status_code: Optional[int],
+            total_seconds: float,
+            connect_seconds: Optional[float] = None,
+            bytes_received: int = 0
+    ) -> None:
+        """Record a request sent to an endpoint.
+
+        :param endpoint: The endpoint the request was sent to.
+        :param status_code: The HTTP status of the response, or `None` if no
+               response was received.
+        :param total_seconds: The time taken by the request, from sending it
+               to receiving the whole response, or failing.
+        :param connect_seconds: The time taken to establish a new connection
+               for the request, or `None` if an existing connection was
+               reused.
+        :param bytes_received: The size of the response body.
+        """
+        with self._lock:
+            metrics: EndpointMetricsMapping = self._get_endpoint_metrics(
+                endpoint
+            )
+            metrics["requests"] += 1
+            if status_code is None:
+                metrics["errors"] += 1
+            else:
+                status: str = str(status_code)
+                metrics["status_codes"][status] = (
+                    metrics["status_codes"].get(status, 0) + 1
+                )
+            metrics["bytes_received"] += bytes_received
+            _observe(metrics["total_seconds"], total_seconds)
+            if connect_seconds is not None:
+                _observe(metrics["connect_seconds"], connect_seconds)
+
+    def record_retry(self, endpoint: str) -> None:
+        """Record that a request to an endpoint is being retried.
+
+        :param endpoint: The endpoint of the retried request.
+        """
+        with self._lock:
+            self._get_endpoint_metrics(endpoint)["retries"] += 1
+
+    def record_reauthentication(self, endpoint: str) -> None:
+        """Record a re-authentication triggered by a request to an endpoint.
+
+        :param endpoint: The endpoint of the request that triggered the
+               re-authentication.
+        """
+        with self._lock:
+            self._get_endpoint_metrics(endpoint)["reauthentications"] += 1
+
+    def add_metrics(self, metrics: HTTPMetricsMapping) -> None:
+        """Combine the given metrics, e.g. recorded on another process, with
+        the metrics recorded so far.
+
+        :param metrics: The metrics to combine, as returned by `to_json`.
+        """
+        assert list(metrics["buckets"]) == list(LATENCY_BUCKETS), (
+            "The latency buckets of the metrics MUST match "
+            '"LATENCY_BUCKETS".'
+        )
+        with self._lock:
+            for _endpoint, _other in metrics["endpoints"].items():
+                endpoint_metrics: EndpointMetricsMapping = (
+                    self._get_endpoint_metrics(_endpoint)
+                )
+                for _key in (
+                        "requests",
+                        "errors",
+                        "retries",
+                        "reauthentications",
+                        "bytes_received"
+                ):
+                    endpoint_metrics[_key] += _other[_key]  # type: ignore
+                for _status, _count in _other["status_codes"].items():
+                    endpoint_metrics["status_codes"][_status] = (
+                        endpoint_metrics["status_codes"].get(_status, 0)
+                        + _count
+                    )
+                _combine_histograms(
+                    endpoint_metrics["connect_seconds"],
+                    _other["connect_seconds"]
+                )
+                _combine_histograms(
+                    endpoint_metrics["total_seconds"],
+                    _other["total_seconds"]
+                )
+
+    def to_json(self) -> HTTPMetricsMapping:
+        """Return a snapshot of the recorded metrics.
+
+        :return: The metrics recorded so far.
+        """
+        with self._lock:
+            endpoints: Dict[str, EndpointMetricsMapping] = json.loads(
+                json.dumps(self._endpoints)
+            )
+        return {
+            "started_at": self._started_at.isoformat(),
+            "collected_at": datetime.now(timezone.utc).isoformat(),
+            "buckets": list(LATENCY_BUCKETS),
+            "endpoints": endpoints
+        }
+
+    def to_prometheus(self, namespace: Optional[str] = None) -> str:
+        """Return the recorded metrics in the Prometheus text format.
+
+        :param namespace: The prefix of the metric names.
+
+        :return: The metrics recorded so far, labeled with their endpoint.
+        """
+        prefix: str = namespace or DEFAULT_METRICS_NAMESPACE
+        endpoints: Dict[str, EndpointMetricsMapping] = self.to_json()[
+            "endpoints"
+        ]
+        lines: List[str] = []
+        for _key, _name, _help in _PROMETHEUS_COUNTERS:
+            metric_name: str = "%s_%s" % (prefix, _name)
+            lines.append("# HELP %s %s" % (metric_name, _help))
+            lines.append("# TYPE %s counter" % metric_name)
+            for _endpoint, _metrics in endpoints.items():
+                lines.append(
+                    '%s{endpoint="%s"} %d' % (
+                        metric_name,
+                        escape_prometheus_label_value(_endpoint),
+                        _metrics[_key]  # type: ignore
+                    )
+                )
+
+        metric_name = "%s_http_responses_total" % prefix
+        lines.append(
+            "# HELP %s Number of HTTP responses from each endpoint, by "
+            "status code." % metric_name
+        )
+        lines.append("# TYPE %s counter" % metric_name)
+        for _endpoint, _metrics in endpoints.items():
+            for _status, _count in sorted(_metrics["status_codes"].items()):
+                lines.append(
+                    '%s{endpoint="%s",code="%s"} %d' % (
+                        metric_name,
+                        escape_prometheus_label_value(_endpoint),
+                        _status,
+                        _count
+                    )
+                )
+
+        for _key, _name, _help in _PROMETHEUS_HISTOGRAMS:
+            metric_name = "%s_%s" % (prefix, _name)
+            lines.append("# HELP %s %s" % (metric_name, _help))
+            lines.append("# TYPE %s histogram" % metric_name)
+            for _endpoint, _metrics in endpoints.items():
+                histogram: LatencyHistogramMapping = _metrics[
+                    _key  # type: ignore
+                ]
+                label: str = escape_prometheus_label_value(_endpoint)
+                cumulative_count: int = 0
+                for _bound, _count in zip(
+                        (*map(repr, LATENCY_BUCKETS), "+Inf"),
+                        histogram["counts"]
+                ):
+                    cumulative_count += _count
+                    lines.append(
+                        '%s_bucket{endpoint="%s",le="%s"} %d' % (
+                            metric_name,
+                            label,
+                            _bound,
+                            cumulative_count
+                        )
+                    )
+                lines.append(
+                    '%s_sum{endpoint="%s"} %r' % (
+                        metric_name,
+                        label,
+                        histogram["sum"]
+                    )
+                )
+                lines.append(
+                    '%s_count{endpoint="%s"} %d' % (
+                        metric_name,
+                        label,
+                        histogram["count"]
+                    )
+                )
+        return "\n".join(lines) + "\n"
+
+    def format_summary(self) -> str:
+        """Return a table summarizing the recorded metrics, an endpoint per
+        row, with the most time consuming endpoints first.
+
+        The "Auth retries" column counts the requests retried after a
+        re-authentication, the only requests the transports retry.
+
+        Latency percentiles are estimated from the latency histograms.
+
+        :return: The summary table, or an empty string if no requests were
+                 recorded.
+        """
+        endpoints: Dict[str, EndpointMetricsMapping] = self.to_json()[
+            "endpoints"
+        ]
+        if not endpoints:
+            return ""
+        rows: List[Sequence[str]] = [_SUMMARY_COLUMNS]
+        for _endpoint, _metrics in sorted(
+                endpoints.items(),
+                key=lambda _item: -_item[1]["total_seconds"]["sum"]
+        ):
+            total: LatencyHistogramMapping = _metrics["total_seconds"]
+            connect: LatencyHistogramMapping = _metrics["connect_seconds"]
+            rows.append((
+                _endpoint,
+                str(_metrics["requests"]),
+                str(_metrics["errors"]),
+                str(_metrics["reauthentications"]),
+                str(_metrics["retries"]),
+                _format_bytes(_metrics["bytes_received"]),
+                str(connect["count"]),
+                _format_seconds(_quantile(connect, 0.95)),
+                _format_seconds(
+                    total["sum"] / total["count"] if total["count"] else None
+                ),
+                _format_seconds(_quantile(total, 0.5)),
+                _format_seconds(_quantile(total, 0.95)),
+                _format_seconds(total["max"] if total["count"] else None),
+                " ".join(
+                    "%s:%d" % _status
+                    for _status in sorted(_metrics["status_codes"].items())
+                ) or "-"
+            ))
+        widths: List[int] = [
+            max(len(_row[_index]) for _row in rows)
+            for _index in range(len(_SUMMARY_COLUMNS))
+        ]
+        return "\n".join(
+            "  ".join(
+                # Left align the endpoints and status codes, right align the
+                # numbers.
+                _value.ljust(_width)
+                if _index in (0, len(_SUMMARY_COLUMNS) - 1)
+                else _value.rjust(_width)
+                for _index, (_value, _width) in enumerate(zip(_row, widths))
+            ).rstrip()
+            for _row in rows
+        )
+
+    def write_json(self, file_path: str) -> None:
+        """Write the recorded metrics to the given file as json.
+
+        :param file_path: The file to write. Replaced if it exists.
+        """
+        LOGGER.debug('Writing HTTP metrics to the file="%s"', file_path)
+        write_metrics_file(file_path, json.dumps(self.to_json(), indent=4))
+
+    def write_prometheus(self, file_path: str) -> None:
+        """Write the recorded metrics to the given file in the Prometheus
+        text format. The file is replaced atomically.
+
+        :param file_path: The file to write. Replaced if it exists.
+        """
+        LOGGER.debug('Writing HTTP metrics to the file="%s"', file_path)
+        write_metrics_file(file_path, self.to_prometheus())
+
+    def _get_endpoint_metrics(self, endpoint: str) -> EndpointMetricsMapping:
+        metrics: Optional[EndpointMetricsMapping] = self._endpoints.get(
+            endpoint
+        )
+        if metrics is None:
+            metrics = _new_endpoint_metrics()
+            self._endpoints[endpoint] = metrics
+        return metrics
+
+
+_HTTP_METRICS_REGISTRY: HTTPMetricsRegistry = HTTPMetricsRegistry()
+
+
+def get_http_metrics_registry() -> HTTPMetricsRegistry:
+    """
+    Return the process wide registry that the HTTP transports record their
+    requests to by default.
+
+    :return: The process wide HTTP metrics registry.
+    """
+    return _HTTP_METRICS_REGISTRY
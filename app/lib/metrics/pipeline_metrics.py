@@ -0,0 +1,357 @@
+import json
+import logging
+import sys
+import time
+from datetime import datetime, timezone
+from threading import Lock, local
+from typing import (
+    Any,
+    Callable,
+    Dict,
+    List,
+    Mapping,
+    Optional,
+    Sequence,
+    Tuple,
+    TypedDict
+)
+
+from app.core import Task
+
+from ..tasks import PipelineHook, Stage, StreamingPipeline
+from .common import (
+    DEFAULT_METRICS_NAMESPACE,
+    escape_prometheus_label_value,
+    write_metrics_file
+)
+
+# =============================================================================
+# TYPES
+# =============================================================================
+
+class StageMetricsMapping(TypedDict):
+    # The number of executions of the stage and how many of them failed.
+    calls: int
+    errors: int
+    # The number of items yielded by the stage, streaming pipelines only.
+    items: int
+    wall_seconds: float
+    cpu_seconds: float
+    # Only known for stages whose tasks report a `bytes_written` count.
+    bytes_written: Optional[int]
+    # The peak resident set size of the process by the end of the stage.
+    peak_rss_bytes: Optional[int]
+
+
+class PipelineMetricsMapping(TypedDict):
+    # ISO 8601 formatted, timezone aware datetimes.
+    started_at: str
+    collected_at: str
+    stages: Dict[str, StageMetricsMapping]
+
+
+# A started execution, its wall and cpu clock readings and the cpu clock.
+_Start = Tuple[float, float, Callable[[], float]]
+
+
+# =============================================================================
+# CONSTANTS
+# =============================================================================
+
+LOGGER = logging.getLogger(__name__)
+
+# The name, type and help of each stage metric exported in the Prometheus
+# text format, by key of `StageMetricsMapping`.
+_PROMETHEUS_METRICS: Sequence[Tuple[str, str, str, str]] = (
+    (
+        "calls",
+        "stage_calls_total",
+        "counter",
+        "Number of executions of each pipeline stage."
+    ),
+    (
+        "errors",
+        "stage_errors_total",
+        "counter",
+        "Number of failed executions of each pipeline stage."
+    ),
+    (
+        "items",
+        "stage_items_total",
+        "counter",
+        "Number of items yielded by each streaming pipeline stage."
+    ),
+    (
+        "wall_seconds",
+        "stage_wall_seconds_total",
+        "counter",
+        "Wall clock time spent executing each pipeline stage."
+    ),
+    (
+        "cpu_seconds",
+        "stage_cpu_seconds_total",
+        "counter",
+        "CPU time spent executing each pipeline stage."
+    ),
+    (
+        "bytes_written",
+        "stage_bytes_written_total",
+        "counter",
+        "Number of bytes written by each pipeline stage."
+    ),
+    (
+        "peak_rss_bytes",
+        "stage_peak_rss_bytes",
+        "gauge",
+        "Peak resident set size of the process by the end of each pipeline "
+        "stage."
+    )
+)
+
+
+# =============================================================================
+# HELPERS
+# =============================================================================
+
+def _get_peak_rss_bytes() -> Optional[int]:
+    try:
+        import resource
+    except ImportError:
+        # Not available on Windows.
+        return None
+    peak_rss: int = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Reported in bytes on macOS and in kilobytes elsewhere.
+    return peak_rss if sys.platform == "darwin" else peak_rss * 1024
+
+
+def _get_stage_name(task: Task[Any, Any]) -> str:
+    return task.name if isinstance(task, Stage) else type(task).__name__
+
+
+def _new_stage_metrics() -> StageMetricsMapping:
+    return {
+        "calls": 0,
+        "errors": 0,
+        "items": 0,
+        "wall_seconds": 0.0,
+        "cpu_seconds": 0.0,
+        "bytes_written": None,
+        "peak_rss_bytes": None
+    }
+
+
+def _max(a: Optional[int], b: Optional[int]) -> Optional[int]:
+    if a is None or b is None:
+        return b if a is None else a
+    return max(a, b)
+
+
+# =============================================================================
+# METRICS COLLECTOR
+# =============================================================================
+
+class MetricsCollector(PipelineHook):
+    """
+    A pipeline hook that collects the wall time, CPU time, number of
+    executions, errors and items, bytes written and peak resident set size
+    of each stage of the pipelines it is added to.
+
+    Stages are identified by the name of their `Stage`, or otherwise by the
+    name of their task's class, and the metrics of stages with the same name
+    are combined. The stages of nested pipelines are reported separately and
+    their times are also included in the times of the stage running them.
+
+    CPU time is measured on the threads executing the tasks of streaming
+    pipelines, which may run concurrently, and for the whole process
+    otherwise. Bytes written are reported by the tasks themselves, through a
+    `bytes_written` attribute, and are only known for the stages whose tasks
+    have one. The peak resident set size is not available on Windows.
+
+    The collected metrics are exported as json, see `to_json`, and in the
+    Prometheus text format, see `to_prometheus`.
+    """
+
+    def __init__(self, namespace: Optional[str] = None):
+        self._namespace: str = namespace or DEFAULT_METRICS_NAMESPACE
+        self._lock: Lock = Lock()
+        self._local: local = local()
+        self._started_at: datetime = datetime.now(timezone.utc)
+        self._stages: Dict[str, StageMetricsMapping] = dict()
+        # The tasks reporting the bytes they wrote, by stage name.
+        self._writers: Dict[str, Dict[int, Any]] = dict()
+
+    def before_task(
+            self,
+            pipeline: Task[Any, Any],
+            task: Task[Any, Any],
+            an_input: Any
+    ) -> None:
+        # Streaming pipelines run their tasks concurrently, measure their
+        # cpu time on the thread executing each task instead.
+        cpu_clock: Callable[[], float] = (
+            time.thread_time
+            if isinstance(pipeline, StreamingPipeline)
+            else time.process_time
+        )
+        self._get_starts().append(
+            (time.perf_counter(), cpu_clock(), cpu_clock)
+        )
+
+    def after_task(
+            self,
+            pipeline: Task[Any, Any],
+            task: Task[Any, Any],
+            an_input: Any,
+            result: Any
+    ) -> None:
+        self._record_execution(task, failed=False)
+
+    def on_task_error(
+            self,
+            pipeline: Task[Any, Any],
+            task: Task[Any, Any],
+            an_input: Any,
+            error: BaseException
+    ) -> None:
+        self._record_execution(task, failed=True)
+
+    def on_item(
+            self,
+            pipeline: Task[Any, Any],
+            task: Task[Any, Any],
+            item: Any
+    ) -> None:
+        name: str = _get_stage_name(task)
+        with self._lock:
+            self._get_stage_metrics(name)["items"] += 1
+
+    def add_metrics(self, metrics: PipelineMetricsMapping) -> None:
+        """Combine the given metrics, e.g. collected on another process, with
+        the metrics collected so far.
+
+        :param metrics: The metrics to combine, as returned by `to_json`.
+        """
+        with self._lock:
+            for _name, _other in metrics["stages"].items():
+                stage_metrics: StageMetricsMapping = self._get_stage_metrics(
+                    _name
+                )
+                stage_metrics["calls"] += _other["calls"]
+                stage_metrics["errors"] += _other["errors"]
+                stage_metrics["items"] += _other["items"]
+                stage_metrics["wall_seconds"] += _other["wall_seconds"]
+                stage_metrics["cpu_seconds"] += _other["cpu_seconds"]
+                if _other["bytes_written"] is not None:
+                    stage_metrics["bytes_written"] = (
+                        stage_metrics["bytes_written"] or 0
+                    ) + _other["bytes_written"]
+                stage_metrics["peak_rss_bytes"] = _max(
+                    stage_metrics["peak_rss_bytes"],
+                    _other["peak_rss_bytes"]
+                )
+
+    def to_json(self) -> PipelineMetricsMapping:
+        """Return a snapshot of the collected metrics.
+
+        :return: The metrics collected so far.
+        """
+        with self._lock:
+            stages: Dict[str, StageMetricsMapping] = {
+                _name: StageMetricsMapping(**_metrics)  # type: ignore
+                for _name, _metrics in self._stages.items()
+            }
+            for _name, _writers in self._writers.items():
+                bytes_written: int = sum(
+                    getattr(_writer, "bytes_written")
+                    for _writer in _writers.values()
+                )
+                stages[_name]["bytes_written"] = (
+                    stages[_name]["bytes_written"] or 0
+                ) + bytes_written
+        return {
+            "started_at": self._started_at.isoformat(),
+            "collected_at": datetime.now(timezone.utc).isoformat(),
+            "stages": stages
+        }
+
+    def to_prometheus(self) -> str:
+        """Return the collected metrics in the Prometheus text format.
+
+        :return: The metrics collected so far, one metric family per stage
+                 metric with a sample per stage, labeled with the name of
+                 the stage.
+        """
+        stages: Mapping[str, StageMetricsMapping] = self.to_json()["stages"]
+        lines: List[str] = []
+        for _key, _name, _type, _help in _PROMETHEUS_METRICS:
+            metric_name: str = "%s_%s" % (self._namespace, _name)
+            lines.append("# HELP %s %s" % (metric_name, _help))
+            lines.append("# TYPE %s %s" % (metric_name, _type))
+            for _stage_name, _metrics in stages.items():
+                value: Optional[float] = _metrics[_key]  # type: ignore
+                if value is None:
+                    continue
+                lines.append(
+                    '%s{stage="%s"} %s' % (
+                        metric_name,
+                        escape_prometheus_label_value(_stage_name),
+                        repr(value)
+                    )
+                )
+        return "\n".join(lines) + "\n"
+
+    def write_json(self, file_path: str) -> None:
+        """Write the collected metrics to the given file as json.
+
+        :param file_path: The file to write. Replaced if it exists.
+        """
+        LOGGER.debug('Writing pipeline metrics to the file="%s"', file_path)
+        write_metrics_file(file_path, json.dumps(self.to_json(), indent=4))
+
+    def write_prometheus(self, file_path: str) -> None:
+        """Write the collected metrics to the given file in the Prometheus
+        text format.
+
+        The file is replaced atomically, it can be read by the textfile
+        collector of the Prometheus node exporter while being updated.
+
+        :param file_path: The file to write. Replaced if it exists.
+        """
+        LOGGER.debug('Writing pipeline metrics to the file="%s"', file_path)
+        write_metrics_file(file_path, self.to_prometheus())
+
+    def _get_starts(self) -> List[_Start]:
+        starts: Optional[List[_Start]] = getattr(self._local, "starts", None)
+        if starts is None:
+            starts = []
+            self._local.starts = starts
+        return starts
+
+    def _get_stage_metrics(self, name: str) -> StageMetricsMapping:
+        stage_metrics: Optional[StageMetricsMapping] = self._stages.get(name)
+        if stage_metrics is None:
+            stage_metrics = _new_stage_metrics()
+            self._stages[name] = stage_metrics
+        return stage_metrics
+
+    def _record_execution(self, task: Task[Any, Any], failed: bool) -> None:
+        # Executions on the same thread are nested, the last to start is the
+        # first to end.
+        wall_start, cpu_start, cpu_clock = self._get_starts().pop()
+        wall_seconds: float = time.perf_counter() - wall_start
+        cpu_seconds: float = cpu_clock() - cpu_start
+        peak_rss_bytes: Optional[int] = _get_peak_rss_bytes()
+        name: str = _get_stage_name(task)
+        writer: Any = task.task if isinstance(task, Stage) else task
+        with self._lock:
+            stage_metrics: StageMetricsMapping = self._get_stage_metrics(name)
+            stage_metrics["calls"] += 1
+            stage_metrics["errors"] += failed
+            stage_metrics["wall_seconds"] += wall_seconds
+            stage_metrics["cpu_seconds"] += cpu_seconds
+            stage_metrics["peak_rss_bytes"] = _max(
+                stage_metrics["peak_rss_bytes"],
+                peak_rss_bytes
+            )
+            if isinstance(getattr(writer, "bytes_written", None), int):
+                self._writers.setdefault(name, dict())[id(writer)] = writer
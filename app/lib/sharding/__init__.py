@@ -0,0 +1,9 @@
+from .shard import SHARD_KEYS, Shard, ShardMapping, shard_of
+
+
+__all__ = [
+    "SHARD_KEYS",
+    "Shard",
+    "ShardMapping",
+    "shard_of"
+]
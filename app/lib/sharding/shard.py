@@ -0,0 +1,137 @@
+import hashlib
+from typing import Any, Mapping, Sequence, TypedDict
+
+from app.core import InitFromMapping, ToJson
+
+# =============================================================================
+# TYPES
+# =============================================================================
+
+class ShardMapping(TypedDict):
+    index: int
+    count: int
+    # What the work is split by, see `SHARD_KEYS`.
+    key: str
+
+
+# =============================================================================
+# CONSTANTS
+# =============================================================================
+
+# Split the work by form id, each form is processed by a single shard, or by
+# instance id, each form is processed by every shard but each submission by
+# a single shard.
+SHARD_KEYS: Sequence[str] = ("form", "instance")
+
+
+# =============================================================================
+# HELPERS
+# =============================================================================
+
+def shard_of(value: str, count: int) -> int:
+    """
+    Return the index of the shard, out of `count` shards, that the given
+    value belongs to.
+
+    Unlike the builtin `hash`, the result is stable across processes, hosts
+    and python versions.
+
+    :param value: The value to look up the shard of, a form or instance id.
+    :param count: The total number of shards.
+
+    :return: The index of the value's shard, from 0 to `count` - 1.
+    """
+    assert count > 0, '"count" MUST be greater than 0.'
+    digest: bytes = hashlib.sha1(value.encode("utf-8")).digest()
+    return int.from_bytes(digest[:8], "big") % count
+
+
+# =============================================================================
+# SHARD
+# =============================================================================
+
+class Shard(InitFromMapping, ToJson):
+    """
+    One of `count` deterministic, disjoint slices of the forms, or of the
+    submissions, of a data source.
+
+    Values are assigned to shards by a stable hash of their ids, see
+    `shard_of`, so that independent runs on different hosts agree on the
+    shard of every form or submission without coordinating.
+    """
+
+    __slots__ = ("_index", "_count", "_key")
+
+    def __init__(self, index: int, count: int, key: str = "form"):
+        assert count > 0, '"count" MUST be greater than 0.'
+        assert 0 <= index < count, (
+            '"index" MUST be between 0 and "count" - 1.'
+        )
+        assert key in SHARD_KEYS, '"key" MUST be one of %s.' % (SHARD_KEYS,)
+        self._index: int = index
+        self._count: int = count
+        self._key: str = key
+
+    @property
+    def index(self) -> int:
+        return self._index
+
+    @property
+    def count(self) -> int:
+        return self._count
+
+    @property
+    def key(self) -> str:
+        return self._key
+
+    def owns(self, value: str) -> bool:
+        """Check whether the given form or instance id is in this shard.
+
+        :param value: The form id, or instance id, to check.
+
+        :return: `True` if the value belongs to this shard, `False`
+                 otherwise.
+        """
+        return shard_of(value, self._count) == self._index
+
+    @classmethod
+    def parse(cls, value: str, key: str = "form") -> "Shard":
+        """Create a shard from its "<index>/<count>" representation.
+
+        :param value: The representation of the shard, e.g. "0/4" for the
+               first of four shards.
+        :param key: What the work is split by, see `SHARD_KEYS`.
+
+        :return: The shard.
+
+        :raise ValueError: If the value is not a valid shard.
+        """
+        index, sep, count = value.partition("/")
+        if not sep or not index.isdigit() or not count.isdigit():
+            raise ValueError(
+                'Invalid shard "%s", expected "<index>/<count>".' % value
+            )
+        if not 0 <= int(index) < int(count):
+            raise ValueError(
+                'Invalid shard "%s", the index must be between 0 and the '
+                'count less 1.' % value
+            )
+        return cls(int(index), int(count), key=key)
+
+    @classmethod
+    def of_mapping(cls, mapping: Mapping[str, Any]) -> "Shard":
+        return cls(mapping["index"], mapping["count"], key=mapping["key"])
+
+    def to_json(self) -> ShardMapping:
+        return {"index": self._index, "count": self._count, "key": self._key}
+
+    def __eq__(self, other: object) -> bool:
+        if not isinstance(other, Shard):
+            return NotImplemented
+        return self.to_json() == other.to_json()
+
+    def __hash__(self) -> int:
+        return hash((self._index, self._count, self._key))
+
+    def __str__(self) -> str:
+        return "%d/%d" % (self._index, self._count)
@@ -0,0 +1,24 @@
+from .column_plan import ColumnPlan, get_column_plan
+from .csv_sink import CSVSink, merge_csv_outputs
+from .ndjson_sink import (
+    NDJSONSink,
+    iter_ndjson_submissions,
+    merge_ndjson_outputs
+)
+from .sqlite_sink import SQLiteSink, merge_sqlite_databases
+from .xlsx_sink import XLSXSink, merge_xlsx_workbooks
+
+
+__all__ = [
+    "CSVSink",
+    "ColumnPlan",
+    "NDJSONSink",
+    "SQLiteSink",
+    "XLSXSink",
+    "get_column_plan",
+    "iter_ndjson_submissions",
+    "merge_csv_outputs",
+    "merge_ndjson_outputs",
+    "merge_sqlite_databases",
+    "merge_xlsx_workbooks"
+]
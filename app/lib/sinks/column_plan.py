@@ -0,0 +1,102 @@
+from threading import Lock
+from typing import Any, List, Optional, Sequence, Tuple
+from weakref import WeakKeyDictionary
+
+from app.core import (
+    PrimaryInstanceDocumentRoot,
+    Question,
+    SubmissionTemplate,
+    XForm
+)
+
+# =============================================================================
+# CONSTANTS
+# =============================================================================
+
+_META_HEADERS: Tuple[str, ...] = ("instance_id", "instance_name")
+
+_COLUMN_PLANS: "WeakKeyDictionary[XForm, ColumnPlan]" = WeakKeyDictionary()
+
+_COLUMN_PLANS_LOCK: Lock = Lock()
+
+
+# =============================================================================
+# COLUMN PLAN
+# =============================================================================
+
+class ColumnPlan:
+    """
+    The columns of a tabular export of the submissions of a form version.
+
+    The first columns hold the submissions metadata, followed by a column for
+    each question of the form version with no sub questions, in submission
+    template slot order. Question columns are headed by the question's label,
+    or by its xpath when the question has no label.
+    """
+
+    def __init__(self, form: XForm):
+        self._template: SubmissionTemplate = form.submission_template
+        questions: Sequence[Question] = self._template.questions
+        self._slots: Tuple[int, ...] = tuple(
+            _slot
+            for _slot, _question in enumerate(questions)
+            if not _question.sub_questions
+        )
+        self._headers: Tuple[str, ...] = _META_HEADERS + tuple(
+            questions[_slot].label or questions[_slot].xpath
+            for _slot in self._slots
+        )
+        self._xpaths: Tuple[str, ...] = _META_HEADERS + tuple(
+            questions[_slot].xpath for _slot in self._slots
+        )
+
+    @property
+    def headers(self) -> Sequence[str]:
+        return self._headers
+
+    @property
+    def xpaths(self) -> Sequence[str]:
+        """
+        The xpath of the question on each column, the metadata columns are
+        identified by their headers.
+        """
+        return self._xpaths
+
+    def get_row(self, submission: PrimaryInstanceDocumentRoot) -> List[Any]:
+        """Return the cells of a submission in column order.
+
+        :param submission: A submission of this plan's form version.
+
+        :return: The submission's metadata followed by its question values.
+        """
+        values: List[Any] = self._template.get_values(submission)
+        return [
+            submission.meta.instance_id,
+            submission.meta.instance_name,
+            *[values[_slot] for _slot in self._slots]
+        ]
+
+
+# =============================================================================
+# HELPERS
+# =============================================================================
+
+def get_column_plan(form: XForm) -> ColumnPlan:
+    """
+    Return the column plan of a form version, computing it on first use.
+
+    The column plans are cached for as long as their forms are alive and are
+    shared by all the tabular sinks.
+
+    :param form: The form version whose column plan to return.
+
+    :return: The column plan of the given form version.
+    """
+    plan: Optional[ColumnPlan] = _COLUMN_PLANS.get(form)
+    if plan is None:
+        with _COLUMN_PLANS_LOCK:
+            plan = _COLUMN_PLANS.get(form)
+            if plan is None:
+                plan = ColumnPlan(form)
+                _COLUMN_PLANS[form] = plan
+    return plan
@@ -0,0 +1,292 @@
+import csv
+import logging
+import os
+import re
+import shutil
+from contextlib import AbstractContextManager
+from queue import Queue
+from threading import Lock, Thread
+from typing import IO, Dict, Optional, Sequence, Set, Tuple
+
+from app.core import PrimaryInstanceDocumentRoot, Task, XForm
+from app.utils import ensure_not_none_nor_empty
+
+from .column_plan import ColumnPlan, get_column_plan
+
+# =============================================================================
+# TYPES
+# =============================================================================
+
+_FormSubmission = Tuple[XForm, PrimaryInstanceDocumentRoot]
+
+
+# =============================================================================
+# CONSTANTS
+# =============================================================================
+
+LOGGER = logging.getLogger(__name__)
+
+_BUFFER_SIZE: int = 1024 * 1024
+
+_DEFAULT_QUEUE_SIZE: int = 1000
+
+_INVALID_FILE_NAME_CHARS_RE = re.compile(r"[^\w.\-]")
+
+
+# =============================================================================
+# HELPERS
+# =============================================================================
+
+def _file_name(form: XForm) -> str:
+    return _INVALID_FILE_NAME_CHARS_RE.sub(
+        "_",
+        "%s_v%s.csv" % (form.id, form.version)
+    )
+
+
+def merge_csv_outputs(
+        out_dir: str,
+        source_dirs: Sequence[str],
+        append: bool = False,
+        move: bool = False
+) -> None:
+    """
+    Merge the files written by `CSVSink`s into a single directory.
+
+    Files missing from `out_dir`, or all of them unless `append` is `True`,
+    are copied, or moved when `move` is `True`, as they are. The rows of the
+    others, less their header row, are appended to the file of the same name
+    on `out_dir`.
+
+    :param out_dir: The directory to merge the files into.
+    :param source_dirs: The directories of the files to merge, in order.
+    :param append: Whether to append to the existing files in `out_dir`
+           instead of replacing them.
+    :param move: Whether to move the files instead of copying them, leaving
+           the source directories incomplete.
+    """
+    merged_file_names: Set[str] = set()
+    for _source_dir in source_dirs:
+        if not os.path.isdir(_source_dir):
+            continue
+        for file_name in sorted(os.listdir(_source_dir)):
+            if not file_name.endswith(".csv"):
+                continue
+            source_file_path: str = os.path.join(_source_dir, file_name)
+            file_path: str = os.path.join(out_dir, file_name)
+            if file_name not in merged_file_names and not (
+                    append and os.path.exists(file_path)
+            ):
+                if move:
+                    os.replace(source_file_path, file_path)
+                else:
+                    shutil.copyfile(source_file_path, file_path)
+                merged_file_names.add(file_name)
+                continue
+            # Rows are re-written, quoted header values might span lines.
+            with open(
+                    source_file_path,
+                    encoding="utf-8",
+                    newline=""
+            ) as source_file, open(
+                    file_path,
+                    "a",
+                    buffering=_BUFFER_SIZE,
+                    encoding="utf-8",
+                    newline=""
+            ) as merged_file:
+                rows = csv.reader(source_file)
+                next(rows, None)
+                csv.writer(merged_file).writerows(rows)
+            merged_file_names.add(file_name)
+
+
+class _FormVersionWriter:
+    """
+    Writes the submissions of a single form version to its own csv file,
+    either on the calling thread or on a dedicated worker thread.
+    """
+
+    def __init__(
+            self,
+            file_path: str,
+            plan: ColumnPlan,
+            append: bool,
+            threaded: bool,
+            queue_size: int
+    ):
+        write_header: bool = not (
+            append and os.path.exists(file_path) and os.path.getsize(file_path)
+        )
+        self._file: IO[str] = open(
+            file_path,
+            "a" if append else "w",
+            buffering=_BUFFER_SIZE,
+            encoding="utf-8",
+            newline=""
+        )
+        self._writer = csv.writer(self._file)
+        self._plan: ColumnPlan = plan
+        # Characters written, only updated by the thread writing rows.
+        self.chars_written: int = 0
+        if write_header:
+            self.chars_written += self._writer.writerow(plan.headers)
+        self._error: Optional[BaseException] = None
+        self._queue: "Optional[Queue[Optional[PrimaryInstanceDocumentRoot]]]"
+        self._thread: Optional[Thread] = None
+        self._queue = Queue(maxsize=queue_size) if threaded else None
+        if self._queue is not None:
+            self._thread = Thread(
+                target=self._run,
+                name="csv-writer-%s" % os.path.basename(file_path),
+                daemon=True
+            )
+            self._thread.start()
+
+    def write(self, submission: PrimaryInstanceDocumentRoot) -> None:
+        if self._queue is None:
+            self.chars_written += self._writer.writerow(
+                self._plan.get_row(submission)
+            )
+            return
+        self._raise_error()
+        self._queue.put(submission)
+
+    def close(self) -> None:
+        try:
+            if self._queue is not None and self._thread is not None:
+                self._queue.put(None)
+                self._thread.join()
+            self._raise_error()
+        finally:
+            self._file.close()
+
+    def _raise_error(self) -> None:
+        if self._error is not None:
+            raise self._error
+
+    def _run(self) -> None:
+        assert self._queue is not None
+        while True:
+            submission: Optional[PrimaryInstanceDocumentRoot] = (
+                self._queue.get()
+            )
+            if submission is None:
+                return
+            # Keep draining the queue after an error so that producers are
+            # never blocked, the error is raised on the next write or close.
+            if self._error is not None:
+                continue
+            try:
+                self.chars_written += self._writer.writerow(
+                    self._plan.get_row(submission)
+                )
+            except BaseException as exp:
+                self._error = exp
+
+
+# =============================================================================
+# CSV SINK
+# =============================================================================
+
+class CSVSink(Task[_FormSubmission, None], AbstractContextManager):
+    """
+    A submission consumer that streams submissions to flat csv files.
+
+    The submissions of each form version are written to their own
+    `<form id>_v<form version>.csv` file, with a header row of the form
+    version's question labels followed by a row per submission, see
+    `ColumnPlan`. Column plans are computed once per form version, nested
+    questions are never traversed per submission.
+
+    When `threaded` is `True`, each form version's file is written on its
+    own worker thread, fed through a queue of at most `queue_size`
+    submissions. When `append` is `True`, existing files are appended to
+    instead of being replaced, and the header row is only written to new
+    files. `bytes_written` counts the characters written, which only differs
+    from the bytes written for non ascii values.
+
+    The sink MUST be entered, as a context manager, before submissions are
+    written to it.
+    """
+
+    def __init__(
+            self,
+            out_dir: str,
+            append: bool = False,
+            threaded: bool = False,
+            queue_size: Optional[int] = None
+    ):
+        self._out_dir: str = ensure_not_none_nor_empty(
+            out_dir,
+            message='"out_dir" MUST be provided.'
+        )
+        self._append: bool = append
+        self._threaded: bool = threaded
+        self._queue_size: int = queue_size or _DEFAULT_QUEUE_SIZE
+        assert self._queue_size > 0, '"queue_size" MUST be greater than 0.'
+        self._lock: Lock = Lock()
+        self._entered: bool = False
+        self._writers: Dict[Tuple[str, str], _FormVersionWriter] = dict()
+        self._closed_chars_written: int = 0
+
+    @property
+    def bytes_written(self) -> int:
+        with self._lock:
+            return self._closed_chars_written + sum(
+                _writer.chars_written for _writer in self._writers.values()
+            )
+
+    @property
+    def out_dir(self) -> str:
+        return self._out_dir
+
+    def __enter__(self) -> "CSVSink":
+        LOGGER.debug(
+            'Streaming submissions to csv files in the directory="%s"',
+            self._out_dir
+        )
+        self._entered = True
+        return self
+
+    def __exit__(self, *args) -> None:
+        with self._lock:
+            writers = tuple(self._writers.values())
+            self._writers.clear()
+            self._entered = False
+        error: Optional[BaseException] = None
+        for _writer in writers:
+            try:
+                _writer.close()
+            except BaseException as exp:
+                error = error or exp
+            finally:
+                with self._lock:
+                    self._closed_chars_written += _writer.chars_written
+        if error is not None:
+            raise error
+
+    def execute(self, an_input: _FormSubmission) -> None:
+        form, submission = an_input
+        with self._lock:
+            assert self._entered, (
+                "The sink MUST be entered before submissions are written to "
+                "it."
+            )
+            form_key: Tuple[str, str] = (form.id, form.version)
+            writer: Optional[_FormVersionWriter] = self._writers.get(form_key)
+            if writer is None:
+                writer = _FormVersionWriter(
+                    os.path.join(self._out_dir, _file_name(form)),
+                    get_column_plan(form),
+                    append=self._append,
+                    threaded=self._threaded,
+                    queue_size=self._queue_size
+                )
+                self._writers[form_key] = writer
+            if not self._threaded:
+                writer.write(submission)
+                return
+        # Only the hand off to a worker thread happens outside of the lock,
+        # each writer's queue is thread safe.
+        writer.write(submission)
@@ -0,0 +1,395 @@
+import gzip
+import json
+import logging
+import os
+import shutil
+from contextlib import AbstractContextManager
+from threading import Lock
+from typing import (
+    IO,
+    Any,
+    Dict,
+    Iterator,
+    Mapping,
+    Optional,
+    Sequence,
+    Set,
+    Tuple,
+    cast
+)
+
+from app.core import (
+    InstanceMetadata,
+    PrimaryInstanceDocumentRoot,
+    RichXFormsSubsError,
+    SubmissionDocumentRoot,
+    Task,
+    XForm
+)
+from app.utils import ensure_not_none_nor_empty
+
+# =============================================================================
+# TYPES
+# =============================================================================
+
+_FormSubmission = Tuple[XForm, PrimaryInstanceDocumentRoot]
+
+
+# =============================================================================
+# CONSTANTS
+# =============================================================================
+
+LOGGER = logging.getLogger(__name__)
+
+_DEFAULT_FLUSH_INTERVAL: int = 100
+
+_FORMS_FILE_NAME: str = "forms.ndjson"
+
+_SUBMISSIONS_FILE_NAME: str = "submissions.ndjson"
+
+
+# =============================================================================
+# HELPERS
+# =============================================================================
+
+def _dumps(value: Any) -> str:
+    return json.dumps(
+        value,
+        check_circular=False,
+        ensure_ascii=True,
+        separators=(",", ":")
+    )
+
+
+def _open(file_path: str, mode: str, compress: bool) -> IO[str]:
+    if compress:
+        # Opened in text mode, a gzip file is wrapped in a text wrapper.
+        return cast(IO[str], gzip.open(file_path, mode, encoding="utf-8"))
+    return open(file_path, mode, encoding="utf-8")
+
+
+def _file_paths(out_dir: str, compress: bool) -> Tuple[str, str]:
+    suffix: str = ".gz" if compress else ""
+    return (
+        os.path.join(out_dir, _FORMS_FILE_NAME + suffix),
+        os.path.join(out_dir, _SUBMISSIONS_FILE_NAME + suffix)
+    )
+
+
+def _form_key(line: str) -> Tuple[str, str]:
+    record: Mapping[str, Any] = json.loads(line)
+    return record["form_id"], record["version"]
+
+
+def _read_form_keys(file_path: str, compress: bool) -> Set[Tuple[str, str]]:
+    # The keys of the form versions already on a forms file, if any.
+    if not os.path.exists(file_path):
+        return set()
+    with _open(file_path, "rt", compress) as forms_file:
+        return set(map(_form_key, forms_file))
+
+
+def _merge_unique_forms(
+        file_path: str,
+        source_file_paths: Sequence[str],
+        compress: bool,
+        append: bool
+) -> None:
+    written_forms: Set[Tuple[str, str]] = (
+        _read_form_keys(file_path, compress) if append else set()
+    )
+    with _open(file_path, "at" if append else "wt", compress) as merged_file:
+        for _source_file_path in source_file_paths:
+            if not os.path.exists(_source_file_path):
+                continue
+            with _open(_source_file_path, "rt", compress) as source_file:
+                for _line in source_file:
+                    form_key: Tuple[str, str] = _form_key(_line)
+                    if form_key not in written_forms:
+                        written_forms.add(form_key)
+                        merged_file.write(_line)
+
+
+def merge_ndjson_outputs(
+        out_dir: str,
+        source_dirs: Sequence[str],
+        compress: bool = False,
+        append: bool = False,
+        unique_forms: bool = False
+) -> None:
+    """
+    Concatenate the files written by `NDJSONSink`s for disjoint sets of
+    submissions into a single pair of files.
+
+    The files are copied as they are, without being parsed. Concatenated
+    gzip files are valid gzip files. When `unique_forms` is `True`, the
+    same form versions may be present on several forms files, e.g. files
+    written for disjoint sets of submissions of the same forms. The forms
+    files are then parsed and only the first line of each form version is
+    kept.
+
+    :param out_dir: The directory to write the merged files to.
+    :param source_dirs: The directories of the files to merge, in order.
+           Directories without files are skipped.
+    :param compress: Whether the files to merge are gzip compressed.
+    :param append: Whether to append to the existing files in `out_dir`
+           instead of replacing them.
+    :param unique_forms: Whether to drop repeated form versions from the
+           merged forms file.
+    """
+    forms_file_path: str = _file_paths(out_dir, compress)[0]
+    if unique_forms:
+        _merge_unique_forms(
+            forms_file_path,
+            [
+                os.path.join(
+                    _source_dir,
+                    os.path.basename(forms_file_path)
+                )
+                for _source_dir in source_dirs
+            ],
+            compress=compress,
+            append=append
+        )
+    for _file_path in _file_paths(out_dir, compress):
+        if unique_forms and _file_path == forms_file_path:
+            continue
+        file_name: str = os.path.basename(_file_path)
+        with open(_file_path, "ab" if append else "wb") as merged_file:
+            for _source_dir in source_dirs:
+                source_file_path: str = os.path.join(_source_dir, file_name)
+                if not os.path.exists(source_file_path):
+                    continue
+                with open(source_file_path, "rb") as source_file:
+                    shutil.copyfileobj(source_file, merged_file)
+
+
+def iter_ndjson_submissions(
+        out_dir: str,
+        compress: bool = False
+) -> Iterator[Tuple[XForm, PrimaryInstanceDocumentRoot]]:
+    """
+    Read back the submissions written by an `NDJSONSink`.
+
+    Submissions written in the normalized mode are rehydrated from their
+    form version's submission template, their questions are only built on
+    first access. Uncompressed files may be read while they are still being
+    written to, reading stops at the last complete submission.
+
+    :param out_dir: The directory containing the files to read.
+    :param compress: Whether the files to read are gzip compressed.
+
+    :return: An iterator of each submission, together with its form version,
+             in the order the submissions were written.
+
+    :raise RichXFormsSubsError: If a submission's form version is missing
+           from the forms file.
+    """
+    forms_file_path, submissions_file_path = _file_paths(out_dir, compress)
+    forms: Dict[Tuple[str, str], XForm] = dict()
+    with _open(forms_file_path, "rt", compress) as forms_file, \
+            _open(submissions_file_path, "rt", compress) as submissions_file:
+        for _line in submissions_file:
+            # The last line might still be being written.
+            if not _line.endswith("\n"):
+                break
+            record: Mapping[str, Any] = json.loads(_line)
+            form_key: Tuple[str, str] = (record["form_id"], record["version"])
+            # Form versions are written before any of their submissions, read
+            # the forms file up to the submission's form version.
+            for _form_line in forms_file if form_key not in forms else ():
+                form_record: Mapping[str, Any] = json.loads(_form_line)
+                forms[(form_record["form_id"], form_record["version"])] = (
+                    XForm.of_mapping(form_record["form"])
+                )
+                if form_key in forms:
+                    break
+            form: Optional[XForm] = forms.get(form_key)
+            if form is None:
+                raise RichXFormsSubsError(
+                    'The form with id="%s" and version="%s" was not found on '
+                    'the file="%s".' % (*form_key, forms_file_path)
+                )
+
+            submission: PrimaryInstanceDocumentRoot
+            if "values" in record:
+                document_root: SubmissionDocumentRoot = (
+                    form.submission_template.create_submission()
+                )
+                document_root.set_values(record["values"])
+                document_root.meta = InstanceMetadata.of_mapping(
+                    record["meta"]
+                )
+                submission = document_root
+            else:
+                submission = PrimaryInstanceDocumentRoot.of_mapping(
+                    record["submission"]
+                )
+            yield form, submission
+
+
+# =============================================================================
+# NDJSON SINK
+# =============================================================================
+
+class NDJSONSink(
+    Task[_FormSubmission, None],
+    AbstractContextManager
+):
+    """
+    Stream form submissions to newline delimited json files as they arrive.
+
+    Each submission is written to a `submissions.ndjson` file as a single
+    json object, on its own line, holding the submission's form id, form
+    version and the submission itself. The first time a submission of a form
+    version is received, the form version is written to a `forms.ndjson`
+    file, so that a form version is always available before any of its
+    submissions.
+
+    When `normalized` is `True`, the schema of each form version, i.e. the
+    metadata of each of its questions, is written once alongside the form
+    version and each submission only holds its metadata and a list of its
+    question values indexed by the questions positions on the schema. Use
+    `iter_ndjson_submissions` to read the submissions back in either mode.
+
+    Writes are flushed every `flush_interval` submissions, allowing readers
+    to consume the files while they are being written. When `compress` is
+    `True`, the files are gzip compressed and get a `.gz` suffix. When
+    `append` is `True`, existing files are appended to instead of being
+    replaced, and the form versions already on the existing forms file are
+    not written again. `bytes_written` counts the bytes written, before
+    compression.
+
+    The sink MUST be entered, as a context manager, before submissions are
+    written to it.
+    """
+
+    def __init__(
+            self,
+            out_dir: str,
+            compress: bool = False,
+            append: bool = False,
+            normalized: bool = False,
+            flush_interval: Optional[int] = None
+    ):
+        ensure_not_none_nor_empty(
+            out_dir,
+            message='"out_dir" MUST be provided.'
+        )
+        self._forms_file_path: str
+        self._submissions_file_path: str
+        self._forms_file_path, self._submissions_file_path = _file_paths(
+            out_dir,
+            compress
+        )
+        self._compress: bool = compress
+        self._normalized: bool = normalized
+        self._mode: str = "at" if append else "wt"
+        self._flush_interval: int = flush_interval or _DEFAULT_FLUSH_INTERVAL
+        assert self._flush_interval > 0, (
+            '"flush_interval" MUST be greater than 0.'
+        )
+        self._lock: Lock = Lock()
+        self._forms_file: Optional[IO[str]] = None
+        self._submissions_file: Optional[IO[str]] = None
+        self._written_forms: Set[Tuple[str, str]] = set()
+        self._unflushed_count: int = 0
+        self._bytes_written: int = 0
+
+    @property
+    def bytes_written(self) -> int:
+        return self._bytes_written
+
+    @property
+    def forms_file_path(self) -> str:
+        return self._forms_file_path
+
+    @property
+    def submissions_file_path(self) -> str:
+        return self._submissions_file_path
+
+    def __enter__(self) -> "NDJSONSink":
+        LOGGER.debug(
+            'Streaming submissions to the file="%s"',
+            self._submissions_file_path
+        )
+        if self._mode == "at":
+            self._written_forms.update(
+                _read_form_keys(self._forms_file_path, self._compress)
+            )
+        self._forms_file = _open(
+            self._forms_file_path,
+            self._mode,
+            self._compress
+        )
+        self._submissions_file = _open(
+            self._submissions_file_path,
+            self._mode,
+            self._compress
+        )
+        return self
+
+    def __exit__(self, *args) -> None:
+        with self._lock:
+            for _file in (self._submissions_file, self._forms_file):
+                if _file is not None:
+                    _file.close()
+            self._forms_file = None
+            self._submissions_file = None
+            self._written_forms.clear()
+            self._unflushed_count = 0
+
+    def execute(self, an_input: _FormSubmission) -> None:
+        form, submission = an_input
+        with self._lock:
+            assert self._forms_file is not None and (
+                self._submissions_file is not None
+            ), "The sink MUST be entered before submissions are written to it."
+            form_key: Tuple[str, str] = (form.id, form.version)
+            if form_key not in self._written_forms:
+                # Records are ascii encoded, characters and bytes match.
+                self._bytes_written += self._forms_file.write(
+                    _dumps(self._form_record(form))
+                )
+                self._bytes_written += self._forms_file.write("\n")
+                # Make the form version available before any of its
+                # submissions.
+                self._forms_file.flush()
+                self._written_forms.add(form_key)
+
+            self._bytes_written += self._submissions_file.write(
+                _dumps(self._submission_record(form, submission))
+            )
+            self._bytes_written += self._submissions_file.write("\n")
+            self._unflushed_count += 1
+            if self._unflushed_count >= self._flush_interval:
+                self._submissions_file.flush()
+                self._unflushed_count = 0
+
+    def _form_record(self, form: XForm) -> Mapping[str, Any]:
+        record: Dict[str, Any] = {
+            "form_id": form.id,
+            "version": form.version,
+            "form": form.to_json()
+        }
+        if self._normalized:
+            record["schema"] = form.submission_template.to_schema()
+        return record
+
+    def _submission_record(
+            self,
+            form: XForm,
+            submission: PrimaryInstanceDocumentRoot
+    ) -> Mapping[str, Any]:
+        if not self._normalized:
+            return {
+                "form_id": form.id,
+                "version": form.version,
+                "submission": submission.to_json()
+            }
+        return {
+            "form_id": form.id,
+            "version": form.version,
+            "meta": submission.meta.to_json(),
+            "values": form.submission_template.get_values(submission)
+        }
@@ -0,0 +1,430 @@
+import json
+import logging
+import os
+import sqlite3
+from contextlib import AbstractContextManager
+from threading import Lock
+from typing import Any, Dict, List, Optional, Sequence, Set, Tuple
+
+from app.core import PrimaryInstanceDocumentRoot, Task, XForm
+from app.utils import ensure_not_none_nor_empty
+
+from .column_plan import ColumnPlan, get_column_plan
+
+# =============================================================================
+# TYPES
+# =============================================================================
+
+_FormSubmission = Tuple[XForm, PrimaryInstanceDocumentRoot]
+
+
+# =============================================================================
+# CONSTANTS
+# =============================================================================
+
+LOGGER = logging.getLogger(__name__)
+
+_BUSY_TIMEOUT: float = 60.0
+
+_DEFAULT_BATCH_SIZE: int = 1000
+
+_FORMS_TABLE_DDL: str = """
+CREATE TABLE IF NOT EXISTS "forms" (
+    "form_id" TEXT NOT NULL,
+    "version" TEXT NOT NULL,
+    "table_name" TEXT NOT NULL UNIQUE,
+    "title" TEXT,
+    "form" TEXT NOT NULL,
+    PRIMARY KEY ("form_id", "version")
+)
+"""
+
+_FORM_COLUMNS_TABLE_DDL: str = """
+CREATE TABLE IF NOT EXISTS "form_columns" (
+    "table_name" TEXT NOT NULL,
+    "column_index" INTEGER NOT NULL,
+    "column_name" TEXT NOT NULL,
+    "label" TEXT NOT NULL,
+    PRIMARY KEY ("table_name", "column_index")
+)
+"""
+
+_UPSERT_FORM_SQL: str = """
+INSERT INTO "forms" ("form_id", "version", "table_name", "title", "form")
+VALUES (?, ?, ?, ?, ?)
+ON CONFLICT ("form_id", "version") DO UPDATE SET
+    "title" = excluded."title",
+    "form" = excluded."form"
+"""
+
+_UPSERT_FORM_COLUMN_SQL: str = """
+INSERT INTO "form_columns" (
+    "table_name", "column_index", "column_name", "label"
+)
+VALUES (?, ?, ?, ?)
+ON CONFLICT ("table_name", "column_index") DO UPDATE SET
+    "label" = excluded."label"
+"""
+
+_SELECT_TABLE_NAME_SQL: str = """
+SELECT "table_name" FROM "forms" WHERE "form_id" = ? AND "version" = ?
+"""
+
+
+# =============================================================================
+# HELPERS
+# =============================================================================
+
+def _quote(identifier: str) -> str:
+    return '"%s"' % identifier.replace('"', '""')
+
+
+def _to_column_value(value: Any) -> Any:
+    if value is None or isinstance(value, (str, bool, int, float)):
+        return value
+    return json.dumps(value)
+
+
+def _upsert_sql(
+        table_name: str,
+        columns: Sequence[str],
+        source_table: Optional[str] = None
+) -> str:
+    # Upsert the statement's parameters or, when a (quoted) source table is
+    # given, all the rows of the source table. The first column is always
+    # the instance id.
+    quoted_columns: Sequence[str] = tuple(map(_quote, columns))
+    values: str = (
+        "VALUES (%s)" % ", ".join("?" * len(quoted_columns))
+        if source_table is None
+        # The WHERE clause disambiguates the upsert's ON CONFLICT clause.
+        else "SELECT %s FROM %s WHERE true" % (
+            ", ".join(quoted_columns),
+            source_table
+        )
+    )
+    return "INSERT INTO %s (%s) %s ON CONFLICT (%s) DO UPDATE SET %s" % (
+        _quote(table_name),
+        ", ".join(quoted_columns),
+        values,
+        quoted_columns[0],
+        ", ".join(
+            "%s = excluded.%s" % (_column, _column)
+            for _column in quoted_columns[1:]
+        )
+    )
+
+
+def _get_table_name(
+        connection: sqlite3.Connection,
+        form_id: str,
+        version: str
+) -> str:
+    row: Optional[Tuple[str]] = connection.execute(
+        _SELECT_TABLE_NAME_SQL,
+        (form_id, version)
+    ).fetchone()
+    if row is not None:
+        return row[0]
+    # Table names are case insensitive and form ids and versions might not
+    # be unique once joined.
+    taken_names: Set[str] = {
+        _name.lower()
+        for (_name,) in connection.execute('SELECT "table_name" FROM "forms"')
+    }
+    table_name: str = "%s_v%s" % (form_id, version)
+    candidate: str = table_name
+    index: int = 1
+    while candidate.lower() in taken_names or (
+            candidate.lower() in ("forms", "form_columns")
+    ):
+        index += 1
+        candidate = "%s~%d" % (table_name, index)
+    return candidate
+
+
+def _register_table(
+        connection: sqlite3.Connection,
+        form_id: str,
+        version: str,
+        title: Optional[str],
+        form_json: str,
+        columns: Sequence[str],
+        labels: Sequence[str]
+) -> str:
+    # Create the table of a form version, if missing, and record it on the
+    # metadata tables. MUST be called within a transaction.
+    table_name: str = _get_table_name(connection, form_id, version)
+    quoted_columns: Sequence[str] = tuple(map(_quote, columns))
+    connection.execute(
+        "CREATE TABLE IF NOT EXISTS %s (%s)" % (
+            _quote(table_name),
+            ", ".join(
+                ("%s TEXT PRIMARY KEY" % quoted_columns[0],) +
+                tuple(quoted_columns[1:])
+            )
+        )
+    )
+    connection.execute(
+        _UPSERT_FORM_SQL,
+        (form_id, version, table_name, title, form_json)
+    )
+    connection.executemany(
+        _UPSERT_FORM_COLUMN_SQL,
+        (
+            (table_name, _index, _column, _label)
+            for _index, (_column, _label) in enumerate(zip(columns, labels))
+        )
+    )
+    return table_name
+
+
+def _open_database(file_path: str) -> sqlite3.Connection:
+    # Transactions are managed explicitly. Other writers, e.g. other
+    # processes, are waited on for up to the timeout.
+    connection: sqlite3.Connection = sqlite3.connect(
+        file_path,
+        check_same_thread=False,
+        isolation_level=None,
+        timeout=_BUSY_TIMEOUT
+    )
+    connection.execute("PRAGMA journal_mode = WAL")
+    connection.execute("PRAGMA synchronous = NORMAL")
+    connection.execute(_FORMS_TABLE_DDL)
+    connection.execute(_FORM_COLUMNS_TABLE_DDL)
+    return connection
+
+
+def merge_sqlite_databases(
+        file_path: str,
+        source_file_paths: Sequence[str]
+) -> None:
+    """
+    Upsert the contents of databases written by `SQLiteSink` into another.
+
+    The tables of the form versions missing from the target database are
+    created and the submissions already on the target database are updated
+    in place. Each source database is merged in its own transaction.
+
+    :param file_path: The database to merge into. Created if missing.
+    :param source_file_paths: The databases to merge, in order.
+    """
+    connection: sqlite3.Connection = _open_database(file_path)
+    try:
+        for _source_file_path in source_file_paths:
+            LOGGER.debug(
+                'Merging the database="%s" into the database="%s"',
+                _source_file_path,
+                file_path
+            )
+            connection.execute(
+                'ATTACH DATABASE ? AS "source"',
+                (_source_file_path,)
+            )
+            try:
+                connection.execute("BEGIN IMMEDIATE")
+                try:
+                    _merge_attached_database(connection)
+                    connection.execute("COMMIT")
+                except BaseException:
+                    connection.execute("ROLLBACK")
+                    raise
+            finally:
+                connection.execute('DETACH DATABASE "source"')
+    finally:
+        connection.close()
+
+
+def _merge_attached_database(connection: sqlite3.Connection) -> None:
+    forms: Sequence[Tuple[str, str, str, Optional[str], str]] = (
+        connection.execute(
+            'SELECT "form_id", "version", "table_name", "title", "form" '
+            'FROM "source"."forms"'
+        ).fetchall()
+    )
+    for _form_id, _version, _source_table, _title, _form_json in forms:
+        columns: Sequence[Tuple[str, str]] = connection.execute(
+            'SELECT "column_name", "label" FROM "source"."form_columns" '
+            'WHERE "table_name" = ? ORDER BY "column_index"',
+            (_source_table,)
+        ).fetchall()
+        table_name: str = _register_table(
+            connection,
+            _form_id,
+            _version,
+            _title,
+            _form_json,
+            [_column for _column, _ in columns],
+            [_label for _, _label in columns]
+        )
+        connection.execute(
+            _upsert_sql(
+                table_name,
+                [_column for _column, _ in columns],
+                source_table='"source".%s' % _quote(_source_table)
+            )
+        )
+
+
+class _FormVersionTable:
+    """
+    The table holding the submissions of a single form version, keyed by
+    the submissions instance ids, with a column per column of the form
+    version's column plan.
+    """
+
+    def __init__(self, table_name: str, plan: ColumnPlan):
+        self.table_name: str = table_name
+        self.plan: ColumnPlan = plan
+        self.pending_rows: List[Sequence[Any]] = []
+        self.upsert_sql: str = _upsert_sql(table_name, plan.xpaths)
+
+    def add(self, submission: PrimaryInstanceDocumentRoot) -> None:
+        self.pending_rows.append(
+            list(map(_to_column_value, self.plan.get_row(submission)))
+        )
+
+
+# =============================================================================
+# SQLITE SINK
+# =============================================================================
+
+class SQLiteSink(Task[_FormSubmission, None], AbstractContextManager):
+    """
+    A submission consumer that upserts submissions into a SQLite database.
+
+    The submissions of each form version are stored on their own table,
+    keyed by the submissions instance ids, with a column per column of the
+    form version's `ColumnPlan`, named after the question's xpath. The
+    `forms` table maps each form version to its table and holds the form
+    version itself, as json, while the `form_columns` table holds the label
+    of each column of each table.
+
+    Submissions are buffered and written in batches of `batch_size`, each
+    batch in a single transaction. Submissions already on the database are
+    updated in place, so re-running an export against the same database
+    only writes the changes. The database is opened in WAL mode, allowing
+    readers to query it while it is being written to. Use
+    `merge_sqlite_databases` to combine databases written separately.
+    `bytes_written` is the growth of the database, and of its write-ahead
+    log, since the sink was entered.
+
+    The sink MUST be entered, as a context manager, before submissions are
+    written to it.
+    """
+
+    def __init__(self, file_path: str, batch_size: Optional[int] = None):
+        self._file_path: str = ensure_not_none_nor_empty(
+            file_path,
+            message='"file_path" MUST be provided.'
+        )
+        self._batch_size: int = batch_size or _DEFAULT_BATCH_SIZE
+        assert self._batch_size > 0, '"batch_size" MUST be greater than 0.'
+        self._lock: Lock = Lock()
+        self._connection: Optional[sqlite3.Connection] = None
+        self._tables: Dict[Tuple[str, str], _FormVersionTable] = dict()
+        self._pending_count: int = 0
+        self._initial_size: int = 0
+        self._bytes_written: int = 0
+
+    @property
+    def bytes_written(self) -> int:
+        return self._bytes_written
+
+    @property
+    def file_path(self) -> str:
+        return self._file_path
+
+    def __enter__(self) -> "SQLiteSink":
+        LOGGER.debug(
+            'Writing submissions to the database="%s"',
+            self._file_path
+        )
+        self._connection = _open_database(self._file_path)
+        self._initial_size = self._get_size()
+        self._bytes_written = 0
+        return self
+
+    def __exit__(self, *args) -> None:
+        with self._lock:
+            if self._connection is None:
+                return
+            try:
+                self._flush()
+            finally:
+                self._connection.close()
+                self._connection = None
+                self._tables.clear()
+                self._pending_count = 0
+
+    def execute(self, an_input: _FormSubmission) -> None:
+        form, submission = an_input
+        with self._lock:
+            assert self._connection is not None, (
+                "The sink MUST be entered before submissions are written to "
+                "it."
+            )
+            form_key: Tuple[str, str] = (form.id, form.version)
+            table: Optional[_FormVersionTable] = self._tables.get(form_key)
+            if table is None:
+                table = self._create_table(form)
+                self._tables[form_key] = table
+            table.add(submission)
+            self._pending_count += 1
+            if self._pending_count >= self._batch_size:
+                self._flush()
+
+    def _create_table(self, form: XForm) -> _FormVersionTable:
+        assert self._connection is not None
+        plan: ColumnPlan = get_column_plan(form)
+        # Other writers MUST not claim the table's name before it's created.
+        self._connection.execute("BEGIN IMMEDIATE")
+        try:
+            table_name: str = _register_table(
+                self._connection,
+                form.id,
+                form.version,
+                form.title,
+                json.dumps(form.to_json()),
+                plan.xpaths,
+                plan.headers
+            )
+            self._connection.execute("COMMIT")
+        except BaseException:
+            self._connection.execute("ROLLBACK")
+            raise
+        return _FormVersionTable(table_name, plan)
+
+    def _flush(self) -> None:
+        assert self._connection is not None
+        if not self._pending_count:
+            return
+        LOGGER.debug(
+            'Writing %d submissions to the database="%s"',
+            self._pending_count,
+            self._file_path
+        )
+        self._connection.execute("BEGIN IMMEDIATE")
+        try:
+            for _table in self._tables.values():
+                if _table.pending_rows:
+                    self._connection.executemany(
+                        _table.upsert_sql,
+                        _table.pending_rows
+                    )
+            self._connection.execute("COMMIT")
+        except BaseException:
+            self._connection.execute("ROLLBACK")
+            raise
+        finally:
+            for _table in self._tables.values():
+                _table.pending_rows.clear()
+            self._pending_count = 0
+            self._bytes_written = max(self._get_size() - self._initial_size, 0)
+
+    def _get_size(self) -> int:
+        return sum(
+            os.path.getsize(_file_path)
+            for _file_path in (self._file_path, "%s-wal" % self._file_path)
+            if os.path.exists(_file_path)
+        )
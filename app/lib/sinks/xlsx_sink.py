@@ -0,0 +1,215 @@
+import json
+import logging
+import os
+from contextlib import AbstractContextManager
+from threading import Lock
+from typing import Any, Dict, List, Optional, Sequence, Set, Tuple
+
+from openpyxl import Workbook, load_workbook
+from openpyxl.cell.cell import ILLEGAL_CHARACTERS_RE
+from openpyxl.workbook.child import INVALID_TITLE_REGEX
+from openpyxl.worksheet._write_only import WriteOnlyWorksheet
+
+from app.core import PrimaryInstanceDocumentRoot, Task, XForm
+from app.utils import ensure_not_none_nor_empty
+
+from .column_plan import ColumnPlan, get_column_plan
+
+# =============================================================================
+# TYPES
+# =============================================================================
+
+_FormSubmission = Tuple[XForm, PrimaryInstanceDocumentRoot]
+
+_Sheet = Tuple[WriteOnlyWorksheet, ColumnPlan]
+
+
+# =============================================================================
+# CONSTANTS
+# =============================================================================
+
+LOGGER = logging.getLogger(__name__)
+
+_EMPTY_SHEET_TITLE: str = "Submissions"
+
+_MAX_SHEET_TITLE_LENGTH: int = 31
+
+
+# =============================================================================
+# HELPERS
+# =============================================================================
+
+def _to_cell_value(value: Any) -> Any:
+    if value is None or isinstance(value, (bool, int, float)):
+        return value
+    if isinstance(value, str):
+        return ILLEGAL_CHARACTERS_RE.sub("", value)
+    return ILLEGAL_CHARACTERS_RE.sub("", json.dumps(value))
+
+
+def _sheet_title(form: XForm, taken_titles: Set[str]) -> str:
+    return _unique_sheet_title(
+        INVALID_TITLE_REGEX.sub("_", "%s v%s" % (form.id, form.version)),
+        taken_titles
+    )
+
+
+def _unique_sheet_title(title: str, taken_titles: Set[str]) -> str:
+    title = title[:_MAX_SHEET_TITLE_LENGTH]
+    index: int = 1
+    while title.lower() in taken_titles:
+        index += 1
+        suffix: str = "~%d" % index
+        title = title[:_MAX_SHEET_TITLE_LENGTH - len(suffix)] + suffix
+    return title
+
+
+def merge_xlsx_workbooks(
+        file_path: str,
+        source_file_paths: Sequence[str],
+        combine_sheets: bool = False
+) -> None:
+    """
+    Combine the worksheets of workbooks written by `XLSXSink`s into a single
+    workbook.
+
+    The workbooks are read and written in openpyxl's read-only and
+    write-only modes, one row at a time. Empty worksheets are dropped and
+    worksheets whose titles are already taken are renamed, unless
+    `combine_sheets` is `True`. The rows of worksheets with the same title,
+    e.g. worksheets written for disjoint sets of submissions of the same
+    form version, are then appended to a single worksheet, less their
+    header rows.
+
+    :param file_path: The workbook to write. Replaced if it exists.
+    :param source_file_paths: The workbooks to combine, in order. Missing
+           workbooks are skipped.
+    :param combine_sheets: Whether to combine worksheets with the same
+           title instead of renaming them.
+    """
+    workbook: Workbook = Workbook(write_only=True)
+    taken_titles: Set[str] = set()
+    # Write-only worksheets can be appended to in any order, each is
+    # streamed to its own temporary file.
+    worksheets: Dict[str, WriteOnlyWorksheet] = dict()
+    for _source_file_path in source_file_paths:
+        if not os.path.exists(_source_file_path):
+            continue
+        source_workbook = load_workbook(_source_file_path, read_only=True)
+        try:
+            for _source_sheet in source_workbook.worksheets:
+                rows = _source_sheet.iter_rows(values_only=True)
+                header: Optional[Tuple[Any, ...]] = next(rows, None)
+                if header is None:
+                    continue
+                existing_worksheet: Optional[WriteOnlyWorksheet] = (
+                    worksheets.get(_source_sheet.title.lower())
+                    if combine_sheets else None
+                )
+                worksheet: WriteOnlyWorksheet
+                if existing_worksheet is None:
+                    title: str = _unique_sheet_title(
+                        _source_sheet.title,
+                        taken_titles
+                    )
+                    taken_titles.add(title.lower())
+                    worksheet = workbook.create_sheet(title)
+                    worksheets[title.lower()] = worksheet
+                    worksheet.append(list(header))
+                else:
+                    worksheet = existing_worksheet
+                for _row in rows:
+                    worksheet.append(list(_row))
+        finally:
+            source_workbook.close()
+    if not taken_titles:
+        workbook.create_sheet(_EMPTY_SHEET_TITLE)
+    workbook.save(file_path)
+
+
+# =============================================================================
+# XLSX SINK
+# =============================================================================
+
+class XLSXSink(Task[_FormSubmission, None], AbstractContextManager):
+    """
+    A submission consumer that streams submissions to an XLSX workbook.
+
+    Each form version is written to its own worksheet, with a header row of
+    the form version's question labels followed by a row per submission, see
+    `ColumnPlan`. The workbook is created in openpyxl's write-only mode, rows
+    are streamed to temporary files as they are received instead of being
+    kept in memory, and the workbook is assembled and saved to the given file
+    when the sink is exited. `bytes_written` is the size of the saved
+    workbook, it remains 0 until the sink is exited.
+
+    The sink MUST be entered, as a context manager, before submissions are
+    written to it.
+    """
+
+    def __init__(self, file_path: str):
+        self._file_path: str = ensure_not_none_nor_empty(
+            file_path,
+            message='"file_path" MUST be provided.'
+        )
+        self._lock: Lock = Lock()
+        self._workbook: Optional[Workbook] = None
+        self._sheets: Dict[Tuple[str, str], _Sheet] = dict()
+        self._sheet_titles: Set[str] = set()
+        self._bytes_written: int = 0
+
+    @property
+    def bytes_written(self) -> int:
+        return self._bytes_written
+
+    @property
+    def file_path(self) -> str:
+        return self._file_path
+
+    def __enter__(self) -> "XLSXSink":
+        LOGGER.debug(
+            'Streaming submissions to the file="%s"',
+            self._file_path
+        )
+        self._workbook = Workbook(write_only=True)
+        return self
+
+    def __exit__(self, *args) -> None:
+        with self._lock:
+            if self._workbook is None:
+                return
+            if not self._sheets:
+                self._workbook.create_sheet(_EMPTY_SHEET_TITLE)
+            LOGGER.debug('Saving the workbook="%s"', self._file_path)
+            try:
+                self._workbook.save(self._file_path)
+                self._bytes_written += os.path.getsize(self._file_path)
+            finally:
+                self._workbook = None
+                self._sheets.clear()
+                self._sheet_titles.clear()
+
+    def execute(self, an_input: _FormSubmission) -> None:
+        form, submission = an_input
+        with self._lock:
+            assert self._workbook is not None, (
+                "The sink MUST be entered before submissions are written to "
+                "it."
+            )
+            form_key: Tuple[str, str] = (form.id, form.version)
+            sheet: Optional[_Sheet] = self._sheets.get(form_key)
+            if sheet is None:
+                sheet = self._create_sheet(form)
+                self._sheets[form_key] = sheet
+            worksheet, plan = sheet
+            row: List[Any] = plan.get_row(submission)
+            worksheet.append(list(map(_to_cell_value, row)))
+
+    def _create_sheet(self, form: XForm) -> _Sheet:
+        assert self._workbook is not None
+        title: str = _sheet_title(form, self._sheet_titles)
+        self._sheet_titles.add(title.lower())
+        worksheet: WriteOnlyWorksheet = self._workbook.create_sheet(title)
+        plan: ColumnPlan = get_column_plan(form)
+        worksheet.append(list(plan.headers))
+        return worksheet, plan
@@ -0,0 +1,7 @@
+from .sync_state_store import FormWatermark, SyncStateStore
+
+
+__all__ = [
+    "FormWatermark",
+    "SyncStateStore"
+]
@@ -0,0 +1,152 @@
+import json
+import logging
+import os
+from datetime import datetime
+from threading import Lock
+from typing import (
+    Any,
+    Dict,
+    FrozenSet,
+    Iterable,
+    List,
+    Mapping,
+    Optional,
+    Set,
+    TypedDict
+)
+
+from app.utils import ensure_not_none_nor_empty
+
+# =============================================================================
+# TYPES
+# =============================================================================
+
+class FormWatermark(TypedDict):
+    # ISO 8601 formatted, timezone aware datetime of the start of the last
+    # successful sync of the form's submissions.
+    last_synced_at: str
+    # The instance ids of all the submissions of the form synced so far.
+    instance_ids: List[str]
+
+
+# =============================================================================
+# CONSTANTS
+# =============================================================================
+
+LOGGER = logging.getLogger(__name__)
+
+_STATE_FORMAT_VERSION: int = 1
+
+
+# =============================================================================
+# SYNC STATE STORE
+# =============================================================================
+
+class SyncStateStore:
+    """
+    A local, json file backed store of the per form high-water marks used to
+    incrementally sync form submissions.
+
+    The state is loaded from the given file on initialization, if the file
+    exists, and is only written back to the file when `save` is called.
+    Writes are atomic, an interrupted save leaves the previous state intact.
+    """
+
+    def __init__(self, file_path: str):
+        self._file_path: str = ensure_not_none_nor_empty(
+            file_path,
+            message='"file_path" MUST be provided.'
+        )
+        self._lock: Lock = Lock()
+        self._watermarks: Dict[str, FormWatermark] = self._load()
+
+    @property
+    def file_path(self) -> str:
+        return self._file_path
+
+    def get_watermark(self, form_id: str) -> Optional[FormWatermark]:
+        return self._watermarks.get(form_id)
+
+    def get_last_synced_at(self, form_id: str) -> Optional[datetime]:
+        watermark: Optional[FormWatermark] = self.get_watermark(form_id)
+        if watermark is None:
+            return None
+        return datetime.fromisoformat(watermark["last_synced_at"])
+
+    def get_instance_ids(self, form_id: str) -> FrozenSet[str]:
+        watermark: Optional[FormWatermark] = self.get_watermark(form_id)
+        return frozenset(watermark["instance_ids"] if watermark else ())
+
+    def update_watermark(
+            self,
+            form_id: str,
+            synced_at: datetime,
+            instance_ids: Iterable[str]
+    ) -> None:
+        """Advance the high-water mark of a form.
+
+        :param form_id: The id of the form whose high-water mark to advance.
+        :param synced_at: A timezone aware datetime of when the sync of the
+               form's submissions started.
+        :param instance_ids: The instance ids of the submissions synced. These
+               are added to the instance ids already seen for the form.
+        """
+        assert synced_at.tzinfo is not None, '"synced_at" MUST be tz aware.'
+        with self._lock:
+            known_ids: List[str] = list(
+                self._watermarks.get(form_id, {}).get("instance_ids", [])
+            )
+            known_ids_set: Set[str] = set(known_ids)
+            for _instance_id in instance_ids:
+                if _instance_id not in known_ids_set:
+                    known_ids_set.add(_instance_id)
+                    known_ids.append(_instance_id)
+            self._watermarks[form_id] = {
+                "last_synced_at": synced_at.isoformat(),
+                "instance_ids": known_ids
+            }
+
+    def merge(
+            self,
+            other: "SyncStateStore",
+            form_ids: Optional[Iterable[str]] = None
+    ) -> None:
+        """Replace the high-water marks of forms with those of another store.
+
+        :param other: The store whose high-water marks to take.
+        :param form_ids: The ids of the forms whose high-water marks to take.
+               Defaults to all the forms on the other store. Forms without a
+               high-water mark on the other store are left as they are.
+        """
+        with self._lock:
+            for _form_id in (
+                    tuple(other._watermarks) if form_ids is None else form_ids
+            ):
+                watermark: Optional[FormWatermark] = other.get_watermark(
+                    _form_id
+                )
+                if watermark is not None:
+                    self._watermarks[_form_id] = watermark
+
+    def save(self) -> None:
+        LOGGER.debug('Persisting sync state to the file="%s"', self._file_path)
+        with self._lock:
+            state: Mapping[str, Any] = {
+                "version": _STATE_FORMAT_VERSION,
+                "forms": self._watermarks
+            }
+            temp_file_path: str = "%s.tmp" % self._file_path
+            with open(temp_file_path, "w") as state_file:
+                json.dump(state, state_file, ensure_ascii=True)
+            os.replace(temp_file_path, self._file_path)
+
+    def _load(self) -> Dict[str, FormWatermark]:
+        if not os.path.exists(self._file_path):
+            LOGGER.info(
+                'No sync state found at "%s", a full sync will be performed.',
+                self._file_path
+            )
+            return dict()
+        with open(self._file_path, "rb") as state_file:
+            state: Mapping[str, Any] = json.load(state_file)
+        return dict(state.get("forms", {}))
@@ -1,11 +1,25 @@
 from .from_mixins import ItemFromMapping, ItemToJson
-from .generic import Chainable, Consumer, Pipeline
+from .generic import (
+    Chainable,
+    Consumer,
+    FlatMap,
+    Pipeline,
+    PipelineHook,
+    Stage,
+    StreamingPipeline,
+    ThreadedStreamingPipeline
+)
 
 
 __all__ = [
     "Chainable",
     "Consumer",
+    "FlatMap",
     "ItemFromMapping",
     "ItemToJson",
-    "Pipeline"
+    "Pipeline",
+    "PipelineHook",
+    "Stage",
+    "StreamingPipeline",
+    "ThreadedStreamingPipeline"
 ]
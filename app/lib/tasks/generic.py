@@ -1,8 +1,15 @@
+from contextlib import AbstractContextManager, ExitStack
 from functools import reduce
+from queue import Empty, Full, Queue
+from threading import Event, Lock, Thread
 from typing import (
     Any,
     Callable,
     Generic,
+    Iterable,
+    Iterator,
+    List,
+    Optional,
     Sequence,
     TypeVar,
     cast
@@ -19,6 +26,174 @@ _IN = TypeVar("_IN")
 _RT = TypeVar("_RT")
 
 
+# =============================================================================
+# CONSTANTS
+# =============================================================================
+
+_DEFAULT_STAGE_QUEUE_SIZE: int = 100
+
+# How often, in seconds, blocked stage workers check whether the stream they
+# are part of has been cancelled.
+_POLL_INTERVAL: float = 0.1
+
+# Marks the end of the items on a stage queue.
+_END_OF_STREAM: Any = object()
+
+
+# =============================================================================
+# HELPERS
+# =============================================================================
+
+class _StreamCancelled(Exception):
+    """Raised on stage workers once the stream they are part of is over."""
+
+
+class _StreamState:
+    """The state shared by the workers of a threaded stream."""
+
+    def __init__(self):
+        self.cancelled: Event = Event()
+        self.error: Optional[BaseException] = None
+        self._lock: Lock = Lock()
+
+    def fail(self, error: BaseException) -> None:
+        with self._lock:
+            if self.error is None:
+                self.error = error
+        self.cancelled.set()
+
+
+def _put(queue: "Queue[Any]", item: Any, state: _StreamState) -> None:
+    # Block while the queue is full, applying backpressure to the producer,
+    # for as long as the stream isn't cancelled.
+    while True:
+        if state.cancelled.is_set():
+            raise _StreamCancelled()
+        try:
+            queue.put(item, timeout=_POLL_INTERVAL)
+            return
+        except Full:
+            continue
+
+
+def _iter_queue(queue: "Queue[Any]", state: _StreamState) -> Iterator[Any]:
+    while True:
+        if state.cancelled.is_set():
+            raise _StreamCancelled()
+        try:
+            item: Any = queue.get(timeout=_POLL_INTERVAL)
+        except Empty:
+            continue
+        if item is _END_OF_STREAM:
+            # Let the other workers reading from the same queue know.
+            _put(queue, _END_OF_STREAM, state)
+            return
+        yield item
+
+
+def _run_task(
+        pipeline: Task[Any, Any],
+        hooks: Sequence["PipelineHook"],
+        task: Task[Any, Any],
+        an_input: Any
+) -> Any:
+    for _hook in hooks:
+        _hook.before_task(pipeline, task, an_input)
+    try:
+        result: Any = task.execute(an_input)
+    except BaseException as exp:
+        for _hook in hooks:
+            _hook.on_task_error(pipeline, task, an_input, exp)
+        raise
+    for _hook in hooks:
+        _hook.after_task(pipeline, task, an_input, result)
+    return result
+
+
+# =============================================================================
+# PIPELINE HOOKS
+# =============================================================================
+
+class PipelineHook:
+    """
+    Receives the events of the pipelines it is added to, e.g. to collect
+    metrics about the tasks of the pipelines.
+
+    Every task execution is preceded by a `before_task` event and followed by
+    either an `after_task` or an `on_task_error` event. Tasks of streaming
+    pipelines are executed once per item and, in the case of `FlatMap`
+    tasks, once per result plus once for the end of the results. Each item
+    yielded by a task of a streaming pipeline is also reported through an
+    `on_item` event. Tasks wrapped on a `Stage` are reported as the stage.
+
+    Events are delivered on the threads executing the tasks, possibly
+    concurrently, and nested pipelines deliver their events while the task
+    of the outer pipeline running them is still executing. All events are
+    ignored by default, subclasses override the ones they need.
+    """
+
+    def before_task(
+            self,
+            pipeline: Task[Any, Any],
+            task: Task[Any, Any],
+            an_input: Any
+    ) -> None:
+        """Called before a task is executed.
+
+        :param pipeline: The pipeline executing the task.
+        :param task: The task about to be executed.
+        :param an_input: The input the task is about to be executed with.
+        """
+        ...
+
+    def after_task(
+            self,
+            pipeline: Task[Any, Any],
+            task: Task[Any, Any],
+            an_input: Any,
+            result: Any
+    ) -> None:
+        """Called after a task is successfully executed.
+
+        :param pipeline: The pipeline executing the task.
+        :param task: The task executed.
+        :param an_input: The input the task was executed with.
+        :param result: The result of the task, `None` at the end of the
+               results of a `FlatMap` task.
+        """
+        ...
+
+    def on_task_error(
+            self,
+            pipeline: Task[Any, Any],
+            task: Task[Any, Any],
+            an_input: Any,
+            error: BaseException
+    ) -> None:
+        """Called after a task fails. The error is re-raised afterwards.
+
+        :param pipeline: The pipeline executing the task.
+        :param task: The task that failed.
+        :param an_input: The input the task was executed with.
+        :param error: The error raised by the task.
+        """
+        ...
+
+    def on_item(
+            self,
+            pipeline: Task[Any, Any],
+            task: Task[Any, Any],
+            item: Any
+    ) -> None:
+        """Called for each item yielded by a task of a streaming pipeline.
+
+        :param pipeline: The streaming pipeline executing the task.
+        :param task: The task that yielded the item.
+        :param item: The item yielded.
+        """
+        ...
+
+
 # =============================================================================
 # ITEM PROCESSORS
 # =============================================================================
@@ -52,18 +227,48 @@ class Consumer(Generic[_IN], Task[_IN, _IN]):
 
 
 class Pipeline(Generic[_IN, _RT], Task[_IN, _RT]):
+    """
+    A pipeline that hands its input to its first task and the result of each
+    task to the next one, returning the result of the last task.
+
+    The given `hooks`, and those added later through `add_hook`, receive the
+    events of the pipeline's tasks, see `PipelineHook`.
+    """
 
-    def __init__(self, *tasks: Task[Any, Any]):
+    def __init__(
+            self,
+            *tasks: Task[Any, Any],
+            hooks: Sequence[PipelineHook] = tuple()
+    ):
         assert tasks, "tasks cannot be None or empty."
         self._tasks: Sequence[Task[Any, Any]] = tuple(tasks)
+        self._hooks: List[PipelineHook] = list(hooks)
 
     @property
     def tasks(self) -> Sequence[Task[Any, Any]]:
         return self._tasks
 
+    @property
+    def hooks(self) -> Sequence[PipelineHook]:
+        return tuple(self._hooks)
+
+    def add_hook(self, hook: PipelineHook) -> None:
+        assert hook, "hook cannot be None."
+        self._hooks.append(hook)
+
     def execute(self, an_input: _IN) -> _RT:
         _acc: Any
         _tsk: Task[Any, Any]
+        hooks: Sequence[PipelineHook] = tuple(self._hooks)
+        if hooks:
+            return cast(
+                _RT,
+                reduce(
+                    lambda _acc, _tsk: _run_task(self, hooks, _tsk, _acc),
+                    self.tasks,
+                    an_input
+                )
+            )
         return cast(
             _RT,
             reduce(
@@ -72,3 +277,293 @@ class Pipeline(Generic[_IN, _RT], Task[_IN, _RT]):
                 self.tasks[0].execute(an_input)
             )
         )
+
+
+class FlatMap(Generic[_IN, _RT], Task[_IN, Iterable[_RT]]):
+    """
+    A task that maps each input to zero or more results.
+
+    On a `StreamingPipeline`, the results of a flat map are streamed to the
+    next task one at a time instead of as a single item.
+    """
+
+    def __init__(self, map_item: Callable[[_IN], Iterable[_RT]]):
+        assert map_item, "map_item cannot be None."
+        self._map_item: Callable[[_IN], Iterable[_RT]] = map_item
+
+    def execute(self, an_input: _IN) -> Iterable[_RT]:
+        return self._map_item(an_input)
+
+
+class Stage(Generic[_IN, _RT], Task[_IN, _RT]):
+    """
+    A task of a streaming pipeline together with how it should be executed
+    by a `ThreadedStreamingPipeline`.
+
+    The task is run on `workers` threads, reading its inputs from a queue
+    holding at most `queue_size` items. Other pipelines execute the wrapped
+    task as if it wasn't wrapped. The stage's `name`, which defaults to the
+    name of the task's class, identifies the task on pipeline hooks.
+    """
+
+    def __init__(
+            self,
+            task: Task[_IN, _RT],
+            workers: int = 1,
+            queue_size: Optional[int] = None,
+            name: Optional[str] = None
+    ):
+        assert task, "task cannot be None."
+        self._task: Task[_IN, _RT] = task
+        self._name: str = name or type(task).__name__
+        self._workers: int = workers
+        self._queue_size: int = queue_size or _DEFAULT_STAGE_QUEUE_SIZE
+        assert self._workers > 0, '"workers" MUST be greater than 0.'
+        assert self._queue_size > 0, '"queue_size" MUST be greater than 0.'
+
+    @property
+    def task(self) -> Task[_IN, _RT]:
+        return self._task
+
+    @property
+    def name(self) -> str:
+        return self._name
+
+    @property
+    def workers(self) -> int:
+        return self._workers
+
+    @property
+    def queue_size(self) -> int:
+        return self._queue_size
+
+    def execute(self, an_input: _IN) -> _RT:
+        return self._task.execute(an_input)
+
+
+class StreamingPipeline(
+    Generic[_IN, _RT],
+    Task[Iterable[_IN], Iterator[_RT]]
+):
+    """
+    A pipeline that streams items through its tasks one item at a time.
+
+    Unlike a `Pipeline`, which hands its whole input from one task to the
+    next, each item of the input is passed through all the tasks before the
+    next item is taken from the input. `FlatMap` tasks stream each of their
+    results to the next task, `Consumer` tasks pass their items through
+    unchanged and any other task replaces each item with its result. Nested
+    streaming pipelines are applied to the whole stream.
+
+    Execution is lazy, nothing happens until the returned iterator is
+    consumed. Tasks that are also context managers are entered when the
+    first item is requested and exited once the stream is exhausted or
+    closed.
+
+    The given `hooks` receive the events of the pipeline's tasks, see
+    `PipelineHook`. Nested streaming pipelines only report events to their
+    own hooks.
+    """
+
+    def __init__(
+            self,
+            *tasks: Task[Any, Any],
+            hooks: Sequence[PipelineHook] = tuple()
+    ):
+        assert tasks, "tasks cannot be None or empty."
+        self._tasks: Sequence[Task[Any, Any]] = tuple(tasks)
+        self._hooks: Sequence[PipelineHook] = tuple(hooks)
+
+    @property
+    def tasks(self) -> Sequence[Task[Any, Any]]:
+        return self._tasks
+
+    @property
+    def hooks(self) -> Sequence[PipelineHook]:
+        return self._hooks
+
+    def execute(self, an_input: Iterable[_IN]) -> Iterator[_RT]:
+        with ExitStack() as exit_stack:
+            self._enter_tasks(exit_stack)
+            items: Iterator[Any] = iter(an_input)
+            for _task in self._tasks:
+                items = self._stream(_task, items)
+            yield from items
+
+    def _enter_tasks(self, exit_stack: ExitStack) -> None:
+        for _task in self._tasks:
+            if isinstance(_task, Stage):
+                _task = _task.task
+            if isinstance(_task, AbstractContextManager):
+                exit_stack.enter_context(_task)
+
+    def _stream(
+            self,
+            task: Task[Any, Any],
+            items: Iterator[Any]
+    ) -> Iterator[Any]:
+        stage: Task[Any, Any] = task
+        if isinstance(task, Stage):
+            task = task.task
+        if isinstance(task, StreamingPipeline):
+            return task.execute(items)
+        if self._hooks:
+            return self._stream_with_hooks(stage, task, items)
+        if isinstance(task, FlatMap):
+            return (
+                _result
+                for _item in items
+                for _result in task.execute(_item)
+            )
+        return map(task.execute, items)
+
+    def _stream_with_hooks(
+            self,
+            stage: Task[Any, Any],
+            task: Task[Any, Any],
+            items: Iterator[Any]
+    ) -> Iterator[Any]:
+        result: Any
+        for _item in items:
+            if not isinstance(task, FlatMap):
+                result = _run_task(self, self._hooks, stage, _item)
+                for _hook in self._hooks:
+                    _hook.on_item(self, stage, result)
+                yield result
+                continue
+
+            # The results of a flat map are usually produced lazily, each is
+            # reported as a separate execution of the task.
+            results: Optional[Iterator[Any]] = None
+            while True:
+                for _hook in self._hooks:
+                    _hook.before_task(self, stage, _item)
+                try:
+                    if results is None:
+                        results = iter(task.execute(_item))
+                    result = next(results)
+                except StopIteration:
+                    for _hook in self._hooks:
+                        _hook.after_task(self, stage, _item, None)
+                    break
+                except BaseException as exp:
+                    for _hook in self._hooks:
+                        _hook.on_task_error(self, stage, _item, exp)
+                    raise
+                for _hook in self._hooks:
+                    _hook.after_task(self, stage, _item, result)
+                    _hook.on_item(self, stage, result)
+                yield result
+
+
+class ThreadedStreamingPipeline(StreamingPipeline[_IN, _RT]):
+    """
+    A streaming pipeline that runs each of its tasks on its own threads.
+
+    Each task is run by one or more worker threads, connected to the workers
+    of the previous and next tasks by bounded queues. Tasks wrapped on a
+    `Stage` get the stage's number of workers and input queue size, other
+    tasks get a single worker and a queue of the default size. Workers block
+    while the queue to the next task is full, so a slow task applies
+    backpressure all the way up to the input, and memory use stays bounded.
+    The input is read from on a thread of its own.
+
+    Items are yielded in input order when every task has a single worker.
+    Any error raised by a task, or by the input, cancels the whole stream
+    and is re-raised on the thread consuming the returned iterator. Closing
+    the returned iterator early also cancels the stream. Either way, all the
+    workers are stopped before the tasks that are context managers are
+    exited.
+    """
+
+    def execute(self, an_input: Iterable[_IN]) -> Iterator[_RT]:
+        state: _StreamState = _StreamState()
+        stages: List[Stage[Any, Any]] = [
+            _task if isinstance(_task, Stage) else Stage(_task)
+            for _task in self._tasks
+        ]
+        queues: List["Queue[Any]"] = [
+            Queue(maxsize=_stage.queue_size) for _stage in stages
+        ]
+        queues.append(Queue(maxsize=_DEFAULT_STAGE_QUEUE_SIZE))
+        threads: List[Thread] = [
+            Thread(
+                target=self._feed,
+                args=(an_input, queues[0], state),
+                name="stream-input",
+                daemon=True
+            )
+        ]
+        for _index, _stage in enumerate(stages):
+            remaining_workers: List[int] = [_stage.workers]
+            workers_lock: Lock = Lock()
+            threads.extend(
+                Thread(
+                    target=self._work,
+                    args=(
+                        self._tasks[_index],
+                        queues[_index],
+                        queues[_index + 1],
+                        state,
+                        remaining_workers,
+                        workers_lock
+                    ),
+                    name="stream-stage-%d-worker-%d" % (_index, _worker),
+                    daemon=True
+                )
+                for _worker in range(_stage.workers)
+            )
+
+        with ExitStack() as exit_stack:
+            self._enter_tasks(exit_stack)
+            for _thread in threads:
+                _thread.start()
+            try:
+                yield from _iter_queue(queues[-1], state)
+            except _StreamCancelled:
+                pass
+            finally:
+                # Stop the workers when the stream is closed before its end.
+                state.cancelled.set()
+                for _thread in threads:
+                    _thread.join()
+            if state.error is not None:
+                raise state.error
+
+    @staticmethod
+    def _feed(
+            an_input: Iterable[Any],
+            outbox: "Queue[Any]",
+            state: _StreamState
+    ) -> None:
+        try:
+            for _item in an_input:
+                _put(outbox, _item, state)
+            _put(outbox, _END_OF_STREAM, state)
+        except _StreamCancelled:
+            return
+        except BaseException as exp:
+            state.fail(exp)
+
+    def _work(
+            self,
+            task: Task[Any, Any],
+            inbox: "Queue[Any]",
+            outbox: "Queue[Any]",
+            state: _StreamState,
+            remaining_workers: List[int],
+            workers_lock: Lock
+    ) -> None:
+        try:
+            for _result in self._stream(task, _iter_queue(inbox, state)):
+                _put(outbox, _result, state)
+            # The last worker of a task to finish ends the next task's input.
+            with workers_lock:
+                remaining_workers[0] -= 1
+                is_last: bool = not remaining_workers[0]
+            if is_last:
+                _put(outbox, _END_OF_STREAM, state)
+        except _StreamCancelled:
+            return
+        except BaseException as exp:
+            state.fail(exp)
@@ -1,9 +1,11 @@
+from .async_http_transport import AsyncHTTPTransport
 from .http_transport import HTTPTransport
 from .http_transport_adapter import HTTPTransportAdapter
 from .odk_central_transport_adapter import ODKCentralHTTPTransportAdapter
 
 
 __all__ = [
+    "AsyncHTTPTransport",
     "HTTPTransport",
     "HTTPTransportAdapter",
     "ODKCentralHTTPTransportAdapter"
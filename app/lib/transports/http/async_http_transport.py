@@ -0,0 +1,793 @@
+import asyncio
+import logging
+import time
+from collections import deque
+from concurrent.futures import Executor, ThreadPoolExecutor
+from typing import (
+    TYPE_CHECKING,
+    Any,
+    AsyncGenerator,
+    AsyncIterator,
+    Awaitable,
+    Callable,
+    Deque,
+    Dict,
+    Iterator,
+    List,
+    Mapping,
+    Optional,
+    Sequence,
+    Tuple,
+    TypeVar,
+    Union,
+    cast
+)
+
+from aiohttp import ClientSession, ClientTimeout, TCPConnector, TraceConfig
+
+from app.core import (
+    PrimaryInstanceDocumentRoot,
+    Transport,
+    TransportError,
+    TransportOptions,
+    XForm
+)
+from app.lib.metrics import HTTPMetricsRegistry, get_http_metrics_registry
+from app.utils import ensure_not_none
+from .http_transport import (
+    MAX_REAUTHENTICATION_ATTEMPTS,
+    AdapterRequestParams,
+    SubmissionsData,
+    exclude_submissions,
+    get_request_endpoint
+)
+if TYPE_CHECKING:
+    from app.lib.cache import FormCache
+    from .http_transport_adapter import HTTPTransportAdapter
+
+
+# =============================================================================
+# TYPES
+# =============================================================================
+
+_T = TypeVar("_T")
+
+
+# =============================================================================
+# CONSTANTS
+# =============================================================================
+
+LOGGER = logging.getLogger(__name__)
+
+_DEFAULT_MAX_WORKERS: int = 100
+
+
+# =============================================================================
+# HELPERS
+# =============================================================================
+
+async def _on_connection_create_start(
+        session: ClientSession,
+        trace_config_ctx: Any,
+        params: Any
+) -> None:
+    trace_config_ctx.connect_started_at = time.perf_counter()
+
+
+async def _on_connection_create_end(
+        session: ClientSession,
+        trace_config_ctx: Any,
+        params: Any
+) -> None:
+    timings: Optional[Dict[str, float]] = trace_config_ctx.trace_request_ctx
+    if timings is not None:
+        timings["connect_seconds"] = (
+            time.perf_counter() - trace_config_ctx.connect_started_at
+        )
+
+
+# =============================================================================
+# ASYNC HTTP TRANSPORT
+# =============================================================================
+
+class AsyncHTTPTransport(Transport):
+    """
+    Transport implementation that uses the HTTP/HTTPS protocol on an asyncio
+    event loop for data transmission between this app and an OpenRosa spec
+    compliant server.
+
+    Like the `HTTPTransport`, this transport relies on an
+    adapter(`HTTPTransportAdapter`) to perform server specific implementation
+    details. Requests are performed concurrently on a single event loop with
+    up to `max_workers` requests in flight at any given time, without
+    dedicating a thread to each request.
+
+    Besides the (blocking) `Transport` interface, each retrieval method has an
+    awaitable counterpart prefixed with an "a", e.g. `aget_form`. The blocking
+    methods drive this transport's own event loop and are therefore not meant
+    to be called from within a running event loop.
+
+    Submissions whose ids are given in the "exclude_instance_ids" option, or
+    are rejected by the "instance_id_filter" option, are not fetched.
+    Authentication happens lazily on the first request.
+    Concurrent requests that fail with one of the adapter's authentication
+    trigger statuses share a single re-authentication.
+
+    When a `form_cache` is given, forms are served from the cache whenever
+    possible and added to it after being retrieved.
+
+    Every request is recorded on the given `metrics_registry`, or otherwise
+    on the process wide one, the same as by the `HTTPTransport`. The time
+    spent waiting for one of the `max_workers` request slots is not
+    included in the recorded latencies.
+    """
+
+    def __init__(
+            self,
+            transport_adapter: "HTTPTransportAdapter",
+            connect_timeout: Optional[float] = None,
+            read_timeout: Optional[float] = None,
+            max_workers: Optional[int] = None,
+            form_cache: Optional["FormCache"] = None,
+            metrics_registry: Optional[HTTPMetricsRegistry] = None
+    ):
+        super().__init__()
+        self._transport_adapter: "HTTPTransportAdapter" = ensure_not_none(
+            transport_adapter,
+            message='The "transport_adapter" parameter must be provided.'
+        )
+        self._timeout: ClientTimeout = ClientTimeout(
+            total=None,
+            sock_connect=connect_timeout,
+            sock_read=read_timeout
+        )
+        self._max_workers: int = max_workers or _DEFAULT_MAX_WORKERS
+        assert self._max_workers > 0, '"max_workers" MUST be greater than 0.'
+        self._form_cache: Optional["FormCache"] = form_cache
+        self._metrics_registry: HTTPMetricsRegistry = (
+            metrics_registry or get_http_metrics_registry()
+        )
+        self._loop: asyncio.AbstractEventLoop = asyncio.new_event_loop()
+        # Forms are parsed on their own executor. Submission parsers running
+        # on the loop's default executor may block waiting for a form to be
+        # retrieved, e.g. when form versions are loaded on demand, and would
+        # otherwise starve the form parser of threads.
+        self._forms_executor: Executor = ThreadPoolExecutor(
+            max_workers=1,
+            thread_name_prefix="forms-parser"
+        )
+        # These are created lazily on this transport's event loop.
+        self._session: Optional[ClientSession] = None
+        self._auth_lock: Optional[asyncio.Lock] = None
+        self._requests_semaphore: Optional[asyncio.Semaphore] = None
+        self._auth_headers: Optional[Mapping[str, str]] = None
+        self._auth_generation: int = 0
+
+    def close(self) -> None:
+        """Release the resources held by this transport and its adapter."""
+        if self._session is not None:
+            self._run(self._session.close())
+            self._session = None
+        self._forms_executor.shutdown()
+        self._loop.close()
+        self._transport_adapter.close()
+
+    def flush(
+            self,
+            timeout: Optional[float] = None,
+            callback: Optional[Callable[[bool, Optional[str]], None]] = None
+    ) -> None:
+        # Do nothing for this transport
+        ...
+
+    # FORM RETRIEVAL
+    # -------------------------------------------------------------------------
+    def get_form(
+            self,
+            form_id: str,
+            version: str,
+            **options: TransportOptions
+    ) -> XForm:
+        return self._run(self.aget_form(form_id, version, **options))
+
+    def list_form_versions(
+            self,
+            form_id,
+            **options: TransportOptions
+    ) -> Sequence[XForm]:
+        return self._run(self.alist_form_versions(form_id, **options))
+
+    def list_forms(self, **options: TransportOptions) -> Sequence[XForm]:
+        return self._run(self.alist_forms(**options))
+
+    def list_form_ids(self, **options: TransportOptions) -> Sequence[str]:
+        return self._run(self.alist_form_ids(**options))
+
+    async def aget_form(
+            self,
+            form_id: str,
+            version: str,
+            **options: TransportOptions
+    ) -> XForm:
+        return await self._aget_form(form_id, version, None, **options)
+
+    async def alist_form_versions(
+            self,
+            form_id,
+            **options: TransportOptions
+    ) -> Sequence[XForm]:
+        response_content: bytes = await self._amake_request(
+            self._transport_adapter.list_form_versions_request(
+                form_id,
+                **options
+            )
+        )
+        versions_data: Union[Sequence[str], Sequence[XForm]]
+        versions_data = self._transport_adapter.response_to_form_versions(
+            response_content,
+            **options
+        )
+        # If s sequence of XForms was returned, then return that sequence.
+        if len(versions_data) == 0 or isinstance(versions_data[0], XForm):
+            return cast(Sequence[XForm], versions_data)
+
+        # Else, assume that the sequence is composed of strings(form ids).
+        versions: Sequence[str] = cast(Sequence[str], versions_data)
+        versions_hashes: Mapping[str, str]
+        versions_hashes = self._transport_adapter.response_to_form_versions_hashes(  # noqa
+            response_content,
+            **options
+        )
+        return tuple(
+            await asyncio.gather(*(
+                self._aget_form(
+                    form_id,
+                    _version,
+                    versions_hashes.get(_version),
+                    **options
+                )
+                for _version in versions
+            ))
+        )
+
+    async def alist_forms(
+            self,
+            **options: TransportOptions
+    ) -> Sequence[XForm]:
+        response_content: bytes = await self._amake_request(
+            self._transport_adapter.list_forms_request(**options)
+        )
+        forms_data: Union[Sequence[str], Sequence[XForm]]
+        forms_data = self._transport_adapter.response_to_forms(
+            response_content,
+            **options
+        )
+        # If s sequence of XForms was returned, then return that sequence.
+        if len(forms_data) == 0 or isinstance(forms_data[0], XForm):
+            return cast(Sequence[XForm], forms_data)
+
+        # Else, assume that the sequence is composed of strings(form ids).
+        forms_ids: Sequence[str] = cast(Sequence[str], forms_data)
+        form_versions: List[Sequence[XForm]] = await asyncio.gather(*(
+            self.alist_form_versions(_f_id, **options)
+            for _f_id in forms_ids
+        ))
+        return tuple(
+            _form
+            for _versions in form_versions
+            for _form in _versions
+        )
+
+    async def alist_form_ids(
+            self,
+            **options: TransportOptions
+    ) -> Sequence[str]:
+        response_content: bytes = await self._amake_request(
+            self._transport_adapter.list_forms_request(**options)
+        )
+        forms_data: Union[Sequence[str], Sequence[XForm]]
+        forms_data = self._transport_adapter.response_to_forms(
+            response_content,
+            **options
+        )
+        if len(forms_data) == 0 or isinstance(forms_data[0], XForm):
+            return tuple(
+                _form.id for _form in cast(Sequence[XForm], forms_data)
+            )
+        return tuple(cast(Sequence[str], forms_data))
+
+    # SUBMISSION RETRIEVAL
+    # -------------------------------------------------------------------------
+    def get_submission(
+            self,
+            form_id: str,
+            submission_id: str,
+            form_versions: Mapping[str, XForm],
+            **options: TransportOptions
+    ) -> PrimaryInstanceDocumentRoot:
+        return self._run(
+            self.aget_submission(
+                form_id,
+                submission_id,
+                form_versions,
+                **options
+            )
+        )
+
+    def iter_form_submissions(
+            self,
+            form_id: str,
+            form_versions: Mapping[str, XForm],
+            **options: TransportOptions
+    ) -> Iterator[PrimaryInstanceDocumentRoot]:
+        submissions = self.aiter_form_submissions(
+            form_id,
+            form_versions,
+            **options
+        )
+        try:
+            while True:
+                try:
+                    yield self._run(submissions.__anext__())
+                except StopAsyncIteration:
+                    return
+        finally:
+            self._run(submissions.aclose())
+
+    def list_form_submissions(
+            self,
+            form_id: str,
+            form_versions: Mapping[str, XForm],
+            **options: TransportOptions
+    ) -> Mapping[str, PrimaryInstanceDocumentRoot]:
+        return {
+            _submission.version: _submission
+            for _submission in self.iter_form_submissions(
+                form_id,
+                form_versions,
+                **options
+            )
+        }
+
+    async def aget_submission(
+            self,
+            form_id: str,
+            submission_id: str,
+            form_versions: Mapping[str, XForm],
+            **options: TransportOptions
+    ) -> PrimaryInstanceDocumentRoot:
+        LOGGER.info('Fetching submission with id="%s"', submission_id)
+        response_content: bytes = await self._amake_request(
+            self._transport_adapter.get_submission_request(
+                form_id,
+                submission_id,
+                **options
+            )
+        )
+        return await self._aparse(
+            lambda: self._transport_adapter.response_to_submission(
+                response_content,
+                form_versions,
+                **options
+            )
+        )
+
+    async def aiter_form_submissions(
+            self,
+            form_id: str,
+            form_versions: Mapping[str, XForm],
+            **options: TransportOptions
+    ) -> AsyncGenerator[PrimaryInstanceDocumentRoot, None]:
+        LOGGER.info('Fetching submissions for form with id="%s"', form_id)
+        async for _submissions_data in self._aiter_submissions_pages(
+                form_id,
+                form_versions,
+                **options
+        ):
+            submissions_data: SubmissionsData = exclude_submissions(
+                _submissions_data,
+                **options
+            )
+            # If the first element is a PrimaryInstanceDocumentRoot, an
+            # assumption is made that the sequence only contains
+            # PrimaryInstanceDocumentRoot elements. No further attempt is made
+            # to check the type of the other elements.
+            if len(submissions_data) == 0 or isinstance(
+                    submissions_data[0],
+                    PrimaryInstanceDocumentRoot
+            ):
+                for _submission in cast(
+                        Sequence[PrimaryInstanceDocumentRoot],
+                        submissions_data
+                ):
+                    yield _submission
+                continue
+
+            # Else, assume that the sequence is composed of strings(submission
+            # ids).
+            async for _submission in self._aiter_submissions(
+                    form_id,
+                    cast(Sequence[str], submissions_data),
+                    form_versions,
+                    **options
+            ):
+                yield _submission
+
+    async def alist_form_submissions(
+            self,
+            form_id: str,
+            form_versions: Mapping[str, XForm],
+            **options: TransportOptions
+    ) -> Mapping[str, PrimaryInstanceDocumentRoot]:
+        return {
+            _submission.version: _submission
+            async for _submission in self.aiter_form_submissions(
+                form_id,
+                form_versions,
+                **options
+            )
+        }
+
+    # OTHER HELPERS
+    # -------------------------------------------------------------------------
+    async def _aget_form(
+            self,
+            form_id: str,
+            version: str,
+            content_hash: Optional[str],
+            **options: TransportOptions
+    ) -> XForm:
+        form_cache: Optional["FormCache"] = self._form_cache
+        if form_cache is not None:
+            cached_form: Optional[XForm] = await self._aparse(
+                lambda: form_cache.get(form_id, version, content_hash),
+                executor=self._forms_executor
+            )
+            if cached_form is not None:
+                return cached_form
+
+        response_content: bytes = await self._amake_request(
+            self._transport_adapter.get_form_request(
+                form_id,
+                version,
+                **options
+            )
+        )
+        form: XForm = await self._aparse(
+            lambda: self._transport_adapter.response_to_form(
+                response_content,
+                **options
+            ),
+            executor=self._forms_executor
+        )
+        if form_cache is not None:
+            form_cache.put(
+                form,
+                self._transport_adapter.response_to_form_hash(
+                    response_content,
+                    **options
+                )
+            )
+        return form
+
+    async def _aiter_submissions_pages(
+            self,
+            form_id: str,
+            form_versions: Mapping[str, XForm],
+            **options: TransportOptions
+    ) -> AsyncIterator[SubmissionsData]:
+        response_content: bytes = await self._amake_request(
+            self._transport_adapter.list_form_submissions_request(
+                form_id,
+                **options
+            )
+        )
+        yield await self._aparse(
+            lambda: self._transport_adapter.response_to_submissions(
+                response_content,
+                form_versions,
+                **options
+            )
+        )
+
+        # Fetch the remaining pages of a paged listing, if any, concurrently.
+        page_requests: Sequence[AdapterRequestParams]
+        page_requests = self._transport_adapter.list_form_submissions_page_requests(  # noqa
+            form_id,
+            response_content,
+            **options
+        )
+        if not page_requests:
+            return
+        LOGGER.info(
+            'Fetching %d more pages of submissions for form with id="%s"',
+            len(page_requests),
+            form_id
+        )
+        pages: List["asyncio.Future[SubmissionsData]"] = [
+            asyncio.ensure_future(
+                self._aget_submissions_page(
+                    _page_request,
+                    form_versions,
+                    **options
+                )
+            )
+            for _page_request in page_requests
+        ]
+        try:
+            for _page in pages:
+                yield await _page
+        finally:
+            for _page in pages:
+                _page.cancel()
+
+    async def _aget_submissions_page(
+            self,
+            page_request: AdapterRequestParams,
+            form_versions: Mapping[str, XForm],
+            **options: TransportOptions
+    ) -> SubmissionsData:
+        page_content: bytes = await self._amake_request(page_request)
+        return await self._aparse(
+            lambda: self._transport_adapter.response_to_submissions(
+                page_content,
+                form_versions,
+                **options
+            )
+        )
+
+    async def _aiter_submissions(
+            self,
+            form_id: str,
+            submission_ids: Sequence[str],
+            form_versions: Mapping[str, XForm],
+            **options: TransportOptions
+    ) -> AsyncIterator[PrimaryInstanceDocumentRoot]:
+        # Keep a bounded window of submissions in flight and yield them in the
+        # order of their ids.
+        pending: Deque["asyncio.Future[Optional[PrimaryInstanceDocumentRoot]]"]
+        pending = deque()
+        try:
+            for _submission_id in submission_ids:
+                pending.append(
+                    asyncio.ensure_future(
+                        self._aget_submission_or_none(
+                            form_id,
+                            _submission_id,
+                            form_versions,
+                            **options
+                        )
+                    )
+                )
+                if len(pending) < self._max_workers:
+                    continue
+                submission = await pending.popleft()
+                if submission is not None:
+                    yield submission
+            while pending:
+                submission = await pending.popleft()
+                if submission is not None:
+                    yield submission
+        finally:
+            for _future in pending:
+                _future.cancel()
+
+    async def _aget_submission_or_none(
+            self,
+            form_id: str,
+            submission_id: str,
+            form_versions: Mapping[str, XForm],
+            **options: TransportOptions
+    ) -> Optional[PrimaryInstanceDocumentRoot]:
+        # Isolate failures to the submission being retrieved.
+        try:
+            return await self.aget_submission(
+                form_id,
+                submission_id,
+                form_versions,
+                **options
+            )
+        except asyncio.CancelledError:
+            raise
+        except Exception:  # noqa
+            LOGGER.exception(
+                'Unable to retrieve the submission with id="%s" of the form '
+                'with id="%s", skipping it.',
+                submission_id,
+                form_id
+            )
+            return None
+
+    async def _aensure_session(self) -> ClientSession:
+        if self._session is None:
+            # Time the connections established for each request.
+            trace_config: TraceConfig = TraceConfig()
+            trace_config.on_connection_create_start.append(
+                _on_connection_create_start
+            )
+            trace_config.on_connection_create_end.append(
+                _on_connection_create_end
+            )
+            self._session = ClientSession(
+                connector=TCPConnector(limit=self._max_workers),
+                headers={
+                    "Accept": "*/*",
+                    "User-Agent": "XFormsRepack/1.0.0"
+                },
+                timeout=self._timeout,
+                trace_configs=[trace_config]
+            )
+            self._auth_lock = asyncio.Lock()
+            self._requests_semaphore = asyncio.Semaphore(self._max_workers)
+        return self._session
+
+    async def _aauthenticate(self) -> Mapping[str, str]:
+        LOGGER.info("Authenticating HTTP transport on data source")
+        request: AdapterRequestParams = self._transport_adapter.authenticate()
+        status, response_content = await self._asend(request, auth_headers={})
+
+        # If authentication was unsuccessful, there is not much that can be
+        # done, just log it and raise an exception.
+        if status != request["expected_http_status_code"]:
+            error_message: str = (
+                "Unable to authenticate HTTP client on data source. Server "
+                'says: "%s"' % response_content.decode(errors="replace")
+            )
+            LOGGER.error(error_message)
+            raise TransportError(error_message)
+        return self._transport_adapter.response_to_auth(
+            response_content=response_content
+        )
+
+    async def _areauthenticate(
+            self,
+            stale_auth_generation: int,
+            request: Optional[AdapterRequestParams] = None
+    ) -> None:
+        # Concurrent requests may all fail with a stale authentication at the
+        # same time, only the first one of them needs to re-authenticate.
+        async with cast(asyncio.Lock, self._auth_lock):
+            if self._auth_generation == stale_auth_generation:
+                if request is not None:
+                    self._metrics_registry.record_reauthentication(
+                        get_request_endpoint(request)
+                    )
+                self._auth_headers = await self._aauthenticate()
+                self._auth_generation += 1
+
+    async def _amake_request(self, request: AdapterRequestParams) -> bytes:
+        await self._aensure_session()
+        request_message: str = "HTTP Request (%s | %s)" % (
+            request["method"],
+            request["url"]
+        )
+        LOGGER.info(request_message)
+        attempt: int = 0
+        while True:
+            if self._auth_headers is None:
+                await self._areauthenticate(stale_auth_generation=0)
+            auth_generation: int = self._auth_generation
+            status, response_content = await self._asend(
+                request,
+                auth_headers=cast(Mapping[str, str], self._auth_headers)
+            )
+            if status == request["expected_http_status_code"]:
+                return response_content
+
+            LOGGER.debug(
+                (
+                    'Got an unexpected HTTP status, expected="%d", but got'
+                    ' "%d" instead'
+                ),
+                request["expected_http_status_code"],
+                status
+            )
+            # If the received response status was not what was expected, check
+            # if the status is among the re-authentication trigger status and
+            # if so, re-authenticate and then retry this request.
+            if status in self._transport_adapter.authentication_trigger_statuses and attempt < MAX_REAUTHENTICATION_ATTEMPTS:  # noqa
+                LOGGER.debug(
+                    (
+                        'Encountered an authentication trigger status("%d"), '
+                        're-authenticating'
+                    ),
+                    status
+                )
+                attempt += 1
+                await self._areauthenticate(
+                    stale_auth_generation=auth_generation,
+                    request=request
+                )
+                LOGGER.debug(
+                    "Re-authentication successful, retrying the request."
+                )
+                self._metrics_registry.record_retry(
+                    get_request_endpoint(request)
+                )
+                continue
+
+            # If not, then an error has occurred, log the error the raise an
+            # exception.
+            error_message: str = (
+                "%s : Failed. Expected response status %d, but got %d" %
+                (
+                    request_message,
+                    request["expected_http_status_code"],
+                    status
+                )
+            )
+            LOGGER.error(error_message)
+            raise TransportError(error_message)
+
+    async def _asend(
+            self,
+            request: AdapterRequestParams,
+            auth_headers: Mapping[str, str]
+    ) -> Tuple[int, bytes]:
+        session: ClientSession = await self._aensure_session()
+        headers = {
+            _name: _value
+            for _name, _value in (request.get("headers") or {}).items()
+            if _value is not None
+        }
+        headers.update(auth_headers)
+        params: List[Tuple[str, str]] = [
+            (_name, _value)
+            for _name, _values in (request.get("params") or {}).items()
+            for _value in (
+                (_values,) if isinstance(_values, str) else _values
+            )
+        ]
+        async with cast(asyncio.Semaphore, self._requests_semaphore):
+            # Filled in by `_on_connection_create_end`.
+            timings: Dict[str, float] = dict()
+            started_at: float = time.perf_counter()
+            try:
+                async with session.request(
+                        data=request.get("data"),
+                        headers=headers,
+                        method=request["method"],
+                        params=params,
+                        url=request["url"],
+                        trace_request_ctx=timings
+                ) as response:
+                    status: int = response.status
+                    response_content: bytes = await response.read()
+            except Exception:
+                self._metrics_registry.record_request(
+                    get_request_endpoint(request),
+                    status_code=None,
+                    total_seconds=time.perf_counter() - started_at,
+                    connect_seconds=timings.get("connect_seconds")
+                )
+                raise
+            self._metrics_registry.record_request(
+                get_request_endpoint(request),
+                status_code=status,
+                total_seconds=time.perf_counter() - started_at,
+                connect_seconds=timings.get("connect_seconds"),
+                bytes_received=len(response_content)
+            )
+            return status, response_content
+
+    async def _aparse(
+            self,
+            parse: Callable[[], _T],
+            executor: Optional[Executor] = None
+    ) -> _T:
+        # Parsing is CPU bound, run it off the event loop so that in flight
+        # requests keep making progress.
+        return await asyncio.get_running_loop().run_in_executor(
+            executor,
+            parse
+        )
+
+    def _run(self, awaitable: Awaitable[_T]) -> _T:
+        if self._loop.is_running():
+            # Called from a thread other than the one running the loop, e.g.
+            # a parser running off the event loop.
+            return asyncio.run_coroutine_threadsafe(
+                cast(Any, awaitable),
+                self._loop
+            ).result()
+        return self._loop.run_until_complete(awaitable)
@@ -1,21 +1,32 @@
 import itertools
 import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock, local
 from typing import (
     TYPE_CHECKING,
     Any,
     Callable,
+    Collection,
+    Dict,
+    Iterator,
     Mapping,
     Optional,
     Sequence,
     Tuple,
+    Type,
     TypedDict,
     Union,
     cast
 )
+from urllib.parse import urlsplit
 
+from requests.adapters import HTTPAdapter
 from requests.auth import AuthBase
 from requests.models import PreparedRequest, Response
 from requests.sessions import Session
+from urllib3.connection import HTTPConnection, HTTPSConnection
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
 
 from app.core import (
     PrimaryInstanceDocumentRoot,
@@ -24,8 +35,10 @@ from app.core import (
     TransportOptions,
     XForm
 )
-from app.utils import ensure_not_none
+from app.lib.metrics import HTTPMetricsRegistry, get_http_metrics_registry
+from app.utils import bounded_ordered_map, ensure_not_none
 if TYPE_CHECKING:
+    from app.lib.cache import FormCache
     from .http_transport_adapter import HTTPTransportAdapter
 
 
@@ -35,6 +48,10 @@ if TYPE_CHECKING:
 
 class _OptionalAdapterRequestParams(TypedDict, total=False):
     data: Optional[Union[bytes, str, Mapping[str, Any]]]
+    # The template of the path of the request's url, e.g.
+    # "/v1/projects/{projectId}/forms", that requests are grouped by in the
+    # HTTP metrics. Defaults to the path of the url.
+    endpoint: str
     headers: Optional[Mapping[str, Optional[str]]]
     params: Optional[Mapping[str, Union[str, Sequence[str]]]]
 
@@ -45,12 +62,103 @@ class AdapterRequestParams(_OptionalAdapterRequestParams):
     url: str
 
 
+SubmissionsData = Union[Sequence[str], Sequence[PrimaryInstanceDocumentRoot]]
+
+
 # =============================================================================
 # CONSTANTS
 # =============================================================================
 
 LOGGER = logging.getLogger(__name__)
 
+_DEFAULT_MAX_WORKERS: int = 1
+
+MAX_REAUTHENTICATION_ATTEMPTS: int = 3
+
+# The time spent establishing new connections on each thread, see
+# `_TimedHTTPConnection`.
+_CONNECT_TIMES = local()
+
+
+# =============================================================================
+# HELPERS
+# =============================================================================
+
+def exclude_submissions(
+        submissions_data: SubmissionsData,
+        **options: TransportOptions
+) -> SubmissionsData:
+    """
+    Drop the submissions whose ids are given in the "exclude_instance_ids"
+    option, or are rejected by the "instance_id_filter" option, a predicate
+    taking an instance id, if any, from the given submissions or submission
+    ids.
+
+    :param submissions_data: The submissions or submission ids to filter.
+    :param options: The transport options in effect.
+
+    :return: The submissions or submission ids not excluded by the given
+             options.
+    """
+    excluded_ids: Collection[str] = cast(
+        Collection[str],
+        options.get("exclude_instance_ids") or ()
+    )
+    instance_id_filter: Optional[Callable[[str], bool]] = cast(
+        Optional[Callable[[str], bool]],
+        options.get("instance_id_filter")
+    )
+    if not excluded_ids and instance_id_filter is None:
+        return submissions_data
+
+    def _is_included(
+            submission: Union[str, PrimaryInstanceDocumentRoot]
+    ) -> bool:
+        instance_id: str = (
+            (submission.meta.instance_id or "")
+            if isinstance(submission, PrimaryInstanceDocumentRoot)
+            else submission
+        )
+        return instance_id not in excluded_ids and (
+            instance_id_filter is None or instance_id_filter(instance_id)
+        )
+
+    return cast(
+        SubmissionsData,
+        tuple(filter(_is_included, submissions_data))
+    )
+
+
+def get_request_endpoint(request: AdapterRequestParams) -> str:
+    """
+    Return the endpoint that a request is grouped by in the HTTP metrics,
+    its method followed by the template of its url's path.
+
+    :param request: The request.
+
+    :return: The request's endpoint, e.g. "GET /v1/projects/{projectId}/forms".
+    """
+    return "%s %s" % (
+        request["method"],
+        request.get("endpoint") or urlsplit(request["url"]).path
+    )
+
+
+def _reset_connect_seconds() -> None:
+    _CONNECT_TIMES.seconds = None
+
+
+def _add_connect_seconds(seconds: float) -> None:
+    _CONNECT_TIMES.seconds = (
+        getattr(_CONNECT_TIMES, "seconds", None) or 0.0
+    ) + seconds
+
+
+def _pop_connect_seconds() -> Optional[float]:
+    seconds: Optional[float] = getattr(_CONNECT_TIMES, "seconds", None)
+    _CONNECT_TIMES.seconds = None
+    return seconds
+
 
 # =============================================================================
 # HTTP TRANSPORT INTERFACE
@@ -64,13 +172,35 @@ class HTTPTransport(Transport):
     This transport relies on an adapter(`HTTPTransportAdapter`) to perform
     server specific implementation details such as mapping to the correct API
     endpoints and translating responses to the correct domain objects.
+
+    When an adapter only returns the ids of a form's submissions, each
+    submission is fetched and parsed on a bounded pool of `max_workers`
+    threads sharing this transport's session. A failure to fetch or parse a
+    single submission is logged and the submission skipped, it doesn't abort
+    the retrieval of the rest of the form's submissions. Submissions whose ids
+    are given in the "exclude_instance_ids" option, or are rejected by the
+    "instance_id_filter" option, are not fetched. When an adapter pages a
+    form's submissions listing, the remaining pages are fetched and parsed
+    concurrently on the same pool.
+
+    When a `form_cache` is given, forms are served from the cache whenever
+    possible and added to it after being retrieved.
+
+    Every request, including authentication requests and retries, is
+    recorded on the given `metrics_registry`, or otherwise on the process
+    wide one, see `get_http_metrics_registry`. Requests that fail with one
+    of the adapter's authentication trigger statuses are retried after
+    re-authenticating, up to `MAX_REAUTHENTICATION_ATTEMPTS` times.
     """
 
     def __init__(
             self,
             transport_adapter: "HTTPTransportAdapter",
             connect_timeout: Optional[float] = None,
-            read_timeout: Optional[float] = None
+            read_timeout: Optional[float] = None,
+            max_workers: Optional[int] = None,
+            form_cache: Optional["FormCache"] = None,
+            metrics_registry: Optional[HTTPMetricsRegistry] = None
     ):
         super().__init__()
         self._transport_adapter: "HTTPTransportAdapter" = ensure_not_none(
@@ -82,13 +212,29 @@ class HTTPTransport(Transport):
             if connect_timeout is not None
             else connect_timeout
         )
+        self._max_workers: int = max_workers or _DEFAULT_MAX_WORKERS
+        assert self._max_workers > 0, '"max_workers" MUST be greater than 0.'
+        self._form_cache: Optional["FormCache"] = form_cache
+        self._metrics_registry: HTTPMetricsRegistry = (
+            metrics_registry or get_http_metrics_registry()
+        )
         self._session: Session = Session()
         self._session.headers.update({
             "Accept": "*/*",
             "User-Agent": "XFormsRepack/1.0.0"
         })
+        # Allow each worker to hold on to its own pooled connection.
+        _http_adapter = _TimedHTTPAdapter(pool_maxsize=self._max_workers)
+        self._session.mount("http://", _http_adapter)
+        self._session.mount("https://", _http_adapter)
+        self._auth_lock: Lock = Lock()
         self._auth: AuthBase = self._authenticate()
 
+    def close(self) -> None:
+        """Release the resources held by this transport and its adapter."""
+        self._session.close()
+        self._transport_adapter.close()
+
     def flush(
             self,
             timeout: Optional[float] = None,
@@ -105,17 +251,7 @@ class HTTPTransport(Transport):
             version: str,
             **options: TransportOptions
     ) -> XForm:
-        response: Response = self._make_request(
-            self._transport_adapter.get_form_request(
-                form_id,
-                version,
-                **options
-            )
-        )
-        return self._transport_adapter.response_to_form(
-            response.content,
-            **options
-        )
+        return self._get_form(form_id, version, None, **options)
 
     def list_form_versions(
             self,
@@ -140,9 +276,19 @@ class HTTPTransport(Transport):
 
         # Else, assume that the sequence is composed of strings(form ids).
         versions: Sequence[str] = cast(Sequence[str], versions_data)
+        versions_hashes: Mapping[str, str]
+        versions_hashes = self._transport_adapter.response_to_form_versions_hashes(  # noqa
+            response.content,
+            **options
+        )
         return tuple(
             map(
-                lambda _version: self.get_form(form_id, _version, **options),
+                lambda _version: self._get_form(
+                    form_id,
+                    _version,
+                    versions_hashes.get(_version),
+                    **options
+                ),
                 versions
             )
         )
@@ -171,6 +317,20 @@ class HTTPTransport(Transport):
         )
         return tuple(itertools.chain.from_iterable(form_versions))
 
+    def list_form_ids(self, **options: TransportOptions) -> Sequence[str]:
+        response: Response = self._make_request(
+            self._transport_adapter.list_forms_request(**options)
+        )
+        forms_data: Union[Sequence[str], Sequence[XForm]]
+        forms_data = self._transport_adapter.response_to_forms(
+            response.content,
+            **options
+        )
+        result, values = self._as_xforms_if_possible(forms_data)
+        if result:
+            return tuple(_form.id for _form in values)
+        return tuple(cast(Sequence[str], forms_data))
+
     # SUBMISSION RETRIEVAL
     # -------------------------------------------------------------------------
     def get_submission(
@@ -194,71 +354,203 @@ class HTTPTransport(Transport):
             **options
         )
 
+    def iter_form_submissions(
+            self,
+            form_id: str,
+            form_versions: Mapping[str, XForm],
+            **options: TransportOptions
+    ) -> Iterator[PrimaryInstanceDocumentRoot]:
+        LOGGER.info('Fetching submissions for form with id="%s"', form_id)
+        for _submissions_data in self._iter_submissions_pages(
+                form_id,
+                form_versions,
+                **options
+        ):
+            submissions_data: SubmissionsData = exclude_submissions(
+                _submissions_data,
+                **options
+            )
+            # If the first element is a PrimaryInstanceDocumentRoot, an
+            # assumption is made that the sequence only contains
+            # PrimaryInstanceDocumentRoot elements. No further attempt is made
+            # to check the type of the other elements.
+            if len(submissions_data) == 0 or isinstance(
+                    submissions_data[0],
+                    PrimaryInstanceDocumentRoot
+            ):
+                yield from cast(
+                    Sequence[PrimaryInstanceDocumentRoot],
+                    submissions_data
+                )
+                continue
+
+            # Else, assume that the sequence is composed of strings(submission
+            # ids).
+            yield from self._iter_submissions(
+                form_id,
+                cast(Sequence[str], submissions_data),
+                form_versions,
+                **options
+            )
+
     def list_form_submissions(
             self,
             form_id: str,
             form_versions: Mapping[str, XForm],
             **options: TransportOptions
     ) -> Mapping[str, PrimaryInstanceDocumentRoot]:
-        LOGGER.info('Fetching submissions for form with id="%s"', form_id)
+        return {
+            _submission.version: _submission
+            for _submission in self.iter_form_submissions(
+                form_id,
+                form_versions,
+                **options
+            )
+        }
+
+    # OTHER HELPERS
+    # -------------------------------------------------------------------------
+    def _get_form(
+            self,
+            form_id: str,
+            version: str,
+            content_hash: Optional[str],
+            **options: TransportOptions
+    ) -> XForm:
+        if self._form_cache is not None:
+            cached_form: Optional[XForm] = self._form_cache.get(
+                form_id,
+                version,
+                content_hash
+            )
+            if cached_form is not None:
+                return cached_form
+
+        response: Response = self._make_request(
+            self._transport_adapter.get_form_request(
+                form_id,
+                version,
+                **options
+            )
+        )
+        form: XForm = self._transport_adapter.response_to_form(
+            response.content,
+            **options
+        )
+        if self._form_cache is not None:
+            self._form_cache.put(
+                form,
+                self._transport_adapter.response_to_form_hash(
+                    response.content,
+                    **options
+                )
+            )
+        return form
+
+    def _iter_submissions_pages(
+            self,
+            form_id: str,
+            form_versions: Mapping[str, XForm],
+            **options: TransportOptions
+    ) -> Iterator[SubmissionsData]:
         response: Response = self._make_request(
             self._transport_adapter.list_form_submissions_request(
                 form_id,
                 **options
             )
         )
-        submissions_data: Union[Sequence[str], Sequence[PrimaryInstanceDocumentRoot]]
-        submissions_data = self._transport_adapter.response_to_submissions(
+        yield self._transport_adapter.response_to_submissions(
             response.content,
             form_versions,
             **options
         )
-        # If the first element is an XForm, an assumption is made that the
-        # sequence only contains XForm elements. No further attempt is made to
-        # check the type of the other elements.
-        submissions: Sequence[PrimaryInstanceDocumentRoot]
-        if len(submissions_data) == 0 or isinstance(
-                submissions_data[0],
-                PrimaryInstanceDocumentRoot
-        ):
-            submissions = cast(
-                Sequence[PrimaryInstanceDocumentRoot],
-                submissions_data
+
+        # Fetch the remaining pages of a paged listing, if any, concurrently.
+        page_requests: Sequence[AdapterRequestParams]
+        page_requests = self._transport_adapter.list_form_submissions_page_requests(  # noqa
+            form_id,
+            response.content,
+            **options
+        )
+        if not page_requests:
+            return
+        LOGGER.info(
+            'Fetching %d more pages of submissions for form with id="%s"',
+            len(page_requests),
+            form_id
+        )
+
+        def _get_page(page_request: AdapterRequestParams) -> SubmissionsData:
+            return self._transport_adapter.response_to_submissions(
+                self._make_request(page_request).content,
+                form_versions,
+                **options
             )
-        else:
-            # Else, assume that the sequence is composed of strings(form ids).
-            submissions_data_ids: Sequence[str] = cast(
-                Sequence[str],
-                submissions_data
+
+        if self._max_workers == 1:
+            yield from map(_get_page, page_requests)
+            return
+
+        with ThreadPoolExecutor(
+                max_workers=self._max_workers,
+                thread_name_prefix="http_transport"
+        ) as executor:
+            yield from bounded_ordered_map(
+                executor,
+                _get_page,
+                page_requests,
+                max_in_flight=self._max_workers
             )
-            submissions = tuple(
-                map(
-                    lambda _s_id: self.get_submission(
-                        form_id,
-                        _s_id,
-                        form_versions
-                    ),
-                    submissions_data_ids
+
+    def _iter_submissions(
+            self,
+            form_id: str,
+            submission_ids: Sequence[str],
+            form_versions: Mapping[str, XForm],
+            **options: TransportOptions
+    ) -> Iterator[PrimaryInstanceDocumentRoot]:
+        def _get_submission(
+                submission_id: str
+        ) -> Optional[PrimaryInstanceDocumentRoot]:
+            # Isolate failures to the submission being retrieved.
+            try:
+                return self.get_submission(
+                    form_id,
+                    submission_id,
+                    form_versions,
+                    **options
+                )
+            except Exception:  # noqa
+                LOGGER.exception(
+                    'Unable to retrieve the submission with id="%s" of the '
+                    'form with id="%s", skipping it.',
+                    submission_id,
+                    form_id
+                )
+                return None
+
+        if self._max_workers == 1:
+            yield from filter(None, map(_get_submission, submission_ids))
+            return
+
+        with ThreadPoolExecutor(
+                max_workers=self._max_workers,
+                thread_name_prefix="http_transport"
+        ) as executor:
+            yield from filter(
+                None,
+                bounded_ordered_map(
+                    executor,
+                    _get_submission,
+                    submission_ids,
+                    max_in_flight=self._max_workers * 2
                 )
             )
-        return {
-            _submission.version: _submission
-            for _submission in submissions
-        }
 
-    # OTHER HELPERS
-    # -------------------------------------------------------------------------
     def _authenticate(self) -> AuthBase:
         LOGGER.info("Authenticating HTTP transport on data source")
         request: AdapterRequestParams = self._transport_adapter.authenticate()
-        response: Response = self._session.request(
-            data=request.get("data"),
-            headers=request.get("headers"),
-            method=request["method"],
-            params=request.get("params"),
-            url=request["url"],
-            timeout=self._timeout  # type: ignore
-        )
+        response: Response = self._send(request, auth=None)
 
         # If authentication was unsuccessful, there is not much that can be
         # done, just log it and raise an exception.
@@ -281,16 +573,13 @@ class HTTPTransport(Transport):
             request["url"]
         )
         LOGGER.info(request_message)
-        response: Response = self._session.request(
-            data=request.get("data"),
-            headers=request.get("headers"),
-            method=request["method"],
-            params=request.get("params"),
-            url=request["url"],
-            auth=self._auth,
-            timeout=self._timeout  # type: ignore
-        )
-        if response.status_code != request["expected_http_status_code"]:
+        attempt: int = 0
+        while True:
+            auth: AuthBase = self._auth
+            response: Response = self._send(request, auth=auth)
+            if response.status_code == request["expected_http_status_code"]:
+                return response
+
             LOGGER.debug(
                 (
                     'Got an unexpected HTTP status, expected="%d", but got'
@@ -302,7 +591,7 @@ class HTTPTransport(Transport):
             # If the received response status was not what was expected, check
             # if the status is among the re-authentication trigger status and
             # if so, re-authenticate and then retry this request.
-            if response.status_code in self._transport_adapter.authentication_trigger_statuses:  # noqa
+            if response.status_code in self._transport_adapter.authentication_trigger_statuses and attempt < MAX_REAUTHENTICATION_ATTEMPTS:  # noqa
                 LOGGER.debug(
                     (
                         'Encountered an authentication trigger status("%d"), '
@@ -310,12 +599,15 @@ class HTTPTransport(Transport):
                     ),  # noqa
                     response.status_code
                 )
-                self._auth = self._authenticate()
+                attempt += 1
+                self._reauthenticate(stale_auth=auth, request=request)
                 LOGGER.debug(
                     "Re-authentication successful, retrying the request."
                 )
-                # FIXME: This could lead into a stack overflow, revisit this.
-                return self._make_request(request)
+                self._metrics_registry.record_retry(
+                    get_request_endpoint(request)
+                )
+                continue
 
             # If not, then an error has occurred, log the error the raise an
             # exception.
@@ -329,6 +621,54 @@ class HTTPTransport(Transport):
             )
             LOGGER.error(error_message)
             raise TransportError(error_message)
+
+    def _reauthenticate(
+            self,
+            stale_auth: AuthBase,
+            request: AdapterRequestParams
+    ) -> None:
+        # Concurrent requests may all fail with a stale authentication at the
+        # same time, only the first one of them needs to re-authenticate.
+        with self._auth_lock:
+            if self._auth is stale_auth:
+                self._metrics_registry.record_reauthentication(
+                    get_request_endpoint(request)
+                )
+                self._auth = self._authenticate()
+
+    def _send(
+            self,
+            request: AdapterRequestParams,
+            auth: Optional[AuthBase]
+    ) -> Response:
+        # Connections are established, and timed, on the calling thread.
+        _reset_connect_seconds()
+        started_at: float = time.perf_counter()
+        try:
+            response: Response = self._session.request(
+                data=request.get("data"),
+                headers=request.get("headers"),
+                method=request["method"],
+                params=request.get("params"),
+                url=request["url"],
+                auth=auth,
+                timeout=self._timeout  # type: ignore
+            )
+        except Exception:
+            self._metrics_registry.record_request(
+                get_request_endpoint(request),
+                status_code=None,
+                total_seconds=time.perf_counter() - started_at,
+                connect_seconds=_pop_connect_seconds()
+            )
+            raise
+        self._metrics_registry.record_request(
+            get_request_endpoint(request),
+            status_code=response.status_code,
+            total_seconds=time.perf_counter() - started_at,
+            connect_seconds=_pop_connect_seconds(),
+            bytes_received=len(response.content)
+        )
         return response
 
     @staticmethod
@@ -357,3 +697,56 @@ class _HTTPTransportAuth(AuthBase):
     def __call__(self, r: PreparedRequest, *args, **kwargs) -> PreparedRequest:
         r.headers.update(self._auth_headers)
         return r
+
+
+# =============================================================================
+# TIMED CONNECTIONS
+# =============================================================================
+
+class _TimedHTTPConnection(HTTPConnection):
+    # Add the time taken to connect to the time spent connecting by the
+    # current thread, see `HTTPTransport._send`.
+
+    def connect(self) -> None:
+        started_at: float = time.perf_counter()
+        try:
+            super().connect()
+        finally:
+            _add_connect_seconds(time.perf_counter() - started_at)
+
+
+class _TimedHTTPSConnection(HTTPSConnection):
+    # Includes the TLS handshake.
+
+    def connect(self) -> None:
+        started_at: float = time.perf_counter()
+        try:
+            super().connect()
+        finally:
+            _add_connect_seconds(time.perf_counter() - started_at)
+
+
+class _TimedHTTPConnectionPool(HTTPConnectionPool):
+    ConnectionCls: Type[HTTPConnection] = _TimedHTTPConnection
+
+
+class _TimedHTTPSConnectionPool(HTTPSConnectionPool):
+    ConnectionCls: Type[HTTPSConnection] = _TimedHTTPSConnection
+
+
+class _TimedHTTPAdapter(HTTPAdapter):
+    """
+    An `HTTPAdapter` whose connections record the time taken to establish
+    them. Connections through proxies are not timed.
+    """
+
+    def init_poolmanager(self, *args, **kwargs) -> None:
+        super().init_poolmanager(*args, **kwargs)
+        pool_classes_by_scheme: Dict[
+            str,
+            Union[Type[HTTPConnectionPool], Type[HTTPSConnectionPool]]
+        ] = {
+            "http": _TimedHTTPConnectionPool,
+            "https": _TimedHTTPSConnectionPool
+        }
+        self.poolmanager.pool_classes_by_scheme = pool_classes_by_scheme
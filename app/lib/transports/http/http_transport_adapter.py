@@ -1,3 +1,4 @@
+import hashlib
 from abc import ABCMeta, abstractmethod
 from typing import Mapping, Sequence, Union
 
@@ -15,6 +16,11 @@ class HTTPTransportAdapter(metaclass=ABCMeta):
     different OpenRosa server implementations.
     """
 
+    def close(self) -> None:
+        # Release the resources held by this adapter. Called when the
+        # transport using this adapter is closed. Does nothing by default.
+        ...
+
     # AUTHENTICATION
     # -------------------------------------------------------------------------
     @property
@@ -90,6 +96,25 @@ class HTTPTransportAdapter(metaclass=ABCMeta):
     ) -> Union[Sequence[str], Sequence[XForm]]:
         ...
 
+    def response_to_form_hash(
+            self,
+            response_content: bytes,
+            **options: TransportOptions
+    ) -> str:
+        # Return a hash of a form's definition. This should match the hashes
+        # returned by `response_to_form_versions_hashes`.
+        return hashlib.md5(response_content).hexdigest()
+
+    def response_to_form_versions_hashes(
+            self,
+            response_content: bytes,
+            **options: TransportOptions
+    ) -> Mapping[str, str]:
+        # Return the hashes of the listed form versions definitions keyed by
+        # version. These are used to validate cached forms without retrieving
+        # the forms. No hashes are available by default.
+        return dict()
+
     # SUBMISSION RETRIEVAL
     # -------------------------------------------------------------------------
     @abstractmethod
@@ -109,6 +134,17 @@ class HTTPTransportAdapter(metaclass=ABCMeta):
     ) -> AdapterRequestParams:
         ...
 
+    def list_form_submissions_page_requests(
+            self,
+            form_id: str,
+            response_content: bytes,
+            **options: TransportOptions
+    ) -> Sequence[AdapterRequestParams]:
+        # Return the requests for the remaining pages of a paged submissions
+        # listing given the response to the first page. Listings are not
+        # paged by default.
+        return tuple()
+
     @abstractmethod
     def response_to_submission(
             self,
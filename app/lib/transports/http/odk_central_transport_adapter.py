@@ -1,11 +1,33 @@
 import io
 import json
-from typing import Any, Mapping, Optional, Union, Sequence
+import logging
+from datetime import datetime
+from threading import Lock
+from typing import (
+    Any,
+    Dict,
+    List,
+    Mapping,
+    Optional,
+    Sequence,
+    Set,
+    Union,
+    cast
+)
 
 from lxml import etree
 
-from app.core import PrimaryInstanceDocumentRoot, TransportOptions, XForm
-from app.loaders.load_submission import do_load_submission
+from app.core import (
+    PrimaryInstanceDocumentRoot,
+    TransportError,
+    TransportOptions,
+    XForm
+)
+from app.loaders.load_submission import (
+    SubmissionParserPool,
+    do_load_submission,
+    do_load_submission_values
+)
 from app.loaders.load_xform import do_load_form
 from app.utils import ensure_not_none_nor_empty as not_empty
 
@@ -16,9 +38,64 @@ from .http_transport_adapter import AdapterRequestParams, HTTPTransportAdapter
 # CONSTANTS
 # =============================================================================
 
+LOGGER = logging.getLogger(__name__)
+
 _GET_METHOD: str = "GET"
 _POST_METHOD: str = "POST"
 
+_ODATA_SUBMISSIONS_SOURCE: str = "odata"
+_REST_SUBMISSIONS_SOURCE: str = "rest"
+
+_DEFAULT_PAGE_SIZE: int = 1000
+
+# The suffix of the keys of OData properties linking to the rows of a repeat
+# group, e.g. "household@odata.navigationLink".
+_ODATA_NAVIGATION_LINK_SUFFIX: str = "@odata.navigationLink"
+
+
+# =============================================================================
+# HELPERS
+# =============================================================================
+
+def _odata_value_to_submission_value(value: Any) -> Any:
+    # Convert an OData value to the value of its question as found on a
+    # submission's xml document.
+    if value is None or isinstance(value, str):
+        return value
+    if isinstance(value, bool):
+        return "true" if value else "false"
+    if isinstance(value, float) and value.is_integer():
+        # Match the xml document, e.g. "1" and not "1.0".
+        return str(int(value))
+    if isinstance(value, (int, float)):
+        return str(value)
+    if isinstance(value, Mapping):
+        _value: Mapping[str, Any] = cast(Mapping[str, Any], value)
+        # Geo data is represented as GeoJSON, with longitude first.
+        if _value.get("type") == "Point" and "coordinates" in _value:
+            coordinates: List[Any] = list(_value["coordinates"])
+            coordinates[0], coordinates[1] = coordinates[1], coordinates[0]
+            accuracy: Any = (_value.get("properties") or {}).get("accuracy")
+            return " ".join(map(str, coordinates + (
+                [accuracy] if accuracy is not None else []
+            )))
+        # Else, this is a group.
+        return {
+            _name: _odata_value_to_submission_value(_sub_value)
+            for _name, _sub_value in _value.items()
+        }
+    return None
+
+
+def _has_repeats(row: Mapping[str, Any]) -> bool:
+    # Repeat groups are either linked to, or expanded as lists of rows.
+    return any(
+        _name.endswith(_ODATA_NAVIGATION_LINK_SUFFIX)
+        or isinstance(_value, list)
+        or (isinstance(_value, Mapping) and _has_repeats(_value))
+        for _name, _value in row.items()
+    )
+
 
 # =============================================================================
 # ADAPTER
@@ -27,6 +104,34 @@ _POST_METHOD: str = "POST"
 class ODKCentralHTTPTransportAdapter(HTTPTransportAdapter):
     """A `HTTPTransportAdapter` to an ODK Central instance.
 
+    Submissions are retrieved from one of two sources, selected using the
+    `submissions_source` parameter:
+
+    * "rest" (the default), the ids of a form's submissions are listed using
+      the REST API and then each submission is retrieved as an xml document.
+    * "odata", a form's submissions are retrieved in pages of `page_size`
+      submissions from the form's OData submissions feed. The submissions data
+      is loaded directly from the feed's json rows, replacing a request per
+      submission with a few large requests.
+
+    When the "submitted_after" option, a timezone aware `datetime`, is given
+    when listing a form's submissions, only the submissions received by the
+    server after the given datetime are requested. This is always done
+    through the form's OData submissions feed since the REST submissions
+    listing endpoint doesn't support filtering. With the "rest" source, the
+    ids of the submissions are then listed in pages of `page_size` ids.
+
+    When `parse_workers` is given, the xml documents of submissions
+    retrieved from the "rest" source are parsed on a `SubmissionParserPool`
+    of that many worker processes instead of on the calling thread. The
+    worker processes are stopped when the adapter is closed.
+
+    Note: The "odata" source does not support repeat groups. The OData feed
+        only links to the rows of a form's repeat groups, which are held on
+        separate feeds, and the answers to the questions of repeat groups
+        are left empty. A warning is logged for each form with repeat
+        groups. Use the "rest" source for such forms.
+
     Note: Each `ODKCentralHTTPTransportAdapter` works within the context of a
         single ODK Central project.
     """
@@ -37,7 +142,10 @@ class ODKCentralHTTPTransportAdapter(HTTPTransportAdapter):
             project_id: str,
             email: str,
             password: str,
-            api_version: Optional[str]
+            api_version: Optional[str],
+            submissions_source: Optional[str] = None,
+            page_size: Optional[int] = None,
+            parse_workers: Optional[int] = None
     ):
         self._instance_host_url: str = not_empty(
             instance_host_url,
@@ -61,8 +169,37 @@ class ODKCentralHTTPTransportAdapter(HTTPTransportAdapter):
             self._api_version,
             self._project_id
         )
+        # The template of the path of the project's endpoints, see
+        # `AdapterRequestParams`.
+        self._base_endpoint: str = "/%s/projects/{projectId}" % (
+            self._api_version
+        )
+        self._submissions_source: str = (
+            submissions_source or _REST_SUBMISSIONS_SOURCE
+        )
+        assert self._submissions_source in (
+            _ODATA_SUBMISSIONS_SOURCE,
+            _REST_SUBMISSIONS_SOURCE
+        ), '"submissions_source" MUST be one of "odata" or "rest".'
+        self._page_size: int = page_size or _DEFAULT_PAGE_SIZE
+        assert self._page_size > 0, '"page_size" MUST be greater than 0.'
+        self._parse_workers: Optional[int] = parse_workers
+        assert self._parse_workers is None or self._parse_workers > 0, (
+            '"parse_workers" MUST be greater than 0.'
+        )
+        self._parser_pool: Optional[SubmissionParserPool] = None
+        self._parser_pool_lock: Lock = Lock()
+        # The forms whose lack of repeat groups support was warned about.
+        self._repeats_warned_forms: Set[str] = set()
+        self._repeats_warned_forms_lock: Lock = Lock()
         self._authentication_trigger_statuses: Sequence[int] = (400,)
 
+    def close(self) -> None:
+        with self._parser_pool_lock:
+            if self._parser_pool is not None:
+                self._parser_pool.shutdown()
+                self._parser_pool = None
+
     # AUTHENTICATION
     # -------------------------------------------------------------------------
     @property
@@ -83,6 +220,7 @@ class ODKCentralHTTPTransportAdapter(HTTPTransportAdapter):
                 "password": self._password
             }),
             "expected_http_status_code": 200,
+            "endpoint": "/%s/sessions" % self._api_version,
             "method": _POST_METHOD,
             "url": "%s/%s/sessions" % (
                 self._instance_host_url,
@@ -111,6 +249,10 @@ class ODKCentralHTTPTransportAdapter(HTTPTransportAdapter):
                 "Accept": "application/xml"
             },
             "expected_http_status_code": 200,
+            "endpoint": (
+                "%s/forms/{xmlFormId}/versions/{version}.xml" %
+                self._base_endpoint
+            ),
             "method": _GET_METHOD,
             "url": "%s/forms/%s/versions/%s.xml" % (
                 self._base_url, form_id, version
@@ -127,6 +269,7 @@ class ODKCentralHTTPTransportAdapter(HTTPTransportAdapter):
                 "Accept": "application/json"
             },
             "expected_http_status_code": 200,
+            "endpoint": "%s/forms/{xmlFormId}/versions" % self._base_endpoint,
             "method": _GET_METHOD,
             "url": "%s/forms/%s/versions" % (self._base_url, form_id)
         }
@@ -140,6 +283,7 @@ class ODKCentralHTTPTransportAdapter(HTTPTransportAdapter):
                 "Accept": "application/json"
             },
             "expected_http_status_code": 200,
+            "endpoint": "%s/forms" % self._base_endpoint,
             "method": _GET_METHOD,
             "url": "%s/forms" % self._base_url
         }
@@ -166,6 +310,21 @@ class ODKCentralHTTPTransportAdapter(HTTPTransportAdapter):
              for _version_data in versions_data)
         )
 
+    def response_to_form_versions_hashes(
+            self,
+            response_content: bytes,
+            **options: TransportOptions
+    ) -> Mapping[str, str]:
+        # ODK Central lists the MD5 sum of each version's definition.
+        versions_data: Sequence[Mapping[str, Any]] = json.loads(
+            response_content
+        )
+        return {
+            _version_data["version"]: _version_data["hash"]
+            for _version_data in versions_data
+            if _version_data.get("hash")
+        }
+
     def response_to_forms(
             self,
             response_content: bytes,
@@ -187,6 +346,10 @@ class ODKCentralHTTPTransportAdapter(HTTPTransportAdapter):
                 "Accept": "application/xml"
             },
             "expected_http_status_code": 200,
+            "endpoint": (
+                "%s/forms/{xmlFormId}/submissions/{instanceId}.xml" %
+                self._base_endpoint
+            ),
             "method": _GET_METHOD,
             "url": "%s/forms/%s/submissions/%s.xml" % (
                 self._base_url,
@@ -200,11 +363,36 @@ class ODKCentralHTTPTransportAdapter(HTTPTransportAdapter):
             form_id: str,
             **options: TransportOptions
     ) -> AdapterRequestParams:
+        submitted_after: Optional[datetime] = cast(
+            Optional[datetime],
+            options.get("submitted_after")
+        )
+        if self._submissions_source == _ODATA_SUBMISSIONS_SOURCE:
+            return self._odata_submissions_request(
+                form_id,
+                submitted_after,
+                **{"$count": "true", "$top": str(self._page_size)}
+            )
+        # Filtered submissions are listed, one page of ids at a time, from
+        # the OData feed.
+        if submitted_after is not None:
+            return self._odata_submissions_request(
+                form_id,
+                submitted_after,
+                **{
+                    "$count": "true",
+                    "$select": "__id",
+                    "$top": str(self._page_size)
+                }
+            )
         return {
             "headers": {
                 "Accept": "application/json"
             },
             "expected_http_status_code": 200,
+            "endpoint": (
+                "%s/forms/{xmlFormId}/submissions" % self._base_endpoint
+            ),
             "method": _GET_METHOD,
             "url": "%s/forms/%s/submissions" % (
                 self._base_url,
@@ -212,12 +400,51 @@ class ODKCentralHTTPTransportAdapter(HTTPTransportAdapter):
             )
         }
 
+    def list_form_submissions_page_requests(
+            self,
+            form_id: str,
+            response_content: bytes,
+            **options: TransportOptions
+    ) -> Sequence[AdapterRequestParams]:
+        submitted_after: Optional[datetime] = cast(
+            Optional[datetime],
+            options.get("submitted_after")
+        )
+        params: Dict[str, str] = dict()
+        if self._submissions_source != _ODATA_SUBMISSIONS_SOURCE:
+            # Only filtered listings of submission ids are paged.
+            if submitted_after is None:
+                return tuple()
+            params["$select"] = "__id"
+        submissions_count: int = json.loads(response_content).get(
+            "@odata.count",
+            0
+        )
+        return tuple(
+            self._odata_submissions_request(
+                form_id,
+                submitted_after,
+                **params,
+                **{"$skip": str(_skip), "$top": str(self._page_size)}
+            )
+            for _skip in range(
+                self._page_size,
+                submissions_count,
+                self._page_size
+            )
+        )
+
     def response_to_submission(
             self,
             response_content: bytes,
             form_version: Mapping[str, XForm],
             **options: TransportOptions
     ) -> PrimaryInstanceDocumentRoot:
+        if self._parse_workers is not None:
+            return self._get_parser_pool(form_version).parse(
+                response_content,
+                form_version
+            )
         return do_load_submission(
             etree.parse(io.BytesIO(response_content)),
             form_version
@@ -229,10 +456,123 @@ class ODKCentralHTTPTransportAdapter(HTTPTransportAdapter):
             form_version: Mapping[str, XForm],
             **options: TransportOptions
     ) -> Union[Sequence[str], Sequence[PrimaryInstanceDocumentRoot]]:
-        submission_data: Sequence[Mapping[str, Any]] = json.loads(
-            response_content
-        )
+        submission_data: Union[
+            Sequence[Mapping[str, Any]],
+            Mapping[str, Any]
+        ] = json.loads(response_content)
+        if self._submissions_source == _ODATA_SUBMISSIONS_SOURCE:
+            rows: Sequence[Mapping[str, Any]] = cast(
+                Mapping[str, Any],
+                submission_data
+            )["value"]
+            return tuple(filter(None, (
+                self._odata_row_to_submission(_row, form_version)
+                for _row in rows
+            )))
+        # Filtered submissions are listed from the OData feed.
+        if isinstance(submission_data, Mapping):
+            return tuple((
+                _submission_data["__id"]
+                for _submission_data in submission_data["value"]
+            ))
         return tuple((
             _submission_data["instanceId"]
             for _submission_data in submission_data
         ))
+
+    # OTHER HELPERS
+    # -------------------------------------------------------------------------
+    def _get_parser_pool(
+            self,
+            form_versions: Mapping[str, XForm]
+    ) -> SubmissionParserPool:
+        if self._parser_pool is None:
+            with self._parser_pool_lock:
+                if self._parser_pool is None:
+                    LOGGER.info(
+                        "Parsing submissions on %d worker processes",
+                        self._parse_workers
+                    )
+                    # Ship the plans of the already known form versions to
+                    # the workers on start up.
+                    self._parser_pool = SubmissionParserPool(
+                        max_workers=self._parse_workers,
+                        forms=tuple(form_versions.values())
+                    )
+        return self._parser_pool
+
+    def _odata_submissions_request(
+            self,
+            form_id: str,
+            submitted_after: Optional[datetime],
+            **params: str
+    ) -> AdapterRequestParams:
+        request_params: Dict[str, str] = dict(params)
+        if submitted_after is not None:
+            request_params["$filter"] = "__system/submissionDate gt %s" % (
+                submitted_after.isoformat()
+            )
+        return {
+            "headers": {
+                "Accept": "application/json"
+            },
+            "expected_http_status_code": 200,
+            "endpoint": (
+                "%s/forms/{xmlFormId}.svc/Submissions" % self._base_endpoint
+            ),
+            "method": _GET_METHOD,
+            "params": request_params,
+            "url": "%s/forms/%s.svc/Submissions" % (self._base_url, form_id)
+        }
+
+    def _odata_row_to_submission(
+            self,
+            row: Mapping[str, Any],
+            form_version: Mapping[str, XForm]
+    ) -> Optional[PrimaryInstanceDocumentRoot]:
+        system: Mapping[str, Any] = row.get("__system") or {}
+        meta: Mapping[str, Any] = row.get("meta") or {}
+        if _has_repeats(row):
+            self._warn_repeats_unsupported(
+                form_version,
+                system.get("formVersion", "")
+            )
+        # Isolate failures to the submission being loaded.
+        try:
+            return do_load_submission_values(
+                form_version=system.get("formVersion", ""),
+                meta={
+                    "instance_id": meta.get("instanceID") or row.get("__id"),
+                    "instance_name": meta.get("instanceName")
+                },
+                values=_odata_value_to_submission_value(row),
+                form_versions=form_version
+            )
+        except TransportError:
+            LOGGER.exception(
+                'Unable to load the submission with id="%s", skipping it.',
+                row.get("__id")
+            )
+            return None
+
+    def _warn_repeats_unsupported(
+            self,
+            form_versions: Mapping[str, XForm],
+            version: str
+    ) -> None:
+        form: Optional[XForm] = form_versions.get(version) or next(
+            iter(form_versions.values()),
+            None
+        )
+        form_id: str = form.id if form is not None else ""
+        with self._repeats_warned_forms_lock:
+            if form_id in self._repeats_warned_forms:
+                return
+            self._repeats_warned_forms.add(form_id)
+        LOGGER.warning(
+            'The submissions of the form with id="%s" have repeat groups, '
+            'which are not supported by the "odata" submissions source. The '
+            'answers to their questions are left empty, use the "rest" '
+            'submissions source to retrieve them.',
+            form_id
+        )
@@ -1,19 +1,59 @@
+import io
 import logging
-from typing import Mapping, Optional
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from threading import Lock
+from typing import (
+    Any,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    Mapping,
+    Optional,
+    Tuple,
+    cast
+)
+from weakref import WeakKeyDictionary
+from lxml import etree
 from lxml.etree import (
     _Element as Element,  # type: ignore
     _ElementTree as ElementTree  # type: ignore
 )
 
 from app.core import (
+    InstanceMetadata,
+    InstanceMetadataMapping,
     PrimaryInstanceDocumentRoot,
-    PrimaryInstanceMapping,
     Question,
-    QuestionMapping,
+    SubmissionDocumentRoot,
     TransportError,
     XForm
 )
-from .load_xform import load_primary_instance_content
+from .load_xform import load_instance_metadata
+
+
+# =============================================================================
+# TYPES
+# =============================================================================
+
+# A node of a loader plan. Maps the names of the questions at one level of a
+# form to each question's slot on the plan and the node of its sub questions.
+_PlanNode = Dict[str, Tuple[int, Optional[Dict[str, Any]]]]
+
+# The form id and version of a form version's loader plan.
+_PlanKey = Tuple[str, str]
+
+# A submission parsed on a parser pool worker. The form id and version the
+# submission refers to, followed by the submission's metadata and question
+# values or, when the worker has no loader plan for the form version, by
+# `None`s.
+_ParsedSubmission = Tuple[
+    str,
+    str,
+    Optional[InstanceMetadataMapping],
+    Optional[List[Optional[str]]]
+]
 
 
 # =============================================================================
@@ -22,31 +62,211 @@ from .load_xform import load_primary_instance_content
 
 LOGGER = logging.getLogger(__name__)
 
+# The compiled loader plans of each form version.
+_LOADER_PLANS: "WeakKeyDictionary[XForm, SubmissionLoaderPlan]" = (
+    WeakKeyDictionary()
+)
+
+_LOADER_PLANS_LOCK: Lock = Lock()
+
+# The loader plans available on a parser pool worker process.
+_WORKER_LOADER_PLANS: Dict[_PlanKey, "SubmissionLoaderPlan"] = dict()
+
 
 # =============================================================================
 # HELPERS
 # =============================================================================
 
-def _load_question_submission_data(
+def _iter_questions(questions: Mapping[str, Question]) -> Iterator[Question]:
+    # Yield the given questions and their sub questions, depth first.
+    for _question in questions.values():
+        yield _question
+        if _question.sub_questions:
+            yield from _iter_questions(_question.sub_questions)
+
+
+def _load_question_values(
         question: Question,
-        question_submission_data: QuestionMapping
+        values: Mapping[str, Any]
+) -> None:
+    value: Any = values.get(question.name)
+    if not question.sub_questions:
+        question.value = value
+        return
+
+    # Compound questions hold a mapping of their sub questions values.
+    question.value = None
+    sub_questions_values: Mapping[str, Any] = (
+        value if isinstance(value, Mapping) else dict()
+    )
+    for _sub_question in question.sub_questions.values():
+        _load_question_values(_sub_question, sub_questions_values)
+
+
+def _init_parser_worker(
+        plans: Mapping[_PlanKey, "SubmissionLoaderPlan"]
 ) -> None:
-    # Set the question value.
-    question.value = question_submission_data.get("value")
-
-    # If question has sub questions, then load the sub question values too.
-    if question.sub_questions:
-        assert question_submission_data["sub_questions"] is not None, (
-            'The submission data for question "%s" should have '
-            "sub-questions." % question_submission_data["name"]
+    _WORKER_LOADER_PLANS.update(plans)
+
+
+def _parse_submission(
+        submission_content: bytes,
+        plans: Optional[Mapping[_PlanKey, "SubmissionLoaderPlan"]] = None
+) -> _ParsedSubmission:
+    # Runs on a parser pool worker process.
+    if plans:
+        _WORKER_LOADER_PLANS.update(plans)
+    document_root: Element = etree.parse(
+        io.BytesIO(submission_content)
+    ).getroot()
+    form_id: str = document_root.attrib.get("id", "")
+    form_version: str = document_root.attrib["version"]
+    plan: Optional[SubmissionLoaderPlan] = _WORKER_LOADER_PLANS.get(
+        (form_id, form_version)
+    )
+    if plan is None:
+        return form_id, form_version, None, None
+    return (
+        form_id,
+        form_version,
+        load_instance_metadata(document_root),
+        plan.load_values(document_root)
+    )
+
+
+def _get_form_version(
+        form_version: str,
+        form_versions: Mapping[str, XForm]
+) -> XForm:
+    # Ensure that the given form and submission data are of the same version
+    form: Optional[XForm] = form_versions.get(form_version)
+    if form is None:
+        error_message: str = (
+            'The given submission refers to a non-existent form version: "%s".'
+            ' Available form versions are: "%s"'
+            % (form_version, ",".join(form_versions))
+        )
+        LOGGER.error(error_message)
+        raise TransportError(error_message)
+    return form
+
+
+# =============================================================================
+# SUBMISSION LOADER PLAN
+# =============================================================================
+
+class SubmissionLoaderPlan:
+    """
+    A compiled plan for loading the submissions of a form version.
+
+    Each question of the form, including sub questions, is assigned a slot
+    on the plan in depth first order. The plan maps the element names of a
+    submission to these slots so that a submission's values are read in a
+    single pass over its elements, without building an intermediate mapping
+    of the submission.
+
+    Submission elements that don't match a question of the form are ignored
+    and questions without a matching element are left without a value. When
+    an element is repeated, the value of the last one wins.
+    """
+
+    def __init__(self, form: XForm):
+        self._slots_count: int = 0
+        self._root: _PlanNode = self._compile(
+            form.primary_instance.document_root.questions
         )
 
-        subs_submissions_data = question_submission_data["sub_questions"]
-        for _sub_question in question.sub_questions.values():
-            _load_question_submission_data(
-                _sub_question,
-                subs_submissions_data[_sub_question.name]
+    @property
+    def slots_count(self) -> int:
+        """The number of questions, including sub questions, of the form."""
+        return self._slots_count
+
+    def load(
+            self,
+            document_root: Element,
+            submission: PrimaryInstanceDocumentRoot
+    ) -> None:
+        """Load the question values of a submission.
+
+        :param document_root: The document root element of the submission.
+        :param submission: A submission template of the plan's form version
+               whose question values to set.
+        """
+        values: List[Optional[str]] = self.load_values(document_root)
+        # Both the plan and the submission template assign slots in depth
+        # first order, so the values can be set all at once.
+        if isinstance(submission, SubmissionDocumentRoot):
+            submission.set_values(values)
+            return
+        for _question, _value in zip(
+                _iter_questions(submission.questions),
+                values
+        ):
+            _question.value = _value
+
+    def load_values(self, document_root: Element) -> List[Optional[str]]:
+        """Read the question values of a submission into a list of slots.
+
+        :param document_root: The document root element of the submission.
+
+        :return: The value of each question of the form, in slot order.
+        """
+        values: List[Optional[str]] = [None] * self._slots_count
+        self._load_element_values(document_root, self._root, values)
+        return values
+
+    def _compile(self, questions: Mapping[str, Question]) -> _PlanNode:
+        node: _PlanNode = dict()
+        for _question in questions.values():
+            slot: int = self._slots_count
+            self._slots_count += 1
+            node[_question.name] = (
+                slot,
+                self._compile(_question.sub_questions)
+                if _question.sub_questions else None
             )
+        return node
+
+    @classmethod
+    def _load_element_values(
+            cls,
+            element: Element,
+            node: _PlanNode,
+            values: List[Optional[str]]
+    ) -> None:
+        _child: Element
+        for _child in element:
+            tag: Any = _child.tag
+            # Skip comments and processing instructions.
+            if not isinstance(tag, str):
+                continue
+            entry = node.get(tag[tag.rfind("}") + 1:])
+            if entry is None:
+                continue
+            slot, sub_node = entry
+            values[slot] = (_child.text or "").strip() or None
+            if sub_node is not None:
+                cls._load_element_values(_child, sub_node, values)
+
+
+def get_submission_loader_plan(form: XForm) -> SubmissionLoaderPlan:
+    """
+    Return the loader plan of a form version, compiling it on first use.
+
+    The compiled plans are cached for as long as their forms are alive.
+
+    :param form: The form version whose loader plan to return.
+
+    :return: The loader plan of the given form version.
+    """
+    plan: Optional[SubmissionLoaderPlan] = _LOADER_PLANS.get(form)
+    if plan is None:
+        with _LOADER_PLANS_LOCK:
+            plan = _LOADER_PLANS.get(form)
+            if plan is None:
+                plan = SubmissionLoaderPlan(form)
+                _LOADER_PLANS[form] = plan
+    return plan
 
 
 # =============================================================================
@@ -58,33 +278,149 @@ def do_load_submission(
         form_versions: Mapping[str, XForm],
 ) -> PrimaryInstanceDocumentRoot:
     document_root: Element = submission_xml.getroot()
-    submission_data: PrimaryInstanceMapping = load_primary_instance_content(
-        document_root,
-        document_root
+    form: XForm = _get_form_version(
+        cast(str, document_root.attrib["version"]),
+        form_versions
     )
-    # Ensure that the given form and submission data are of the same version
-    submission_data_version: str = submission_data["version"]
-    form: Optional[XForm] = form_versions.get(submission_data_version)
-    if form is None:
-        error_message: str = (
-            'The given submission refers to a non-existent form version: "%s".'
-            ' Available form versions are: "%s"'
-            % (submission_data_version, ",".join(form_versions))
-        )
-        LOGGER.error(error_message)
-        raise TransportError(error_message)
+    meta: InstanceMetadataMapping = load_instance_metadata(document_root)
     submission = form.create_form_submission_template()
     LOGGER.debug(
         'Loading submission with id="%s", for form with title="%s", id="%s" '
         'and version="%s"',
-        submission_data["meta"]["instance_id"],
+        meta["instance_id"],
         form.title,
         form.id,
         form.version
     )
+    submission.meta = InstanceMetadata.of_mapping(meta)
+    get_submission_loader_plan(form).load(document_root, submission)
+    return submission
+
+
+def do_load_submission_values(
+        form_version: str,
+        meta: InstanceMetadataMapping,
+        values: Mapping[str, Any],
+        form_versions: Mapping[str, XForm]
+) -> PrimaryInstanceDocumentRoot:
+    """
+    Load a submission from a mapping of its question values.
+
+    The values of compound questions are mappings of their sub questions
+    values keyed by the sub questions names. Questions missing from the
+    given values are left without a value.
+
+    :param form_version: The version of the form the submission belongs to.
+    :param meta: The submission's metadata.
+    :param values: The submission's question values keyed by question name.
+    :param form_versions: A mapping of all the known versions of the form
+           keyed by their version.
+
+    :return: The loaded submission.
+    """
+    form: XForm = _get_form_version(form_version, form_versions)
+    submission = form.create_form_submission_template()
+    LOGGER.debug(
+        'Loading submission with id="%s", for form with title="%s", id="%s" '
+        'and version="%s"',
+        meta["instance_id"],
+        form.title,
+        form.id,
+        form.version
+    )
+    submission.meta = InstanceMetadata.of_mapping(meta)
     for _question in submission.questions.values():
-        _load_question_submission_data(
-            _question,
-            submission_data["questions"][_question.name]
-        )
+        _load_question_values(_question, values)
     return submission
+
+
+# =============================================================================
+# SUBMISSIONS PARSER POOL
+# =============================================================================
+
+class SubmissionParserPool:
+    """
+    Parses submission xml documents on a pool of worker processes.
+
+    Parsing a submission and reading its question values is CPU bound, doing
+    it on worker processes spreads the work across cores instead of having
+    it contend for the GIL. Each worker only returns the submission's
+    metadata and its list of question values, which are then set on a
+    submission created from its form version's submission template.
+
+    The loader plan of each form version is shipped to each worker once,
+    either through the pool's initializer, for the form versions given on
+    creation, or along with the first submission of a form version that a
+    worker receives without having the form version's plan.
+
+    `parse` blocks until the submission is parsed, call it from as many
+    threads as there are workers to keep all the workers busy.
+    """
+
+    def __init__(
+            self,
+            max_workers: Optional[int] = None,
+            forms: Iterable[XForm] = ()
+    ):
+        # Workers are not forked from the, possibly multithreaded, calling
+        # process.
+        start_method: str = (
+            "forkserver"
+            if "forkserver" in multiprocessing.get_all_start_methods()
+            else "spawn"
+        )
+        self._executor: ProcessPoolExecutor = ProcessPoolExecutor(
+            max_workers=max_workers,
+            mp_context=multiprocessing.get_context(start_method),
+            initializer=_init_parser_worker,
+            initargs=({
+                (_form.id, _form.version): get_submission_loader_plan(_form)
+                for _form in forms
+            },)
+        )
+
+    def parse(
+            self,
+            submission_content: bytes,
+            form_versions: Mapping[str, XForm]
+    ) -> PrimaryInstanceDocumentRoot:
+        """Parse a submission xml document.
+
+        :param submission_content: The submission's xml document.
+        :param form_versions: A mapping of all the known versions of the
+               submission's form keyed by their version.
+
+        :return: The parsed submission.
+
+        :raise TransportError: If the submission's form version is not one
+               of the given form versions.
+        """
+        form_id, form_version, meta, values = self._executor.submit(
+            _parse_submission,
+            submission_content
+        ).result()
+        form: XForm = _get_form_version(form_version, form_versions)
+        if meta is None or values is None:
+            form_id, form_version, meta, values = self._executor.submit(
+                _parse_submission,
+                submission_content,
+                {(form_id, form_version): get_submission_loader_plan(form)}
+            ).result()
+            assert meta is not None and values is not None
+
+        submission = form.submission_template.create_submission()
+        LOGGER.debug(
+            'Loaded submission with id="%s", for form with title="%s", '
+            'id="%s" and version="%s"',
+            meta["instance_id"],
+            form.title,
+            form.id,
+            form.version
+        )
+        submission.meta = InstanceMetadata.of_mapping(meta)
+        submission.set_values(values)
+        return submission
+
+    def shutdown(self) -> None:
+        """Stop the pool's worker processes."""
+        self._executor.shutdown()
@@ -1,4 +1,4 @@
-from typing import Dict, Optional, Sequence, cast
+from typing import Dict, Mapping, Optional, Sequence, Tuple, cast
 from lxml.etree import (
     _Element as Element,  # type: ignore
     _ElementTree as ElementTree,  # type: ignore
@@ -7,6 +7,7 @@ from lxml.etree import (
 )
 
 from app.core import (
+    InstanceMetadataMapping,
     PrimaryInstanceMapping,
     QuestionMapping,
     SecondaryInstanceItemMapping,
@@ -16,6 +17,14 @@ from app.core import (
 from app.utils import ensure_not_none
 
 
+# =============================================================================
+# TYPES
+# =============================================================================
+
+# The question type and label of each body control keyed by the control's ref.
+BodyControls = Mapping[str, Tuple[str, str]]
+
+
 # =============================================================================
 # CONSTANTS
 # =============================================================================
@@ -45,6 +54,37 @@ get_secondary_instances = XPath(
 )
 
 
+def index_body_controls(xml_root: Element) -> BodyControls:
+    """
+    Index the body controls of a form by their refs in a single pass over the
+    form's body.
+
+    When multiple controls share the same ref, only the first one in document
+    order is indexed.
+
+    :param xml_root: The root element of the form.
+
+    :return: A mapping of the question type and label of each control keyed
+             by the control's ref.
+    """
+    body_controls: Dict[str, Tuple[str, str]] = dict()
+    _body: Element
+    _control: Element
+    for _body in xml_root.iterfind("./html:body", namespaces=NAMESPACES):
+        for _control in _body.iterdescendants("{*}*"):
+            control_ref: Optional[str] = _control.get("ref")
+            if control_ref is None or control_ref in body_controls:
+                continue
+            body_controls[control_ref] = (
+                QName(_control.tag).localname,
+                _control.findtext(
+                    path="./default:label",
+                    namespaces=NAMESPACES
+                ) or UNKNOWN
+            )
+    return body_controls
+
+
 # =============================================================================
 # LOADERS
 # =============================================================================
@@ -92,6 +132,7 @@ def load_primary_instance_content(
         xml_root: Element
 ) -> PrimaryInstanceMapping:
     document_root_name: str = QName(document_root).localname
+    body_controls: BodyControls = index_body_controls(xml_root)
     question_elements: Sequence[Element] = cast(
         Sequence[Element],
         document_root.xpath(
@@ -100,7 +141,7 @@ def load_primary_instance_content(
         )
     )
     questions_mappings: Sequence[QuestionMapping] = [
-        load_question(_qe, xml_root, "/%s" % document_root_name)
+        load_question(_qe, body_controls, "/%s" % document_root_name)
         for _qe in question_elements
     ]
     return {
@@ -112,24 +153,24 @@ def load_primary_instance_content(
                 questions_mappings
             )
         ),
-        "meta": {
-            "instance_id": document_root.findtext(
-                "./default:meta/default:instanceID",
-                namespaces=NAMESPACES
-            ),
-            "instance_name": document_root.findtext(
-                "./default:meta/default:instanceName",
-                namespaces=NAMESPACES
-            )
-        },
+        "meta": load_instance_metadata(document_root),
         "prefix": None,
         "delimiter": None
     }
 
 
+def load_instance_metadata(document_root: Element) -> InstanceMetadataMapping:
+    # Submissions don't always declare the XForms namespace as their default
+    # namespace, so match the metadata in any namespace.
+    return {
+        "instance_id": document_root.findtext("./{*}meta/{*}instanceID"),
+        "instance_name": document_root.findtext("./{*}meta/{*}instanceName")
+    }
+
+
 def load_question(
         xml_element: Element,
-        xml_root: Element,
+        body_controls: BodyControls,
         parent_question_ref: str
 ) -> QuestionMapping:
     question_name = QName(xml_element.tag).localname
@@ -148,22 +189,18 @@ def load_question(
     }
 
     # Extract the presentational details of a question
-    question_presentation_xml: Optional[Element] = xml_root.find(
-        "./html:body//*[@ref='%s']" % question_ref,
-        namespaces=NAMESPACES
+    question_presentation: Optional[Tuple[str, str]] = body_controls.get(
+        question_ref
     )
-    if question_presentation_xml is not None:
-        question_kwargs["question_type"] = QName(question_presentation_xml.tag).localname
-        question_kwargs["label"] = question_presentation_xml.findtext(
-            path="./default:label",
-            namespaces=NAMESPACES
-        ) or UNKNOWN
+    if question_presentation is not None:
+        question_kwargs["question_type"] = question_presentation[0]
+        question_kwargs["label"] = question_presentation[1]
 
     _sub_question_xml: Element
     for _sub_question_xml in xml_element:
         sub_question = load_question(
             _sub_question_xml,
-            xml_root,
+            body_controls,
             question_ref
         )
         question_kwargs["sub_questions"][sub_question["name"]] = sub_question  # type: ignore
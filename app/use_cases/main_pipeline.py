@@ -1,87 +1,692 @@
 import json
 import logging
-from typing import Any, Callable
+import os
+from contextlib import AbstractContextManager, ExitStack
+from datetime import datetime, timedelta, timezone
+from functools import partial
+from threading import Lock
+from typing import (
+    IO,
+    Any,
+    Callable,
+    Collection,
+    Dict,
+    Iterator,
+    List,
+    Mapping,
+    Optional,
+    Sequence,
+    Set,
+    Tuple
+)
 
-from app.core import AppData, Task, Transport
-from app.lib import Consumer
+from app.core import (
+    AppData,
+    PrimaryInstanceDocumentRoot,
+    Task,
+    ToJson,
+    Transport,
+    TransportError,
+    XForm
+)
+from app.lib import (
+    Consumer,
+    FlatMap,
+    PipelineHook,
+    Stage,
+    StreamingPipeline,
+    SyncStateStore,
+    ThreadedStreamingPipeline
+)
 from app.utils import ensure_not_none
 
+# =============================================================================
+# TYPES
+# =============================================================================
+
+FormSubmission = Tuple[XForm, PrimaryInstanceDocumentRoot]
+
+SubmissionConsumer = Task[FormSubmission, Any]
+
+# A form version's form and submissions, either as domain objects or as their
+# json representations.
+_JsonEntry = Tuple[Any, Sequence[Any]]
+
+
 # =============================================================================
 # CONSTANTS
 # =============================================================================
 
 LOGGER = logging.getLogger(__name__)
 
+# How far back before the last sync of a form to look for new submissions.
+# This accounts for clock differences between this app and the data source.
+_DEFAULT_WATERMARK_OVERLAP: timedelta = timedelta(hours=1)
+
+
+# =============================================================================
+# HELPERS
+# =============================================================================
+
+class _LazyFormVersions(Mapping[str, XForm]):
+    """
+    A mapping of the versions of a form that retrieves each missing version
+    from a transport the first time it is looked up.
+
+    Retrieved versions are memoized and handed over to the given `on_load`
+    callback. Looking up a version that cannot be retrieved raises a
+    `KeyError`. Lookups are safe to perform from multiple threads and each
+    version is retrieved at most once.
+    """
+
+    def __init__(
+            self,
+            transport: Transport,
+            form_id: str,
+            form_versions: Mapping[str, XForm],
+            on_load: Callable[[XForm], None]
+    ):
+        self._transport: Transport = transport
+        self._form_id: str = form_id
+        self._form_versions: Dict[str, XForm] = dict(form_versions)
+        self._missing_versions: Set[str] = set()
+        self._on_load: Callable[[XForm], None] = on_load
+        self._lock: Lock = Lock()
+
+    def __getitem__(self, version: str) -> XForm:
+        form: Optional[XForm] = self._form_versions.get(version)
+        if form is not None:
+            return form
+        with self._lock:
+            # The version might have been retrieved by another thread while
+            # this one was waiting for the lock.
+            if version in self._form_versions:
+                return self._form_versions[version]
+            if version in self._missing_versions:
+                raise KeyError(version)
+            LOGGER.info(
+                'Fetching version="%s" of the form with id="%s"',
+                version,
+                self._form_id
+            )
+            try:
+                form = self._transport.get_form(self._form_id, version)
+            except TransportError as exp:
+                LOGGER.warning(
+                    'Unable to retrieve version="%s" of the form with id="%s"',
+                    version,
+                    self._form_id,
+                    exc_info=True
+                )
+                self._missing_versions.add(version)
+                raise KeyError(version) from exp
+            self._form_versions[version] = form
+            self._on_load(form)
+            return form
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(tuple(self._form_versions))
+
+    def __len__(self) -> int:
+        return len(self._form_versions)
+
+
+def _copy_bytes(source: IO[bytes], target: IO[bytes], count: int) -> None:
+    while count > 0:
+        chunk: bytes = source.read(min(count, 1024 * 1024))
+        if not chunk:
+            return
+        target.write(chunk)
+        count -= len(chunk)
+
+
+def write_app_data_json(
+        entries: Mapping[str, Mapping[str, _JsonEntry]],
+        file_path: str,
+        **json_kwargs
+) -> None:
+    """
+    Write the forms and submissions of app data to a json file, in the
+    format written by `AppDataToJson`.
+
+    :param entries: Each form version's form and submissions, by version and
+           form id. Forms and submissions are either domain objects or their
+           json representations.
+    :param file_path: The file to write. Replaced if it exists.
+    :param json_kwargs: Other keyword arguments of `json.dumps`.
+    """
+    LOGGER.debug('Persisting app data to the file="%s"', file_path)
+
+    def _dumps(value: Any, level: int) -> str:
+        # Each value is dumped on its own and then indented to match its
+        # nesting level on the document.
+        return json.dumps(
+            value.to_json() if isinstance(value, ToJson) else value,
+            ensure_ascii=True,
+            check_circular=False,
+            indent=4,
+            **json_kwargs
+        ).replace("\n", "\n" + _indent(level))
+
+    def _indent(level: int) -> str:
+        return " " * 4 * level
+
+    def _separator(index: int, level: int) -> str:
+        return "%s\n%s" % ("," if index else "", _indent(level))
+
+    def _closing(token: str, is_empty: bool, level: int) -> str:
+        return token if is_empty else "\n%s%s" % (_indent(level), token)
+
+    # Write to a temporary file first to avoid clobbering the existing
+    # file if anything goes wrong.
+    temp_file_path: str = "%s.tmp" % file_path
+    with open(temp_file_path, "w") as json_output:
+        json_output.write("{")
+        for _f_index, (_form_id, _versions) in enumerate(entries.items()):
+            json_output.write(_separator(_f_index, 1))
+            json_output.write("%s: {" % _dumps(_form_id, 1))
+            for _v_index, (_version, (_form, _submissions)) in enumerate(
+                    _versions.items()
+            ):
+                json_output.write(_separator(_v_index, 2))
+                json_output.write("%s: {" % _dumps(_version, 2))
+                json_output.write(_separator(0, 3))
+                json_output.write('"form": %s' % _dumps(_form, 3))
+                json_output.write(_separator(1, 3))
+                json_output.write('"submissions": [')
+                for _s_index, _submission in enumerate(_submissions):
+                    json_output.write(_separator(_s_index, 4))
+                    json_output.write(_dumps(_submission, 4))
+                json_output.write(_closing("]", not _submissions, 3))
+                json_output.write(_closing("}", False, 2))
+            json_output.write(_closing("}", not _versions, 1))
+        json_output.write(_closing("}", not entries, 0))
+    os.replace(temp_file_path, file_path)
+
+
+def merge_json_files(
+        file_path: str,
+        source_file_paths: Sequence[str],
+        overlapping: bool = False
+) -> None:
+    """
+    Merge json files written by `AppDataToJson` into a single file.
+
+    Files written for disjoint sets of forms are merged without being
+    parsed, the entries of each file are copied as they are. The merged file
+    is identical to the file that would have been written for all the forms
+    at once.
+
+    When `overlapping` is `True`, the same forms may be present on several
+    files, e.g. files written for disjoint sets of submissions. The files
+    are then loaded and the submissions of each form version concatenated,
+    in the order of the files.
+
+    :param file_path: The file to write. Replaced if it exists.
+    :param source_file_paths: The files to merge, in order. Missing files are
+           skipped.
+    :param overlapping: Whether the same forms may be present on several
+           files.
+    """
+    LOGGER.debug('Merging app data into the file="%s"', file_path)
+    if overlapping:
+        _merge_overlapping_json_files(file_path, source_file_paths)
+        return
+    temp_file_path: str = "%s.tmp" % file_path
+    is_empty: bool = True
+    with open(temp_file_path, "wb") as merged_file:
+        merged_file.write(b"{")
+        for _source_file_path in source_file_paths:
+            if not os.path.exists(_source_file_path):
+                continue
+            # Non empty files are an opening brace, the entries and then a
+            # new line and a closing brace.
+            size: int = os.path.getsize(_source_file_path)
+            if size <= len(b"{}"):
+                continue
+            with open(_source_file_path, "rb") as source_file:
+                source_file.seek(len(b"{"))
+                if not is_empty:
+                    merged_file.write(b",")
+                _copy_bytes(
+                    source_file,
+                    merged_file,
+                    size - len(b"{") - len(b"\n}")
+                )
+            is_empty = False
+        merged_file.write(b"}" if is_empty else b"\n}")
+    os.replace(temp_file_path, file_path)
+
+
+def _merge_overlapping_json_files(
+        file_path: str,
+        source_file_paths: Sequence[str]
+) -> None:
+    entries: Dict[str, Dict[str, Tuple[Any, List[Any]]]] = dict()
+    for _source_file_path in source_file_paths:
+        if not os.path.exists(_source_file_path):
+            continue
+        with open(_source_file_path, "rb") as source_file:
+            app_data: Mapping[str, Any] = json.load(source_file)
+        for _form_id, _versions in app_data.items():
+            form_entries = entries.setdefault(_form_id, dict())
+            for _version, _entry in _versions.items():
+                submissions: List[Any] = (
+                    form_entries[_version][1]
+                    if _version in form_entries else []
+                )
+                submissions.extend(_entry["submissions"])
+                form_entries[_version] = (_entry["form"], submissions)
+    write_app_data_json(entries, file_path=file_path)
+
 
 # =============================================================================
 # MAIN PIPELINE TASKS
 # =============================================================================
 
 class FetchForms(Task[AppData, AppData]):
+    """
+    Retrieve the forms available on the data source.
+
+    When `lazy` is `True`, only the form ids are retrieved. The versions of
+    each form are then only retrieved by `FetchSubmissions` once a submission
+    refers to them. This avoids retrieving the historical versions of a form
+    that have no submissions to process.
 
-    def __init__(self, transport: Transport):
+    When `form_ids` are given, only the forms with the given ids are
+    retrieved. When a `form_filter` is given, only the forms whose ids it
+    accepts are retrieved.
+    """
+
+    def __init__(
+            self,
+            transport: Transport,
+            lazy: bool = False,
+            form_ids: Optional[Collection[str]] = None,
+            form_filter: Optional[Callable[[str], bool]] = None
+    ):
         self._transport: Transport = transport
+        self._lazy: bool = lazy
+        self._form_ids: Optional[Collection[str]] = form_ids
+        self._form_filter: Optional[Callable[[str], bool]] = form_filter
 
     def execute(self, an_input: AppData) -> AppData:
         LOGGER.info("Fetching forms")
+        if self._lazy:
+            for _form_id in self._list_form_ids():
+                an_input.add_form_id(_form_id)
+            return an_input
+
+        if self._form_ids is not None or self._form_filter is not None:
+            for _form_id in self._list_form_ids():
+                for _form in self._transport.list_form_versions(_form_id):
+                    an_input.add_form(_form)
+            return an_input
+
         for form in self._transport.list_forms():
             an_input.add_form(form)
         return an_input
 
+    def _list_form_ids(self) -> Sequence[str]:
+        form_ids: Collection[str] = (
+            self._form_ids
+            if self._form_ids is not None
+            else self._transport.list_form_ids()
+        )
+        if self._form_filter is None:
+            return tuple(form_ids)
+        return tuple(filter(self._form_filter, form_ids))
+
 
 class AppDataToJson(Consumer[AppData]):
+    """
+    Persist the app data to a json file.
 
-    def __init__(self, file_path: str = "all_forms.json", **json_kwargs):
+    The app data is serialized one form and one submission at a time instead
+    of first converting the whole app data into a single json document.
+
+    When `merge_existing` is `True` and the file already exists, the app data
+    is merged into the file's contents instead of replacing them. Forms
+    replace the existing forms with the same id and version while
+    submissions are added to the existing submissions, replacing those with
+    the same instance id.
+
+    When `with_submissions` is `False`, only the forms are persisted, each
+    with an empty list of submissions.
+
+    `bytes_written` is the size of the files written so far.
+    """
+
+    def __init__(
+            self,
+            file_path: str = "all_forms.json",
+            merge_existing: bool = False,
+            with_submissions: bool = True,
+            **json_kwargs
+    ):
         ensure_not_none(file_path, message='"file_path" MUST be provided.')
-        _consume: Callable[[AppData], None] = (
-            lambda _item: self._persist_to_json_file(
-                app_data=self._forms_to_json(_item),
+        self._bytes_written: int = 0
+
+        def _consume(_item: AppData) -> None:
+            write_app_data_json(
+                entries=self._to_json_entries(
+                    app_data=_item,
+                    existing=(
+                        self._load_json_file(file_path)
+                        if merge_existing else dict()
+                    ),
+                    with_submissions=with_submissions
+                ),
                 file_path=file_path,
                 **json_kwargs
             )
-        )
+            self._bytes_written += os.path.getsize(file_path)
+
         super().__init__(_consume)
 
+    @property
+    def bytes_written(self) -> int:
+        return self._bytes_written
+
     @staticmethod
-    def _forms_to_json(app_data: AppData) -> Any:
-        LOGGER.debug("Converting app data to json")
-        return app_data.to_json()
+    def _load_json_file(file_path: str) -> Mapping[str, Any]:
+        if not os.path.exists(file_path):
+            return dict()
+        LOGGER.debug('Loading existing app data from the file="%s"', file_path)
+        with open(file_path, "rb") as json_input:
+            return json.load(json_input)
 
     @staticmethod
-    def _persist_to_json_file(
-            app_data: Any,
-            file_path: str,
-            **json_kwargs
-    ) -> None:
-        LOGGER.debug('Persisting app data to the file="%s"', file_path)
-        with open(file_path, "w") as json_output:
-            json.dump(
-                app_data,
-                json_output,
-                ensure_ascii=True,
-                check_circular=True,
-                indent=4,
-                **json_kwargs
-            )
+    def _to_json_entries(
+            app_data: AppData,
+            existing: Mapping[str, Any],
+            with_submissions: bool = True
+    ) -> Mapping[str, Mapping[str, _JsonEntry]]:
+        entries: Dict[str, Dict[str, _JsonEntry]] = {
+            _form_id: {
+                _version: (_entry["form"], list(_entry["submissions"]))
+                for _version, _entry in _versions.items()
+            }
+            for _form_id, _versions in existing.items()
+        }
+        for _form_id, _versions in app_data.data.items():
+            _form_entries = entries.setdefault(_form_id, dict())
+            for _version, _entry in _versions.items():
+                if not with_submissions:
+                    _form_entries[_version] = (_entry["form"], [])
+                    continue
+                # Submissions are written as they are, without being copied,
+                # unless there are existing submissions to merge them with.
+                if not _form_entries.get(_version, (None, []))[1]:
+                    _form_entries[_version] = (
+                        _entry["form"],
+                        _entry["submissions"]
+                    )
+                    continue
+                _new_ids: Set[str] = {
+                    _sub.meta.instance_id
+                    for _sub in _entry["submissions"]
+                    if _sub.meta.instance_id
+                }
+                _existing_subs: List[Any] = [
+                    _sub
+                    for _sub in _form_entries[_version][1]
+                    if _sub["meta"]["instance_id"] not in _new_ids
+                ]
+                _form_entries[_version] = (
+                    _entry["form"],
+                    _existing_subs + list(_entry["submissions"])
+                )
+        return entries
 
 
 class FetchSubmissions(Task[AppData, AppData]):
+    """
+    Retrieve the submissions of every form on the app data.
+
+    Submissions are streamed, one at a time, from the data source to the
+    given submission consumers. Each submission, together with the form
+    version it belongs to, is handed over to each of the submission consumers
+    as soon as it is retrieved, see `iter_form_submissions`. Consumers that
+    are also context managers are entered before the first submission is
+    retrieved and exited once all the submissions have been retrieved.
+
+    When `threaded` is `True`, submissions are retrieved and handed over to
+    the submission consumers on separate threads, connected by a queue of at
+    most `queue_size` submissions. Retrieving the next submissions then
+    overlaps with consuming the previous ones.
+
+    When `retain_submissions` is `False`, submissions are not added to the app
+    data, leaving the submission consumers as the only place where the
+    submissions are processed. This keeps memory usage flat regardless of the
+    number of submissions a form has.
+
+    When a `sync_state_store` is given, submissions are synced incrementally.
+    Only the submissions received by the data source since the last sync of a
+    form, less the `watermark_overlap`, and whose instance ids haven't been
+    seen before are retrieved. The high-water marks of the forms synced are
+    kept in memory until `save_sync_state` is called, which should only
+    happen once the retrieved submissions have been durably written, see
+    `SaveSyncState`. A failed run then never advances the high-water mark
+    of a form past submissions that were not written.
 
-    def __init__(self, transport: Transport):
+    When an `instance_id_filter` is given, only the submissions whose
+    instance ids it accepts are retrieved.
+
+    The retrieval and consumption of each form's submissions are reported,
+    as the "retrieve_submissions" and "consume_submissions" stages, to the
+    given pipeline `hooks`. `bytes_written` sums the bytes written by the
+    submission consumers that report them.
+
+    Form versions referred to by submissions but missing from the app data
+    are retrieved on demand, once per version, and added to the app data.
+    Submissions whose instance ids were already retrieved for the form
+    during the same sync, or are already present on the app data, are
+    skipped.
+    """
+
+    def __init__(
+            self,
+            transport: Transport,
+            submission_consumers: Sequence[SubmissionConsumer] = tuple(),
+            retain_submissions: bool = True,
+            sync_state_store: Optional[SyncStateStore] = None,
+            watermark_overlap: timedelta = _DEFAULT_WATERMARK_OVERLAP,
+            threaded: bool = False,
+            queue_size: Optional[int] = None,
+            instance_id_filter: Optional[Callable[[str], bool]] = None,
+            hooks: Sequence[PipelineHook] = tuple()
+    ):
         self._transport: Transport = transport
+        self._submission_consumers: Sequence[SubmissionConsumer] = tuple(
+            submission_consumers
+        )
+        self._retain_submissions: bool = retain_submissions
+        self._sync_state_store: Optional[SyncStateStore] = sync_state_store
+        self._watermark_overlap: timedelta = watermark_overlap
+        self._threaded: bool = threaded
+        self._queue_size: Optional[int] = queue_size
+        self._instance_id_filter: Optional[Callable[[str], bool]] = (
+            instance_id_filter
+        )
+        self._hooks: Sequence[PipelineHook] = tuple(hooks)
+        # The start of the sync and the instance ids synced, by form id, of
+        # the forms whose high-water marks are yet to be advanced.
+        self._pending_watermarks: Dict[str, Tuple[datetime, List[str]]] = (
+            dict()
+        )
 
-    def execute(self, an_input: AppData) -> AppData:
-        for _form_id in an_input.data:
-            _form_versions = an_input.get_all_form_versions(_form_id)
-            LOGGER.info('Fetching submissions for form with id="%s"', _form_id)
-            _subs = self._transport.list_form_submissions(
+    @property
+    def bytes_written(self) -> int:
+        return sum(
+            getattr(_consumer, "bytes_written", 0)
+            for _consumer in self._submission_consumers
+        )
+
+    def save_sync_state(self) -> None:
+        """Advance and persist the high-water marks of the forms synced so far.
+
+        Does nothing when no `sync_state_store` was given.
+        """
+        if self._sync_state_store is None or not self._pending_watermarks:
+            return
+        for _form_id, (_synced_at, _instance_ids) in (
+                self._pending_watermarks.items()
+        ):
+            self._sync_state_store.update_watermark(
                 _form_id,
-                _form_versions
+                synced_at=_synced_at,
+                instance_ids=_instance_ids
             )
-            for _version, _sub in _subs.items():
-                an_input.add_form_submission(
-                    form_id=_form_id,
-                    form_version=_version,
-                    submission=_sub
-                )
+        self._sync_state_store.save()
+        self._pending_watermarks.clear()
+
+    def execute(self, an_input: AppData) -> AppData:
+        with ExitStack() as exit_stack:
+            for _consumer in self._submission_consumers:
+                if isinstance(_consumer, AbstractContextManager):
+                    exit_stack.enter_context(_consumer)
+            for _form_id in tuple(an_input.data):
+                self._fetch_form_submissions(an_input, _form_id)
         return an_input
+
+    def iter_form_submissions(
+            self,
+            app_data: AppData,
+            form_id: str
+    ) -> Iterator[FormSubmission]:
+        """Lazily retrieve the new submissions of a form.
+
+        Each submission is yielded together with its form version as soon as
+        it is retrieved. Submissions already retrieved by this call, e.g.
+        listed on more than one page, or already on the app data are skipped.
+
+        :param app_data: The app data to look up the form's versions and
+               known submissions on. Retrieved form versions are added to it.
+        :param form_id: The id of the form whose submissions to retrieve.
+
+        :return: An iterator of the form's new submissions and their form
+                 versions.
+        """
+        _form_versions: Mapping[str, XForm] = _LazyFormVersions(
+            self._transport,
+            form_id,
+            form_versions=app_data.get_all_form_versions(form_id),
+            on_load=app_data.add_form
+        )
+        # Submissions aren't on the app data when they aren't retained.
+        synced_instance_ids: Set[str] = set()
+        _sub: PrimaryInstanceDocumentRoot
+        for _sub in self._transport.iter_form_submissions(
+                form_id,
+                _form_versions,
+                **self._fetch_options(form_id)
+        ):
+            instance_id: Optional[str] = _sub.meta.instance_id
+            if instance_id and (
+                    instance_id in synced_instance_ids
+                    or app_data.has_submission(instance_id)
+            ):
+                LOGGER.debug(
+                    'Skipping duplicate submission with instance id="%s"',
+                    instance_id
+                )
+                continue
+            if instance_id:
+                synced_instance_ids.add(instance_id)
+            yield _form_versions[_sub.version], _sub
+
+    def _fetch_form_submissions(self, app_data: AppData, form_id: str) -> None:
+        LOGGER.info('Fetching submissions for form with id="%s"', form_id)
+        sync_started_at: datetime = datetime.now(timezone.utc)
+        synced_instance_ids: List[str] = []
+        fetch: FlatMap[str, FormSubmission] = FlatMap(
+            partial(self.iter_form_submissions, app_data)
+        )
+        consume: Consumer[FormSubmission] = Consumer(
+            partial(
+                self._consume_form_submission,
+                app_data,
+                synced_instance_ids
+            )
+        )
+        pipeline: StreamingPipeline[str, FormSubmission] = (
+            ThreadedStreamingPipeline if self._threaded else StreamingPipeline
+        )(
+            Stage(fetch, name="retrieve_submissions"),
+            Stage(
+                consume,
+                queue_size=self._queue_size,
+                name="consume_submissions"
+            ),
+            hooks=self._hooks
+        )
+        for _ in pipeline.execute((form_id,)):
+            pass
+
+        if self._sync_state_store is not None:
+            LOGGER.info(
+                'Synced %d new submissions for form with id="%s"',
+                len(synced_instance_ids),
+                form_id
+            )
+            self._pending_watermarks[form_id] = (
+                sync_started_at,
+                synced_instance_ids
+            )
+
+    def _consume_form_submission(
+            self,
+            app_data: AppData,
+            synced_instance_ids: List[str],
+            form_submission: FormSubmission
+    ) -> None:
+        for _consumer in self._submission_consumers:
+            _consumer.execute(form_submission)
+        form, submission = form_submission
+        if self._retain_submissions:
+            app_data.add_form_submission(
+                form_id=form.id,
+                form_version=submission.version,
+                submission=submission
+            )
+        if submission.meta.instance_id:
+            synced_instance_ids.append(submission.meta.instance_id)
+
+    def _fetch_options(self, form_id: str) -> Dict[str, Any]:
+        options: Dict[str, Any] = self._sync_options(form_id)
+        if self._instance_id_filter is not None:
+            options["instance_id_filter"] = self._instance_id_filter
+        return options
+
+    def _sync_options(self, form_id: str) -> Dict[str, Any]:
+        if self._sync_state_store is None:
+            return dict()
+        last_synced_at: Optional[datetime]
+        last_synced_at = self._sync_state_store.get_last_synced_at(form_id)
+        if last_synced_at is None:
+            return dict()
+        return {
+            "submitted_after": last_synced_at - self._watermark_overlap,
+            "exclude_instance_ids": self._sync_state_store.get_instance_ids(
+                form_id
+            )
+        }
+
+
+class SaveSyncState(Consumer[AppData]):
+    """
+    Advance and persist the high-water marks of the forms synced by the given
+    `FetchSubmissions` task, see `FetchSubmissions.save_sync_state`.
+
+    Submission consumers are only exited once all the submissions have been
+    retrieved and the app data is only written by later tasks. This task
+    should therefore come after all the tasks writing the app data.
+    """
+
+    def __init__(self, fetch_submissions: FetchSubmissions):
+        ensure_not_none(
+            fetch_submissions,
+            message='"fetch_submissions" MUST be provided.'
+        )
+        super().__init__(lambda _item: fetch_submissions.save_sync_state())
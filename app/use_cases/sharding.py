@@ -0,0 +1,341 @@
+import json
+import logging
+import os
+from datetime import datetime, timezone
+from typing import Any, Dict, List, Sequence, Set, TypedDict
+
+from app.core import RichXFormsSubsError
+from app.lib import (
+    Shard,
+    ShardMapping,
+    merge_csv_outputs,
+    merge_ndjson_outputs,
+    merge_sqlite_databases,
+    merge_xlsx_workbooks
+)
+
+from .main_pipeline import merge_json_files
+
+# =============================================================================
+# TYPES
+# =============================================================================
+
+class ShardManifest(TypedDict):
+    version: int
+    shard: ShardMapping
+    output_format: str
+    compress: bool
+    normalized: bool
+    # The ids of the forms processed by the shard.
+    form_ids: List[str]
+    # The names of the output files of the shard, relative to its directory.
+    files: List[str]
+    # ISO 8601 formatted, timezone aware datetime of when the shard finished.
+    created_at: str
+
+
+# =============================================================================
+# CONSTANTS
+# =============================================================================
+
+LOGGER = logging.getLogger(__name__)
+
+SHARD_MANIFEST_FILE_NAME: str = "shard_manifest.json"
+
+_MANIFEST_FORMAT_VERSION: int = 1
+
+# Manifest entries that MUST be the same on all the shards of a run.
+_SHARED_MANIFEST_ENTRIES: Sequence[str] = (
+    "output_format",
+    "compress",
+    "normalized"
+)
+
+
+# =============================================================================
+# HELPERS
+# =============================================================================
+
+def _output_file_names(
+        out_dir: str,
+        output_format: str,
+        compress: bool = False
+) -> List[str]:
+    file_names: List[str] = ["all_forms.json"]
+    if output_format == "json":
+        file_names.append("all_forms_and_subs.json")
+    elif output_format == "ndjson":
+        suffix: str = ".gz" if compress else ""
+        file_names.append("forms.ndjson" + suffix)
+        file_names.append("submissions.ndjson" + suffix)
+    elif output_format == "csv":
+        file_names.extend(
+            sorted(
+                _file_name
+                for _file_name in os.listdir(out_dir)
+                if _file_name.endswith(".csv")
+            )
+        )
+    elif output_format == "sqlite":
+        file_names.append("submissions.sqlite3")
+    elif output_format == "xlsx":
+        file_names.append("submissions.xlsx")
+    return [
+        _file_name
+        for _file_name in file_names
+        if os.path.exists(os.path.join(out_dir, _file_name))
+    ]
+
+
+def merge_outputs(
+        out_dir: str,
+        source_dirs: Sequence[str],
+        output_format: str,
+        compress: bool = False,
+        append: bool = False,
+        overlapping: bool = False,
+        move_files: bool = False
+) -> None:
+    """
+    Merge the outputs of several runs of the main pipeline into a single set
+    of outputs, the same as that of a single run.
+
+    :param out_dir: The directory to write the merged outputs to.
+    :param source_dirs: The output directories of the runs, in order.
+    :param output_format: The format of the outputs to merge.
+    :param compress: Whether the outputs to merge are gzip compressed.
+    :param append: Whether to append to the existing outputs in `out_dir`
+           instead of replacing them. Only applies to the ndjson and csv
+           formats, sqlite databases are always merged into.
+    :param overlapping: Whether the same forms may be present on the outputs
+           of several runs, i.e. the runs processed disjoint sets of
+           submissions instead of disjoint sets of forms.
+    :param move_files: Whether output files may be moved out of the source
+           directories instead of being copied.
+    """
+    merge_json_files(
+        os.path.join(out_dir, "all_forms.json"),
+        [
+            os.path.join(_source_dir, "all_forms.json")
+            for _source_dir in source_dirs
+        ],
+        overlapping=overlapping
+    )
+    if output_format == "json":
+        merge_json_files(
+            os.path.join(out_dir, "all_forms_and_subs.json"),
+            [
+                os.path.join(_source_dir, "all_forms_and_subs.json")
+                for _source_dir in source_dirs
+            ],
+            overlapping=overlapping
+        )
+    elif output_format == "ndjson":
+        merge_ndjson_outputs(
+            out_dir,
+            source_dirs,
+            compress=compress,
+            append=append,
+            unique_forms=overlapping
+        )
+    elif output_format == "csv":
+        merge_csv_outputs(
+            out_dir,
+            source_dirs,
+            append=append,
+            move=move_files
+        )
+    elif output_format == "sqlite":
+        merge_sqlite_databases(
+            os.path.join(out_dir, "submissions.sqlite3"),
+            [
+                _file_path for _file_path in (
+                    os.path.join(_source_dir, "submissions.sqlite3")
+                    for _source_dir in source_dirs
+                )
+                if os.path.exists(_file_path)
+            ]
+        )
+    elif output_format == "xlsx":
+        merge_xlsx_workbooks(
+            os.path.join(out_dir, "submissions.xlsx"),
+            [
+                os.path.join(_source_dir, "submissions.xlsx")
+                for _source_dir in source_dirs
+            ],
+            combine_sheets=overlapping
+        )
+
+
+# =============================================================================
+# SHARD MANIFESTS
+# =============================================================================
+
+def write_shard_manifest(
+        out_dir: str,
+        shard: Shard,
+        output_format: str,
+        form_ids: Sequence[str],
+        compress: bool = False,
+        normalized: bool = False
+) -> ShardManifest:
+    """
+    Describe the outputs of a shard on a manifest file in its output
+    directory, for use by `merge_shard_outputs`.
+
+    :param out_dir: The output directory of the shard.
+    :param shard: The shard.
+    :param output_format: The format of the shard's outputs.
+    :param form_ids: The ids of the forms processed by the shard.
+    :param compress: Whether the shard's outputs are gzip compressed.
+    :param normalized: Whether the shard's outputs are normalized.
+
+    :return: The manifest written.
+    """
+    manifest: ShardManifest = {
+        "version": _MANIFEST_FORMAT_VERSION,
+        "shard": shard.to_json(),
+        "output_format": output_format,
+        "compress": compress,
+        "normalized": normalized,
+        "form_ids": sorted(form_ids),
+        "files": _output_file_names(out_dir, output_format, compress),
+        "created_at": datetime.now(timezone.utc).isoformat()
+    }
+    file_path: str = os.path.join(out_dir, SHARD_MANIFEST_FILE_NAME)
+    LOGGER.debug('Writing the shard manifest="%s"', file_path)
+    temp_file_path: str = "%s.tmp" % file_path
+    with open(temp_file_path, "w") as manifest_file:
+        json.dump(manifest, manifest_file, ensure_ascii=True, indent=4)
+    os.replace(temp_file_path, file_path)
+    return manifest
+
+
+def load_shard_manifest(shard_dir: str) -> ShardManifest:
+    """
+    Load the manifest of the shard whose outputs are in the given directory.
+
+    :param shard_dir: The output directory of the shard.
+
+    :return: The shard's manifest.
+
+    :raise RichXFormsSubsError: If the directory has no valid manifest.
+    """
+    file_path: str = os.path.join(shard_dir, SHARD_MANIFEST_FILE_NAME)
+    if not os.path.exists(file_path):
+        raise RichXFormsSubsError(
+            'No shard manifest found in the directory "%s".' % shard_dir
+        )
+    with open(file_path, "rb") as manifest_file:
+        manifest: Dict[str, Any] = json.load(manifest_file)
+    if manifest.get("version") != _MANIFEST_FORMAT_VERSION:
+        raise RichXFormsSubsError(
+            'Unsupported shard manifest version "%s" in "%s".' % (
+                manifest.get("version"),
+                file_path
+            )
+        )
+    return ShardManifest(**manifest)  # type: ignore
+
+
+def merge_shard_outputs(out_dir: str, shard_dirs: Sequence[str]) -> None:
+    """
+    Merge the outputs of the shards of a run into the outputs that a single,
+    unsharded run would have produced.
+
+    The shards' manifests MUST agree on the format of the outputs and on how
+    the work was sharded. Missing shards are logged, and the outputs of the
+    shards present merged.
+
+    :param out_dir: The directory to write the merged outputs to. Existing
+           outputs are replaced.
+    :param shard_dirs: The output directories of the shards.
+
+    :raise RichXFormsSubsError: If the shards' manifests are missing or
+           inconsistent, or if the outputs of a shard are missing.
+    """
+    manifests: Dict[str, ShardManifest] = {
+        _shard_dir: load_shard_manifest(_shard_dir)
+        for _shard_dir in shard_dirs
+    }
+    if not manifests:
+        raise RichXFormsSubsError("No shards to merge.")
+    if os.path.realpath(out_dir) in map(os.path.realpath, shard_dirs):
+        raise RichXFormsSubsError(
+            "Shards cannot be merged into the directory of one of the shards."
+        )
+    shards: Dict[str, Shard] = {
+        _shard_dir: Shard.of_mapping(_manifest["shard"])
+        for _shard_dir, _manifest in manifests.items()
+    }
+    first_dir: str = shard_dirs[0]
+    first: ShardManifest = manifests[first_dir]
+    seen_indexes: Set[int] = set()
+    for _shard_dir in shard_dirs:
+        manifest: ShardManifest = manifests[_shard_dir]
+        shard: Shard = shards[_shard_dir]
+        for _entry in _SHARED_MANIFEST_ENTRIES:
+            if manifest[_entry] != first[_entry]:  # type: ignore
+                raise RichXFormsSubsError(
+                    'The shards "%s" and "%s" differ on "%s".' % (
+                        first_dir,
+                        _shard_dir,
+                        _entry
+                    )
+                )
+        if (shard.count, shard.key) != (
+                shards[first_dir].count,
+                shards[first_dir].key
+        ):
+            raise RichXFormsSubsError(
+                'The shards "%s" and "%s" are not shards of the same run.' % (
+                    first_dir,
+                    _shard_dir
+                )
+            )
+        if shard.index in seen_indexes:
+            raise RichXFormsSubsError(
+                'The shard "%s" is given more than once.' % shard
+            )
+        seen_indexes.add(shard.index)
+        for _file_name in manifest["files"]:
+            if not os.path.exists(os.path.join(_shard_dir, _file_name)):
+                raise RichXFormsSubsError(
+                    'The output file "%s" of the shard "%s" is missing.' % (
+                        _file_name,
+                        shard
+                    )
+                )
+    missing_indexes: Set[int] = set(
+        range(shards[first_dir].count)
+    ) - seen_indexes
+    if missing_indexes:
+        LOGGER.warning(
+            "Merging without the shards %s.",
+            ", ".join(
+                str(Shard(_index, shards[first_dir].count))
+                for _index in sorted(missing_indexes)
+            )
+        )
+
+    os.makedirs(out_dir, exist_ok=True)
+    # Outputs that are merged into, e.g. sqlite databases, are replaced.
+    for _file_name in {
+        _file_name
+        for _manifest in manifests.values()
+        for _file_name in _manifest["files"]
+    }:
+        if os.path.exists(os.path.join(out_dir, _file_name)):
+            os.remove(os.path.join(out_dir, _file_name))
+    LOGGER.info(
+        'Merging %d shards into the directory="%s"',
+        len(manifests),
+        out_dir
+    )
+    merge_outputs(
+        out_dir,
+        sorted(shard_dirs, key=lambda _shard_dir: shards[_shard_dir].index),
+        output_format=first["output_format"],
+        compress=first["compress"],
+        overlapping=shards[first_dir].key == "instance"
+    )
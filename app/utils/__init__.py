@@ -1,7 +1,9 @@
 from .checkers import ensure_not_none, ensure_not_none_nor_empty
+from .concurrency import bounded_ordered_map
 from .module_loading import import_string
 
 __all__ = [
+    "bounded_ordered_map",
     "ensure_not_none",
     "ensure_not_none_nor_empty",
     "import_string"
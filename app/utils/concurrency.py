@@ -0,0 +1,43 @@
+from collections import deque
+from concurrent.futures import Executor, Future
+from typing import Callable, Deque, Iterable, Iterator, TypeVar
+
+_T = TypeVar("_T")
+_R = TypeVar("_R")
+
+
+def bounded_ordered_map(
+        executor: Executor,
+        fn: Callable[[_T], _R],
+        items: Iterable[_T],
+        max_in_flight: int
+) -> Iterator[_R]:
+    """
+    Lazily map a callable over the given items using an executor.
+
+    At most `max_in_flight` calls are pending on the executor at any given
+    time and the results are yielded in the same order as the given items
+    regardless of the order in which the calls complete. If the returned
+    iterator is closed before it is exhausted, all pending calls that haven't
+    started yet are cancelled.
+
+    :param executor: The executor to submit the calls to.
+    :param fn: The callable to apply to each item.
+    :param items: The items to map the callable over.
+    :param max_in_flight: The maximum number of pending calls. Must be
+           greater than zero.
+
+    :return: An iterator of the results of each call in input order.
+    """
+    assert max_in_flight > 0, '"max_in_flight" MUST be greater than zero.'
+    pending: Deque[Future[_R]] = deque()
+    try:
+        for item in items:
+            pending.append(executor.submit(fn, item))
+            if len(pending) >= max_in_flight:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+    finally:
+        for _future in pending:
+            _future.cancel()
@@ -0,0 +1,138 @@
+"""
+Benchmark the construction of XForms spec nodes.
+
+Reports the mean time taken to construct each kind of node and the memory
+retained by each constructed node, as traced by `tracemalloc`.
+
+Run from the repository root with::
+
+    python -m benchmarks.spec_nodes [-n NODES]
+"""
+import time
+import tracemalloc
+from argparse import ArgumentParser
+from typing import Any, Callable, Dict, List, Mapping
+
+from app.core import (
+    InstanceMetadata,
+    PrimaryInstanceDocumentRoot,
+    PrimaryInstanceMapping,
+    Question,
+    QuestionMapping
+)
+
+# =============================================================================
+# CONSTANTS
+# =============================================================================
+
+_DEFAULT_NODES: int = 200_000
+
+_QUESTION_KWARGS: Mapping[str, Any] = {
+    "name": "q",
+    "question_type": "input",
+    "read_only": False,
+    "xpath": "/data/q",
+    "label": "Q",
+    "required": False,
+    "sub_questions": None,
+    "value": "v",
+    "tag": None
+}
+
+# The number of questions of each benchmarked document root.
+_DOCUMENT_ROOT_QUESTIONS: int = 20
+
+
+# =============================================================================
+# HELPERS
+# =============================================================================
+
+def _benchmark(label: str, nodes: int, make: Callable[[], Any]) -> None:
+    # Warm up, e.g. any lazily generated initializers.
+    make()
+    started_at: float = time.perf_counter()
+    for _ in range(nodes):
+        make()
+    elapsed: float = time.perf_counter() - started_at
+
+    tracemalloc.start()
+    kept: List[Any] = [make() for _ in range(nodes)]
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del kept
+    print(
+        "%-32s %9.2fus/node %9.1fB/node" % (
+            label,
+            elapsed / nodes * 1e6,
+            size / nodes
+        )
+    )
+
+
+def _document_root_mapping(
+        question_mapping: QuestionMapping
+) -> PrimaryInstanceMapping:
+    questions: Dict[str, QuestionMapping] = {
+        "q%d" % _index: {**question_mapping, "name": "q%d" % _index}
+        for _index in range(_DOCUMENT_ROOT_QUESTIONS)
+    }
+    return {
+        "id": "x",
+        "version": "1",
+        "questions": questions,
+        "meta": {"instance_id": "uuid:x", "instance_name": None},
+        "prefix": None,
+        "delimiter": None
+    }
+
+
+# =============================================================================
+# MAIN
+# =============================================================================
+
+def main() -> None:
+    parser = ArgumentParser(
+        description="Benchmark the construction of XForms spec nodes."
+    )
+    parser.add_argument(
+        "-n",
+        "--nodes",
+        default=_DEFAULT_NODES,
+        help=(
+            "The number of nodes of each kind to construct. A twentieth as "
+            "many document roots are constructed (default: %(default)d)."
+        ),
+        type=int
+    )
+    args = parser.parse_args()
+
+    question_mapping: QuestionMapping = Question(
+        **_QUESTION_KWARGS
+    ).to_json()
+    document_root_mapping: PrimaryInstanceMapping = _document_root_mapping(
+        question_mapping
+    )
+    _benchmark(
+        "Question(**kwargs)",
+        args.nodes,
+        lambda: Question(**_QUESTION_KWARGS)
+    )
+    _benchmark(
+        "InstanceMetadata(**kwargs)",
+        args.nodes,
+        lambda: InstanceMetadata(instance_id="uuid:x", instance_name=None)
+    )
+    _benchmark(
+        "Question.of_mapping",
+        args.nodes,
+        lambda: Question.of_mapping(question_mapping)
+    )
+    _benchmark(
+        "DocumentRoot.of_mapping (%dq)" % _DOCUMENT_ROOT_QUESTIONS,
+        args.nodes // _DOCUMENT_ROOT_QUESTIONS,
+        lambda: PrimaryInstanceDocumentRoot.of_mapping(document_root_mapping)
+    )
+
+
+if __name__ == "__main__":
+    main()